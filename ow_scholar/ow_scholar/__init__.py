@@ -1,15 +1,38 @@
 from pyramid.config import Configurator
-from pyramid_zodbconn import get_connection
 from .models import appmaker
-from .slack_bot import slack_events, slack_api, SCHEDULER_KEY
+import os
+from datetime import timedelta
+from . import slack_bot
+from .slack_bot import slack_events, slack_api, send_message
+from .outbox import SlackSender
+from .inbox import SlackEventQueue
+from .scheduling import SchedulerEngine
+from .leases import LeaseKeeper
+from .http_cache import ResponseCache
+from .percolator import ArxivPercolator
+from .metrics import metrics_view, watch_engine, count_retry
+from .tracing import configure_tracing
+from . import fetching
 from zodburi import resolve_uri
 from ZODB.DB import DB
-import transaction
+
+
+def zodb_connection(request):
+    """
+    The request's connection to the database opened by `main`, in the
+    request's transaction. It's closed when the request is finished
+    """
+    conn = request.registry.zodb_db.open(transaction_manager=request.tm)
+
+    def close(request):
+        conn.transaction_manager.abort()
+        conn.close()
+    request.add_finished_callback(close)
+    return conn
 
 
 def root_factory(request):
-    conn = get_connection(request)
-    return appmaker(conn.root())
+    return appmaker(request.zodb_connection.root())
 
 
 def make_init_db(uri):
@@ -19,57 +42,128 @@ def make_init_db(uri):
     return db
 
 
-class SchedulerData(object):
-    def __init__(self):
-        self.connection = None
-        self.scheduler = None
-        self.database = None
-
-
-def run_schedulers(uri, conn):
-    sdata = []
-    try:
-        root = appmaker(conn.root())
-        schedulers = root.get(SCHEDULER_KEY)
-        if schedulers:
-            print("we have schedulers")
-            for oid in (x._p_oid for x in schedulers.values()):
-                sd = SchedulerData()
-                sd.database = make_init_db(uri)
-                sd.connection = sd.database.open()
-                sd.scheduler = sd.connection.get(oid)
-                sd.scheduler.run()
-                sdata.append(sd)
-        else:
-            print("we have no schedulers")
-    finally:
-        transaction.commit()
-        return sdata
+SCHEDULER_MODES = ('all', 'web', 'worker')
+
+
+def run_schedulers(db, settings, post=send_message):
+    """
+    Start the process-wide scheduler engine for every stored scheduler
+
+    Messages to Slack go through a `.outbox.SlackSender` on the engine, and
+    events from Slack are handled on its workers by a `.inbox.SlackEventQueue`.
+    Their queues and counters are served on ``/metrics``. See `.metrics`
+
+    Parameters
+    ----------
+    db : ZODB.DB.DB
+        The database the schedulers are stored in. It is shared with the web
+        application. The engine opens one connection for its schedulers and
+        one for each of its threads
+    settings : dict
+        Application settings. ``scheduler.max_workers`` bounds how many
+        searches may run at once and ``scheduler.coalesce_window`` is how many
+        seconds one fetch is shared between subscriptions to the same query.
+        ``scheduler.catch_up_concurrency`` bounds how many catch-up runs, for
+        runs missed while the schedulers weren't running, may run at once.
+        Schedules added by other processes are picked up as soon as the
+        storage tells the engine about them. For storages which don't,
+        ``scheduler.poll_interval`` is how many seconds apart the database is
+        checked for them instead.
+        ``percolator.categories`` lists arXiv categories to fetch one shared
+        listing of, refreshed every ``percolator.refresh_interval`` seconds and
+        going back ``percolator.lookback`` seconds. See
+        `.percolator.ArxivPercolator`
+
+        ``scheduler.mode`` says which stored schedulers to run: ``all`` of
+        them, which is the default, none of them for ``web`` processes, or,
+        for ``worker`` processes, a share of them split with the other workers
+        by leases. See `.leases.LeaseKeeper`. Workers are named by
+        ``scheduler.worker_id``, hold leases for ``scheduler.lease_seconds``
+        and stop firing searches ``scheduler.lease_grace`` seconds before
+        their leases run out. Slack messages are leased to the process which
+        queued them under the same ``scheduler.worker_id``. See
+        `.outbox.SlackSender`
+    post : callable, optional
+        Called like `.slack_bot.send_message` to post to Slack
+    """
+    mode = settings.get('scheduler.mode', 'all')
+    if mode not in SCHEDULER_MODES:
+        raise ValueError('scheduler.mode must be one of {}, not {!r}'.format(
+            ', '.join(SCHEDULER_MODES), mode))
+    engine = SchedulerEngine(db,
+                             max_workers=int(settings.get('scheduler.max_workers', 4)),
+                             coalesce_window=float(settings.get('scheduler.coalesce_window', 60)),
+                             catch_up_concurrency=int(
+                                 settings.get('scheduler.catch_up_concurrency', 2)),
+                             poll_interval=float(settings.get('scheduler.poll_interval') or 0))
+    engine.run_schedulers = mode != 'web'
+    categories = settings.get('percolator.categories', '').split()
+    if categories:
+        engine.percolator = ArxivPercolator(
+            categories,
+            refresh_interval=float(settings.get('percolator.refresh_interval', 3600)),
+            lookback=timedelta(seconds=float(settings.get('percolator.lookback', 172800))))
+        engine.add_service(engine.percolator)
+    token = os.environ.get('SLACK_API_KEY')
+    sender = SlackSender(engine, post, token=token,
+                         worker=settings.get('scheduler.worker_id') or None)
+    engine.add_service(sender)
+    if mode == 'worker':
+        engine.leases = LeaseKeeper(engine,
+                                    worker=settings.get('scheduler.worker_id') or None,
+                                    duration=float(settings.get('scheduler.lease_seconds', 30)),
+                                    grace=float(settings.get('scheduler.lease_grace', 5)))
+        engine.add_service(engine.leases)
+    slack_bot.outbound = sender
+    engine.start()
+    slack_bot.event_queue = SlackEventQueue(engine, post, token=token)
+    slack_bot.event_queue.prepare()
+    watch_engine(engine, sender, slack_bot.event_queue)
+    return engine
+
+
+def configure_response_cache(settings):
+    """
+    Put a `.http_cache.ResponseCache` under every query's requests if
+    ``cache.directory`` is set. ``cache.max_bytes`` bounds its size and
+    ``cache.ttl.<target>`` gives the seconds responses stay fresh for each of
+    the `SEARCH_TARGETS`
+    """
+    directory = settings.get('cache.directory')
+    if not directory:
+        return None
+    ttl_prefix = 'cache.ttl.'
+    ttls = {k[len(ttl_prefix):]: float(v) for k, v in settings.items()
+            if k.startswith(ttl_prefix)}
+    cache = ResponseCache(directory,
+                          max_bytes=int(settings.get('cache.max_bytes', 64 * 1024 * 1024)),
+                          ttls=ttls)
+    fetching.response_cache = cache
+    return cache
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     settings['tm.manager_hook'] = 'pyramid_tm.explicit_manager'
-    uri = settings['zodbconn.uri']
-    db = make_init_db(uri)
-    conn = db.open()
-    try:
-        run_schedulers(uri, conn)
-    finally:
-        conn.close()
-        db.close()
-
+    configure_response_cache(settings)
+    configure_tracing(settings)
     with Configurator(settings=settings) as config:
         config.include('pyramid_jinja2')
         config.add_jinja2_renderer('.j2', settings_prefix='jinja2.')
         config.include('pyramid_tm')
         config.include('pyramid_retry')
-        config.include('pyramid_zodbconn')
+        db = make_init_db(settings['zodbconn.uri'])
+        config.registry.zodb_db = db
+        config.add_request_method(zodb_connection, reify=True)
+        config.registry.scheduler_engine = run_schedulers(db, settings)
         config.set_root_factory(root_factory)
         config.add_static_view('static', 'static', cache_max_age=3600)
         config.add_route('slack_events', '/events')
         config.add_route('slack_api', '/api')
+        config.add_route('metrics', '/metrics')
         config.add_view(slack_events, route_name='slack_events')
         config.add_view(slack_api, route_name='slack_api')
+        config.add_view(metrics_view, route_name='metrics')
+        config.add_subscriber(count_retry, 'pyramid_retry.IBeforeRetry')
         return config.make_wsgi_app()
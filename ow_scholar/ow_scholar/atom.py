@@ -0,0 +1,145 @@
+from io import BytesIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+__all__ = ['parse_arxiv_feed', 'iter_arxiv_feed', 'format_arxiv_feed', 'NS']
+
+NS = {'atom': 'http://www.w3.org/2005/Atom',
+      'arxiv': 'http://arxiv.org/schemas/atom',
+      'opensearch': 'http://a9.com/-/spec/opensearch/1.1/'}
+
+
+def _text(elt, path, collapse=True):
+    child = elt.find(path, NS)
+    if child is None or child.text is None:
+        return None
+    if collapse:
+        return ' '.join(child.text.split())
+    return child.text.strip()
+
+
+def parse_entry(elt):
+    """
+    Convert an Atom ``<entry>`` from the arXiv API into a dict with the same
+    keys as the feedparser output in ``arxiv.json``
+    """
+    entry = dict(id=_text(elt, 'atom:id'),
+                 title=_text(elt, 'atom:title'),
+                 summary=_text(elt, 'atom:summary', collapse=False),
+                 updated=_text(elt, 'atom:updated'),
+                 published=_text(elt, 'atom:published'),
+                 arxiv_comment=_text(elt, 'arxiv:comment'),
+                 authors=[dict(name=_text(a, 'atom:name'))
+                          for a in elt.findall('atom:author', NS)],
+                 tags=[dict(term=t.get('term'), scheme=t.get('scheme'))
+                       for t in elt.findall('atom:category', NS)],
+                 links=[dict(ln.attrib) for ln in elt.findall('atom:link', NS)])
+    entry['link'] = next((ln['href'] for ln in entry['links']
+                          if ln.get('rel') == 'alternate'), entry['id'])
+    primary = elt.find('arxiv:primary_category', NS)
+    if primary is not None:
+        entry['arxiv_primary_category'] = dict(primary.attrib)
+    return entry
+
+
+FEED_FIELDS = {'{%s}title' % NS['atom']: 'title',
+               '{%s}updated' % NS['atom']: 'updated',
+               '{%s}totalResults' % NS['opensearch']: 'opensearch_totalresults',
+               '{%s}startIndex' % NS['opensearch']: 'opensearch_startindex',
+               '{%s}itemsPerPage' % NS['opensearch']: 'opensearch_itemsperpage'}
+
+ENTRY_TAG = '{%s}entry' % NS['atom']
+
+
+def iter_arxiv_feed(data, feed=None):
+    """
+    Parse an Atom document from the arXiv API one entry at a time
+
+    Each entry is yielded as soon as its end tag is read and is then dropped
+    from the parse tree, so only one entry is held at a time no matter how
+    many the document has.
+
+    Parameters
+    ----------
+    data : bytes or file-like
+    feed : dict, optional
+        Filled in with the feed's title and OpenSearch paging totals as they
+        are read. These come before the entries in the arXiv API's feeds
+
+    Yields
+    ------
+    dict
+        One dict per entry. See `parse_entry`
+    """
+    if feed is None:
+        feed = dict()
+    for key in FEED_FIELDS.values():
+        feed.setdefault(key, None)
+    if isinstance(data, bytes):
+        data = BytesIO(data)
+    root = None
+    depth = 0
+    for event, elt in ElementTree.iterparse(data, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elt
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elt.tag == ENTRY_TAG:
+            yield parse_entry(elt)
+            root.remove(elt)
+        elif elt.tag in FEED_FIELDS:
+            feed[FEED_FIELDS[elt.tag]] = ' '.join(elt.text.split()) if elt.text else None
+
+
+def parse_arxiv_feed(data):
+    """
+    Parse an Atom document from the arXiv API
+
+    Returns
+    -------
+    dict
+        With ``feed`` holding the OpenSearch paging totals and ``entries``
+        holding one dict per entry. See `parse_entry`
+    """
+    feed = dict()
+    entries = list(iter_arxiv_feed(data, feed))
+    return dict(feed=feed, entries=entries)
+
+
+def format_arxiv_feed(entries, total_results=None, start_index=0):
+    """
+    Write entry dicts, like those from `parse_arxiv_feed`, as an arXiv API Atom
+    document. Useful for standing in for the API
+    """
+    if total_results is None:
+        total_results = start_index + len(entries)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<feed xmlns="{atom}" xmlns:arxiv="{arxiv}" xmlns:opensearch="{opensearch}">'
+             '<title type="html">ArXiv Query</title>'
+             '<opensearch:totalResults>{}</opensearch:totalResults>'
+             '<opensearch:startIndex>{}</opensearch:startIndex>'
+             '<opensearch:itemsPerPage>{}</opensearch:itemsPerPage>'
+             .format(total_results, start_index, len(entries), **NS)]
+    for e in entries:
+        parts.append('<entry><id>{}</id><updated>{}</updated><published>{}</published>'
+                     '<title>{}</title><summary>{}</summary>'
+                     .format(escape(e['id']),
+                             escape(e.get('updated') or ''),
+                             escape(e.get('published') or ''),
+                             escape(e.get('title') or ''),
+                             escape(e.get('summary') or '')))
+        for a in e.get('authors', ()):
+            parts.append('<author><name>{}</name></author>'.format(escape(a['name'])))
+        for ln in e.get('links', ()):
+            parts.append('<link {}/>'.format(' '.join('{}={}'.format(k, quoteattr(v))
+                                                      for k, v in ln.items() if v is not None)))
+        for t in e.get('tags', ()):
+            parts.append('<category term={} scheme={}/>'.format(quoteattr(t['term']),
+                                                                quoteattr(t.get('scheme') or '')))
+        parts.append('</entry>')
+    parts.append('</feed>')
+    return ''.join(parts).encode('utf-8')
@@ -0,0 +1,544 @@
+"""
+Measure throughput and latency against local stand-ins for arXiv and Slack
+
+The benchmark starts an `ArxivStandIn` and a `SlackStandIn` on local ports,
+points the app at them, and then:
+
+1. posts a "search for" event for every subscription to the ``slack_events``
+   view, through the WSGI stack, timing each webhook call and how long the
+   event queue takes to handle them all
+2. lets the scheduler engine run the resulting searches for a while
+
+Requests to arXiv and messages posted to Slack, including replies to the
+events, are counted from the first event to the end.
+
+Results are written as JSON so that runs can be compared. For example::
+
+    ow_scholar_bench --channels 10 --subscriptions 5 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from importlib import resources
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from time import monotonic, sleep, time
+from urllib.parse import urlparse, parse_qs
+
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+
+from . import fetching
+from . import slack_bot
+from .atom import format_arxiv_feed
+from .pubmed import format_esearch, format_pubmed_articles
+from .ratelimit import TokenBucket
+
+L = getLogger(__name__)
+
+__all__ = ['ArxivStandIn', 'PubmedStandIn', 'SlackStandIn', 'Benchmark', 'percentile']
+
+FIXTURE_RESOURCE = 'arxiv.json'
+""" The feed JSON shipped with the package, used when no fixture is given """
+
+
+def load_fixture(path=None):
+    """ The entries from a feed JSON file, or from the packaged `FIXTURE_RESOURCE` """
+    if path is None:
+        text = resources.files(__package__).joinpath(FIXTURE_RESOURCE).read_text()
+    else:
+        with open(path) as f:
+            text = f.read()
+    return json.loads(text)['entries']
+
+
+class StandIn(ABC):
+    """ An HTTP server on a local port, run on a background thread """
+
+    def __init__(self):
+        self.server = None
+        self.thread = None
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @abstractmethod
+    def handle(self, request):
+        """
+        Answer a request
+
+        Returns
+        -------
+        tuple
+            The status, a dict of headers and the body as bytes
+        """
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                with stand_in._lock:
+                    stand_in.requests += 1
+                status, headers, body = stand_in.handle(self)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='ow_scholar-bench-' + type(self).__name__,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+class ArxivStandIn(StandIn):
+    """
+    Answers arXiv API queries with a fixed listing of `size` entries, made
+    from the entries in a fixture like ``arxiv.json``, after waiting `latency`
+    seconds. Paging by ``start`` and ``max_results`` works like the real API
+    """
+
+    def __init__(self, fixture_entries, size=50, latency=0.0, newest=None):
+        super(ArxivStandIn, self).__init__()
+        self.latency = latency
+        newest = newest or datetime.utcnow()
+        self.entries = []
+        for i in range(size):
+            e = dict(fixture_entries[i % len(fixture_entries)])
+            e['id'] = e['link'] = 'http://arxiv.org/abs/9901.{:05d}v1'.format(size - i)
+            e['updated'] = (newest - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            self.entries.append(e)
+
+    def handle(self, request):
+        if self.latency:
+            sleep(self.latency)
+        args = parse_qs(urlparse(request.path).query)
+        start = int(args.get('start', ['0'])[0])
+        size = int(args.get('max_results', ['10'])[0])
+        body = format_arxiv_feed(self.entries[start:start + size],
+                                 total_results=len(self.entries),
+                                 start_index=start)
+        return 200, {'Content-Type': 'application/atom+xml'}, body
+
+
+class PubmedStandIn(StandIn):
+    """
+    Answers E-utilities ESearch and EFetch requests for a fixed listing of
+    articles, like those from `.pubmed.iter_pubmed_articles`, which every
+    search matches. Searches are kept on a history server, and EFetch pages
+    through them by ``WebEnv``, ``query_key``, ``retstart`` and ``retmax``.
+    Requests beyond NCBI's limit of `rate` per second get a 429, like from
+    NCBI
+    """
+
+    def __init__(self, articles, rate=3, latency=0.0):
+        super(PubmedStandIn, self).__init__()
+        self.articles = list(articles)
+        self.rate = rate
+        self.latency = latency
+        self.searches = []
+        """ The arguments of each ESearch request """
+        self.fetches = []
+        """ The arguments of each EFetch request """
+        self.rate_limited = 0
+        self._bucket = TokenBucket(rate, rate)
+        self._history = dict()
+
+    def handle(self, request):
+        if self.latency:
+            sleep(self.latency)
+        url = urlparse(request.path)
+        tool = url.path.rsplit('/', 1)[-1]
+        args = {k: v[0] for k, v in parse_qs(url.query).items()}
+        headers = {'Content-Type': 'text/xml; charset=UTF-8'}
+        if not self._bucket.try_acquire():
+            with self._lock:
+                self.rate_limited += 1
+            headers['Retry-After'] = '1'
+            return 429, headers, b'{"error":"API rate limit exceeded"}'
+        if tool == 'esearch.fcgi':
+            with self._lock:
+                self.searches.append(args)
+                webenv = 'MCID_{}'.format(len(self.searches))
+                self._history[webenv] = self.articles
+            return 200, headers, format_esearch(len(self.articles), webenv, 1)
+        if tool == 'efetch.fcgi':
+            with self._lock:
+                self.fetches.append(args)
+                articles = self._history.get(args.get('WebEnv'))
+            if articles is None:
+                return 400, headers, b'<eFetchResult><ERROR>Unknown WebEnv</ERROR></eFetchResult>'
+            start = int(args.get('retstart', 0))
+            size = int(args.get('retmax', 20))
+            return 200, headers, format_pubmed_articles(articles[start:start + size])
+        return 404, headers, b''
+
+
+class SlackStandIn(StandIn):
+    """
+    Accepts Slack Web API calls, holding ``chat.postMessage`` to Slack's
+    limit of about `rate` messages per second per channel, with short bursts
+    of up to `burst`. Messages over the limit get a 429 with ``Retry-After``,
+    like from Slack
+    """
+
+    def __init__(self, rate=1, burst=2):
+        super(SlackStandIn, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.messages = 0
+        self.rate_limited = 0
+        self.channels = dict()
+        """ Messages posted to each channel """
+        self._buckets = dict()
+
+    def _bucket(self, channel):
+        with self._lock:
+            bucket = self._buckets.get(channel)
+            if bucket is None:
+                bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def handle(self, request):
+        method = request.path.rsplit('/', 1)[-1]
+        length = int(request.headers.get('Content-Length') or 0)
+        raw = request.rfile.read(length) if length else b''
+        if 'json' in (request.headers.get('Content-Type') or ''):
+            args = json.loads(raw or b'{}')
+        else:
+            args = {k: v[0] for k, v in parse_qs(raw.decode('utf-8')).items()}
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if method != 'chat.postMessage':
+            return 200, headers, b'{"ok": true}'
+        channel = args.get('channel')
+        if not self._bucket(channel).try_acquire():
+            with self._lock:
+                self.rate_limited += 1
+            headers['Retry-After'] = '1'
+            return 429, headers, b'{"ok": false, "error": "ratelimited"}'
+        with self._lock:
+            self.messages += 1
+            self.channels[channel] = self.channels.get(channel, 0) + 1
+        resp = dict(ok=True, channel=channel, ts='{:.6f}'.format(time()))
+        return 200, headers, json.dumps(resp).encode('utf-8')
+
+
+def slack_poster(base_url):
+    """
+    Returns a function, called like `.slack_bot.send_message`, which posts to
+    the Slack Web API at ``base_url``
+    """
+    clients = dict()
+    lock = threading.Lock()
+
+    def post(token, channel, text, thread=None):
+        with lock:
+            client = clients.get(token)
+            if client is None:
+                client = clients[token] = slack_bot.slack.WebClient(token=token,
+                                                                    base_url=base_url)
+        kwargs = {'thread_ts': thread} if thread else {}
+        return client.chat_postMessage(channel=channel, text=text, **kwargs)
+    return post
+
+
+def percentile(values, p):
+    """ The ``p`` percentile of the values, by the nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def max_rss():
+    """ The peak resident set size of this process, in bytes, if known """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS, bytes
+    return rss if platform.system() == 'Darwin' else rss * 1024
+
+
+class Benchmark(object):
+    """ One run of the benchmark. See the module documentation """
+
+    BOT_TOKEN = 'bench-bot-token'
+    API_TOKEN = 'bench-api-token'
+
+    def __init__(self, channels=4, subscriptions=5, schedule='every minute',
+                 duration=30, arxiv_size=50, arxiv_latency=0.05, arxiv_rate=None,
+                 slack_rate=1, concurrency=4, digest=False, max_workers=4,
+                 fixture=None, db=None, timeout=60):
+        """
+        Parameters
+        ----------
+        channels : int
+            Channels to subscribe from
+        subscriptions : int
+            Subscriptions in each channel, each to a different query
+        schedule : str
+            The schedule asked for in each subscription
+        duration : float
+            Seconds to let the searches run once all subscriptions are added
+        arxiv_size : int
+            Entries in the arXiv stand-in's listing
+        arxiv_latency : float
+            Seconds the arXiv stand-in waits before answering
+        arxiv_rate : float, optional
+            Requests per second to allow to arXiv. By default, no limit
+        slack_rate : float
+            Messages per second per channel the Slack stand-in allows
+        concurrency : int
+            Webhook calls made at once
+        digest : bool
+            Whether subscriptions post digests. See ``slack.digest``
+        max_workers : int
+            See ``scheduler.max_workers``
+        fixture : str, optional
+            The feed JSON to make the arXiv stand-in's entries from. By
+            default, the one packaged with ow_scholar
+        db : ZODB.DB.DB, optional
+            The database to use. By default, a file storage in a temporary
+            directory, which, unlike an in-memory storage, resolves conflicting
+            writes to BTrees the way the app's storage does
+        timeout : float
+            Seconds to wait for the event queue to handle the events before
+            giving up
+        """
+        self.channels = channels
+        self.subscriptions = subscriptions
+        self.schedule = schedule
+        self.duration = duration
+        self.arxiv_rate = arxiv_rate
+        self.concurrency = concurrency
+        self.digest = digest
+        self.max_workers = max_workers
+        self.db = db
+        self.timeout = timeout
+        self.arxiv = ArxivStandIn(load_fixture(fixture), size=arxiv_size, latency=arxiv_latency)
+        self.slack = SlackStandIn(rate=slack_rate)
+
+    def config(self):
+        return dict(channels=self.channels,
+                    subscriptions=self.subscriptions,
+                    schedule=self.schedule,
+                    duration=self.duration,
+                    arxiv_size=len(self.arxiv.entries),
+                    arxiv_latency=self.arxiv.latency,
+                    arxiv_rate=self.arxiv_rate,
+                    slack_rate=self.slack.rate,
+                    concurrency=self.concurrency,
+                    digest=self.digest,
+                    max_workers=self.max_workers)
+
+    def events(self):
+        # Schedules drop the fraction of a second from their start, which
+        # would put the first run a whole period after the message
+        now = int(time())
+        for c in range(self.channels):
+            for s in range(self.subscriptions):
+                text = 'Search for benchmark query {} at Arxiv {}'.format(s, self.schedule)
+                yield {'token': self.BOT_TOKEN,
+                       'event_id': 'Ev{:06d}{:06d}'.format(c, s),
+                       'event': {'type': 'message',
+                                 'text': text,
+                                 'user': 'Ubench',
+                                 'channel': 'Cbench{:04d}'.format(c),
+                                 'ts': '{:.6f}'.format(now)}}
+
+    @contextmanager
+    def redirected(self):
+        """ Point the app at the stand-ins, and put things back afterwards """
+        saved_url = slack_bot.ARXIV_API_URL
+        saved_limiter = fetching.rate_limiters.get('Arxiv')
+        saved_env = {k: os.environ.get(k) for k in ('SLACK_API_KEY', 'SLACK_BOT_TOKEN')}
+        slack_bot.ARXIV_API_URL = self.arxiv.url + '/api/query'
+        if self.arxiv_rate:
+            fetching.rate_limiters['Arxiv'] = TokenBucket(self.arxiv_rate, 1)
+        else:
+            fetching.rate_limiters.pop('Arxiv', None)
+        os.environ['SLACK_API_KEY'] = self.API_TOKEN
+        os.environ['SLACK_BOT_TOKEN'] = self.BOT_TOKEN
+        try:
+            yield
+        finally:
+            slack_bot.ARXIV_API_URL = saved_url
+            if saved_limiter is not None:
+                fetching.rate_limiters['Arxiv'] = saved_limiter
+            for k, v in saved_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+    def run(self):
+        """
+        Returns
+        -------
+        dict
+            The configuration and results, ready to be written as JSON
+        """
+        from pyramid.config import Configurator
+        from pyramid.request import Request
+        from . import run_schedulers
+
+        settings = {'scheduler.max_workers': str(self.max_workers),
+                    'slack.digest': str(self.digest).lower()}
+        tempdir = None
+        if self.db is None:
+            tempdir = tempfile.TemporaryDirectory()
+            db = DB(FileStorage(os.path.join(tempdir.name, 'bench.fs')))
+        else:
+            db = self.db
+        self.arxiv.start()
+        self.slack.start()
+        engine = None
+        try:
+            with self.redirected():
+                with Configurator(settings=settings) as config:
+                    config.add_route('slack_events', '/events')
+                    config.add_view(slack_bot.slack_events, route_name='slack_events')
+                    app = config.make_wsgi_app()
+                engine = run_schedulers(db, settings,
+                                        post=slack_poster(self.slack.url + '/api/'))
+                queue = slack_bot.event_queue
+
+                def call(body):
+                    req = Request.blank('/events', method='POST',
+                                        body=json.dumps(body).encode('utf-8'),
+                                        content_type='application/json')
+                    start = monotonic()
+                    resp = req.get_response(app)
+                    elapsed = monotonic() - start
+                    if resp.status_code != 200:
+                        L.warning('Webhook answered %s', resp.status)
+                    return elapsed
+
+                bodies = list(self.events())
+                events_start = monotonic()
+                with ThreadPoolExecutor(self.concurrency) as pool:
+                    latencies = list(pool.map(call, bodies))
+                deadline = monotonic() + self.timeout
+                while queue.handled + queue.duplicates < len(bodies):
+                    if monotonic() >= deadline:
+                        raise TimeoutError('Only {} of {} events were handled in {} seconds'.format(
+                            queue.handled + queue.duplicates, len(bodies), self.timeout))
+                    sleep(0.01)
+                events_elapsed = monotonic() - events_start
+
+                sleep(self.duration)
+                elapsed = monotonic() - events_start
+                # Stop posting first so that a message isn't counted as both
+                # posted and still in the outbox
+                stopping, engine = engine, None
+                stopping.stop()
+                arxiv_requests = self.arxiv.requests
+                slack_messages = self.slack.messages
+                backlog = len(slack_bot.outbound)
+        finally:
+            if engine is not None:
+                engine.stop()
+            slack_bot.outbound = None
+            slack_bot.event_queue = None
+            self.arxiv.stop()
+            self.slack.stop()
+            if tempdir is not None:
+                db.close()
+                tempdir.cleanup()
+
+        ms = [x * 1000 for x in latencies]
+        return dict(
+            config=self.config(),
+            webhook=dict(events=len(bodies),
+                         p50_ms=percentile(ms, 50),
+                         p99_ms=percentile(ms, 99),
+                         max_ms=max(ms, default=None)),
+            events_per_second=len(bodies) / events_elapsed if events_elapsed else None,
+            elapsed=elapsed,
+            arxiv=dict(requests=arxiv_requests,
+                       requests_per_second=arxiv_requests / elapsed),
+            slack=dict(messages=slack_messages,
+                       messages_per_second=slack_messages / elapsed,
+                       rate_limited=self.slack.rate_limited,
+                       outbox_backlog=backlog),
+            max_rss_bytes=max_rss())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark ow_scholar against local stand-ins for arXiv and Slack')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--subscriptions', type=int, default=5, help='Per channel')
+    parser.add_argument('--schedule', default='every minute')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run the searches for')
+    parser.add_argument('--arxiv-size', type=int, default=50)
+    parser.add_argument('--arxiv-latency', type=float, default=0.05)
+    parser.add_argument('--arxiv-rate', type=float,
+                        help='Requests per second to allow to arXiv. Default: no limit')
+    parser.add_argument('--slack-rate', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--digest', action='store_true')
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--fixture', help='Feed JSON file. Default: the packaged arxiv.json')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for the events to be handled')
+    parser.add_argument('--output', default='-', help='File to write results to. Default: stdout')
+    args = parser.parse_args(argv)
+
+    bench = Benchmark(channels=args.channels,
+                      subscriptions=args.subscriptions,
+                      schedule=args.schedule,
+                      duration=args.duration,
+                      arxiv_size=args.arxiv_size,
+                      arxiv_latency=args.arxiv_latency,
+                      arxiv_rate=args.arxiv_rate,
+                      slack_rate=args.slack_rate,
+                      concurrency=args.concurrency,
+                      digest=args.digest,
+                      max_workers=args.max_workers,
+                      fixture=args.fixture,
+                      timeout=args.timeout)
+    results = bench.run()
+    results['time'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import random
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from logging import getLogger
+from time import sleep
+
+L = getLogger(__name__)
+
+USER_AGENT = 'ow_scholar (https://github.com/openworm/openworm-scholar)'
+
+RETRY_STATUSES = (429, 503)
+""" Statuses which mean the server wants us to slow down and try again """
+
+MAX_RETRIES = 4
+
+BACKOFF_BASE = 2
+""" Seconds to wait before the first retry. Doubled for each retry after """
+
+
+class FetchResponse(object):
+    """ The parts of an HTTP response that queries need """
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def header(self, name, default=None):
+        """ Look up a header, ignoring case """
+        name = name.lower()
+        for k, v in self.headers.items():
+            if k.lower() == name:
+                return v
+        return default
+
+
+class FetchError(Exception):
+    def __init__(self, url, response):
+        super(FetchError, self).__init__(f'Got status {response.status} for {url}')
+        self.url = url
+        self.response = response
+
+
+response_cache = None
+""" A `.http_cache.ResponseCache` for `fetch` to go through, if set """
+
+rate_limiters = dict()
+""" A `.ratelimit.TokenBucket` for each search target's requests, by target name """
+
+
+def fetch(url, headers=None, timeout=30, target=None):
+    """
+    GET the given URL, through `response_cache` if there is one
+
+    Parameters
+    ----------
+    url : str
+    headers : dict, optional
+        Extra request headers. Requests with extra headers are not cached
+    timeout : float, optional
+        Seconds to wait for the server
+    target : str, optional
+        The name of the search target the request is for
+
+    Requests which go to the server wait for the target's rate limiter, and
+    are retried with exponential backoff when the server answers with one of
+    the `RETRY_STATUSES`
+
+    Returns
+    -------
+    FetchResponse
+        The response. Error statuses are returned rather than raised
+    """
+    def get(u, h):
+        return polite_get(u, h, timeout, rate_limiters.get(target))
+
+    cache = response_cache
+    if cache is not None and not headers:
+        return cache.fetch(url, get, target)
+    return get(url, headers)
+
+
+def polite_get(url, headers, timeout, limiter=None):
+    """
+    GET the URL once the limiter allows, retrying while the server says to
+    slow down
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.acquire()
+        resp = _get(url, headers, timeout)
+        if resp.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return resp
+        delay = retry_after(resp)
+        if delay is None:
+            delay = BACKOFF_BASE * 2 ** attempt
+            delay += random.uniform(0, delay / 2)
+        L.info('Got status %d for %s. Retrying in %.1f seconds', resp.status, url, delay)
+        if limiter is not None:
+            limiter.penalize(delay)
+        else:
+            sleep(delay)
+    return resp
+
+
+def retry_after(resp):
+    """ Seconds the response's ``Retry-After`` header says to wait, if it has one """
+    value = resp.header('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _get(url, headers, timeout):
+    req_headers = {'User-Agent': USER_AGENT}
+    if headers:
+        req_headers.update(headers)
+    L.debug('Fetching %s', url)
+    try:
+        with urlopen(Request(url, headers=req_headers), timeout=timeout) as resp:
+            return FetchResponse(resp.status, dict(resp.headers), resp.read())
+    except HTTPError as e:
+        return FetchResponse(e.code, dict(e.headers or {}), e.read())
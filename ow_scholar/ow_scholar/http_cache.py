@@ -0,0 +1,215 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from logging import getLogger
+from threading import RLock
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .fetching import FetchResponse
+
+L = getLogger(__name__)
+
+__all__ = ['ResponseCache', 'normalize_url']
+
+VALIDATORS = (('ETag', 'If-None-Match'),
+              ('Last-Modified', 'If-Modified-Since'))
+
+STORED_HEADERS = ('ETag', 'Last-Modified', 'Content-Type')
+
+
+def normalize_url(url):
+    """
+    Put a URL in a canonical form so that equivalent requests share a key:
+    the scheme and host are lower-cased and the query parameters are sorted
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/',
+                       query, ''))
+
+
+class ResponseCache(object):
+    """
+    A file-backed cache of successful GET responses
+
+    Each response is stored as a body file and a JSON metadata file named by
+    the hash of its normalized URL. A response is served without a request
+    for as long as the TTL of its target. After that, if the response had an
+    ``ETag`` or ``Last-Modified`` header, a conditional request is made and
+    a ``304 Not Modified`` answer renews the stored response. When the stored
+    bodies go over `max_bytes`, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, ttls=None,
+                 default_ttl=600, timefunc=time):
+        """
+        Parameters
+        ----------
+        directory : str
+            Where to store responses. Created if it doesn't exist
+        max_bytes : int
+            The most bytes of response bodies to keep
+        ttls : dict, optional
+            Seconds for which responses stay fresh, by search target name
+        default_ttl : float
+            Seconds for which responses for other targets stay fresh
+        timefunc : callable
+            Returns the current time in seconds
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.timefunc = timefunc
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self._lock = RLock()
+        self._lru = OrderedDict()
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        metas = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                try:
+                    metas.append((os.path.getmtime(path), name[:-len('.json')]))
+                except OSError:
+                    pass
+        for _, key in sorted(metas):
+            try:
+                size = os.path.getsize(self._body_path(key))
+            except OSError:
+                self._remove(key)
+                continue
+            self._lru[key] = size
+            self._size += size
+
+    def _body_path(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def key(self, url):
+        return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+    def ttl(self, target):
+        return self.ttls.get(target, self.default_ttl)
+
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    revalidated=self.revalidated,
+                    evictions=self.evictions,
+                    entries=len(self._lru),
+                    bytes=self._size)
+
+    def fetch(self, url, fetchfunc, target=None):
+        """
+        Returns the response for the URL, from the cache if possible
+
+        Parameters
+        ----------
+        url : str
+        fetchfunc : callable
+            Called with the URL and a dict of extra request headers to make
+            the request if it can't be answered from the cache
+        target : str, optional
+            The search target the request is for, which decides the TTL
+        """
+        key = self.key(url)
+        meta = self._read_meta(key)
+        now = self.timefunc()
+        if meta is not None and now - meta['stored_at'] < self.ttl(target):
+            body = self._read_body(key)
+            if body is not None:
+                with self._lock:
+                    self.hits += 1
+                    self._touch(key)
+                return FetchResponse(meta['status'], meta['headers'], body)
+
+        validators = dict()
+        if meta is not None:
+            for header, validator in VALIDATORS:
+                if meta['headers'].get(header):
+                    validators[validator] = meta['headers'][header]
+
+        resp = fetchfunc(url, validators)
+        if resp.status == 304 and meta is not None:
+            body = self._read_body(key)
+            if body is not None:
+                with self._lock:
+                    self.revalidated += 1
+                    meta['stored_at'] = now
+                    self._write(key, meta, None)
+                return FetchResponse(meta['status'], meta['headers'], body)
+            resp = fetchfunc(url, {})
+
+        with self._lock:
+            self.misses += 1
+            if resp.status == 200:
+                self._write(key, dict(url=url,
+                                      status=resp.status,
+                                      headers={k: resp.header(k) for k in STORED_HEADERS
+                                               if resp.header(k) is not None},
+                                      stored_at=now),
+                            resp.body)
+        return resp
+
+    def _read_meta(self, key):
+        try:
+            with open(self._meta_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _read_body(self, key):
+        try:
+            with open(self._body_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key, meta, body):
+        if body is not None:
+            if len(body) > self.max_bytes:
+                return
+            self._replace(self._body_path(key), body)
+            self._size += len(body) - self._lru.get(key, 0)
+            self._lru[key] = len(body)
+        self._replace(self._meta_path(key), json.dumps(meta).encode('utf-8'))
+        self._touch(key)
+        while self._size > self.max_bytes and self._lru:
+            oldest, _ = next(iter(self._lru.items()))
+            L.debug('Evicting cached response %s', oldest)
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _replace(self, path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _touch(self, key):
+        if key in self._lru:
+            self._lru.move_to_end(key)
+        try:
+            os.utime(self._meta_path(key))
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        self._size -= self._lru.pop(key, 0)
+        for path in (self._body_path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
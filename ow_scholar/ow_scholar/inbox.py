@@ -0,0 +1,228 @@
+import random
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from time import time
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+from ZODB.POSException import ConflictError
+
+from .models import appmaker
+from . import slack_bot
+from . import tracing
+
+L = getLogger(__name__)
+
+__all__ = ['SlackEventQueue', 'ProcessedEvents', 'PROCESSED_EVENTS_KEY']
+
+PROCESSED_EVENTS_KEY = 'slack_processed_events'
+
+EVENT_ID_TTL = 24 * 60 * 60
+""" Seconds to remember an event ID for. Slack stops retrying well before this """
+
+
+class ProcessedEvents(Persistent):
+    """ The IDs of Slack events which have been handled, with when they were """
+
+    def __init__(self):
+        self._times = OOBTree()
+        self._len = Length()
+
+    def __len__(self):
+        return self._len()
+
+    def __contains__(self, event_id):
+        return event_id in self._times
+
+    def add(self, event_id, now):
+        if event_id not in self._times:
+            self._len.change(1)
+        self._times[event_id] = now
+
+    def prune(self, before):
+        """ Forget events handled before the given time """
+        old = [k for k, t in self._times.items() if t < before]
+        for k in old:
+            del self._times[k]
+        self._len.change(-len(old))
+        return len(old)
+
+
+class SlackEventQueue(object):
+    """
+    Handles Slack events on the workers of a `.scheduling.SchedulerEngine`, so
+    that the web request can be answered right away
+
+    Slack sends an event again if it isn't answered within three seconds, and
+    may do so anyway. Events are only handled once per ``event_id``: recent IDs
+    are checked in memory when the event is queued and again against the
+    `ProcessedEvents` stored in the app root in the same transaction as the
+    event's changes. That transaction is tried again if it conflicts.
+
+    Once queued, the event has been answered, so Slack won't send it again. If
+    its transaction still conflicts after `attempts` tries, the event is
+    queued again after a random delay, up to `requeues` times, rather than
+    dropped. Sends of the event meanwhile are dropped as duplicates. An ID is
+    only remembered in memory once its transaction has committed, so if
+    handling fails for good, a later send of the event is handled.
+    """
+
+    def __init__(self, engine, post, token=None, timefunc=time, max_recent=1000,
+                 attempts=10, requeues=5, requeue_delay=1):
+        """
+        Parameters
+        ----------
+        engine : .scheduling.SchedulerEngine
+            Runs the handling and holds the processed event IDs
+        post : callable
+            Called like `send_message` to reply when there isn't an outbound
+            queue
+        token : str
+            The workspace's API token
+        timefunc : callable
+            Returns the current time in seconds
+        max_recent : int
+            How many event IDs to check in memory
+        attempts : int
+            How many times to try handling an event whose transaction conflicts
+            before queueing it again
+        requeues : int
+            How many times to queue again an event which still conflicts
+        requeue_delay : float
+            Seconds to wait, at most, before handling a queued again event for
+            the first time. Doubled each time it's queued again
+        """
+        self.engine = engine
+        self.post = post
+        self.token = token
+        self.timefunc = timefunc
+        self.max_recent = max_recent
+        self.attempts = attempts
+        self.requeues = requeues
+        self.requeue_delay = requeue_delay
+        self.duplicates = 0
+        """ How many events were dropped because they were already queued or handled """
+        self.handled = 0
+        """ How many events were handled """
+        self._recent = OrderedDict()
+        """ IDs of recently handled events """
+        self._in_flight = set()
+        """ IDs of events queued or being handled """
+        self._lock = Lock()
+        self._last_prune = None
+
+    def _is_recent(self, event_id):
+        with self._lock:
+            if event_id in self._recent or event_id in self._in_flight:
+                self.duplicates += 1
+                return True
+            self._in_flight.add(event_id)
+            return False
+
+    def _finished(self, event_id, handled):
+        with self._lock:
+            self._in_flight.discard(event_id)
+            if handled:
+                self._recent[event_id] = True
+                while len(self._recent) > self.max_recent:
+                    self._recent.popitem(last=False)
+
+    def prepare(self):
+        """
+        Make the stored `ProcessedEvents` if there isn't one yet, so that the
+        first events don't all write the app root to make it
+        """
+        for attempt in self.engine.attempts():
+            with attempt as conn:
+                root = appmaker(conn.root())
+                if PROCESSED_EVENTS_KEY not in root:
+                    root[PROCESSED_EVENTS_KEY] = ProcessedEvents()
+
+    def put(self, body, potential_targets, digest=False):
+        """
+        Queue an event callback body from Slack to be handled
+
+        Returns
+        -------
+        bool
+            Whether the event was queued, as opposed to being dropped as a
+            duplicate
+        """
+        event_id = body.get('event_id')
+        if event_id is not None and self._is_recent(event_id):
+            L.info('Dropping duplicate Slack event %s', event_id)
+            return False
+        evt = body['event']
+        self.engine.submit(tracing.bind(self.handle, 'slack_event.handle'),
+                           (event_id, evt, potential_targets, digest),
+                           key=('slack_channel', evt.get('channel')))
+        return True
+
+    def handle(self, event_id, evt, potential_targets, digest=False, requeued=0):
+        try:
+            reply = self._commit_event(event_id, evt, potential_targets, digest)
+        except ConflictError:
+            if requeued < self.requeues:
+                delay = random.uniform(0, self.requeue_delay * 2 ** requeued)
+                L.warning('Handling Slack event %s still conflicts. Trying again in %.1f seconds',
+                          event_id, delay)
+                self.engine.enter(delay, 0, tracing.bind(self.handle, 'slack_event.handle'),
+                                  (event_id, evt, potential_targets, digest, requeued + 1),
+                                  key=('slack_channel', evt.get('channel')))
+                return
+            L.error('Dropping Slack event %s, which conflicted %d times', event_id,
+                    (requeued + 1) * self.attempts)
+            if event_id is not None:
+                self._finished(event_id, False)
+            raise
+        except Exception:
+            if event_id is not None:
+                self._finished(event_id, False)
+            raise
+        if event_id is not None:
+            self._finished(event_id, True)
+        if reply is None:
+            self.duplicates += 1
+            L.info('Dropping already handled Slack event %s', event_id)
+            return
+        self.handled += 1
+
+        # Any searches for a channel we haven't seen before are in a new
+        # scheduler
+        self.engine.load_schedulers()
+        if slack_bot.outbound is not None:
+            slack_bot.outbound.put(evt['channel'], [reply])
+        else:
+            self.post(self.token, evt['channel'], reply)
+
+    def _commit_event(self, event_id, evt, potential_targets, digest):
+        """
+        Make the event's changes and record its ID as processed, in one
+        transaction, tried up to `attempts` times
+
+        Returns
+        -------
+        str or None
+            The reply to post, or `None` if the event was already handled
+        """
+        now = self.timefunc()
+        prune = self._last_prune is None or now - self._last_prune > EVENT_ID_TTL / 24
+        for attempt in self.engine.attempts(self.attempts):
+            with attempt as conn:
+                root = appmaker(conn.root())
+                if PROCESSED_EVENTS_KEY not in root:
+                    root[PROCESSED_EVENTS_KEY] = ProcessedEvents()
+                processed = root[PROCESSED_EVENTS_KEY]
+                reply = None
+                if event_id is None or event_id not in processed:
+                    if event_id is not None:
+                        processed.add(event_id, now)
+                    if prune:
+                        processed.prune(now - EVENT_ID_TTL)
+                    reply = slack_bot.handle_message_event(root, evt, potential_targets,
+                                                           digest)
+        if prune and reply is not None:
+            self._last_prune = now
+        return reply
@@ -0,0 +1,265 @@
+"""
+Split the stored schedulers between worker processes with leases kept in ZODB
+
+Each worker holds a lease on the key, in ``root[SCHEDULER_KEY]``, of every
+scheduler it runs. Leases are renewed well before they run out. A worker
+which dies stops renewing them, and once they've run out the other workers
+take them over. Each worker takes about an even share of the keys: its
+share is the number of keys over the number of workers which have checked
+in recently.
+
+A worker only fires a search while its lease has more than `grace` seconds
+left, and leases are only taken over once they've run out, so as long as
+the workers' clocks agree to within `grace` seconds, each run fires on one
+worker. Two workers trying to take the same lease both write the same
+BTree entry, so one of them gets a ``ConflictError`` and tries again later.
+"""
+import math
+import os
+import random
+import socket
+import zlib
+from logging import getLogger
+from threading import Condition, Thread
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
+
+from .models import appmaker
+from .slack_bot import SCHEDULER_KEY
+
+L = getLogger(__name__)
+
+__all__ = ['LeaseTable', 'LeaseKeeper', 'LEASES_KEY', 'default_worker_id']
+
+LEASES_KEY = 'scheduler_leases'
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseTable(Persistent):
+    """
+    Who holds the lease on each scheduler key and until when, and when each
+    worker last checked in
+
+    Times are in seconds since the epoch. Entries are tuples so that the
+    BTrees can resolve concurrent changes to different keys.
+    """
+
+    def __init__(self):
+        self._leases = OOBTree()
+        """ key -> (worker, expiry time) """
+        self._workers = OOBTree()
+        """ worker -> time its check-in runs out """
+
+    def holder(self, key, now):
+        """ The worker holding the lease on ``key`` at ``now``, if any """
+        lease = self._leases.get(key)
+        if lease is None or lease[1] <= now:
+            return None
+        return lease[0]
+
+    def claim(self, key, worker, now, duration):
+        """
+        Take or renew the lease on ``key`` for ``duration`` seconds, unless
+        another worker holds it
+
+        Returns
+        -------
+        bool
+            Whether ``worker`` now holds the lease
+        """
+        holder = self.holder(key, now)
+        if holder is not None and holder != worker:
+            return False
+        self._leases[key] = (worker, now + duration)
+        return True
+
+    def release(self, key, worker):
+        """ Give up the lease on ``key``, if ``worker`` holds it """
+        lease = self._leases.get(key)
+        if lease is not None and lease[0] == worker:
+            del self._leases[key]
+
+    def check_in(self, worker, now, duration):
+        self._workers[worker] = now + duration
+
+    def leave(self, worker):
+        self._workers.pop(worker, None)
+
+    def live_workers(self, now):
+        """ The workers which have checked in and not run out """
+        return [w for w, until in self._workers.items() if until > now]
+
+    def prune(self, now):
+        """
+        Forget workers which ran out before ``now``. Leases which ran out are
+        left for `claim` to overwrite, since every worker would otherwise try
+        to delete the same ones at once
+        """
+        for w in [w for w, until in self._workers.items() if until <= now]:
+            del self._workers[w]
+
+
+class LeaseKeeper(object):
+    """
+    Keeps one worker's share of the scheduler leases, for a
+    `.scheduling.SchedulerEngine` to decide which stored schedulers to run
+
+    Every `renew_interval` seconds, the keeper checks in, renews the leases it
+    holds, takes free ones up to its share and lets leases beyond its share
+    run out for other workers to take. The engine is told to reload its
+    schedulers whenever the keys held change.
+    """
+
+    def __init__(self, engine, worker=None, duration=30, renew_interval=None, grace=5):
+        """
+        Parameters
+        ----------
+        engine : .scheduling.SchedulerEngine
+            Its connection holds the leases, at ``LEASES_KEY`` in the app root
+        worker : str, optional
+            Names this worker. By default, the host name and process ID
+        duration : float
+            Seconds each lease lasts from when it's taken or renewed
+        renew_interval : float, optional
+            Seconds between renewals. By default, a third of `duration`
+        grace : float
+            Searches aren't fired with less than this many seconds left on the
+            lease. Must be more than the difference between workers' clocks
+        """
+        if renew_interval is None:
+            renew_interval = duration / 3
+        if grace + renew_interval >= duration:
+            raise ValueError('Leases would run out before they were renewed')
+        self.engine = engine
+        self.worker = worker or default_worker_id()
+        self.duration = duration
+        self.renew_interval = renew_interval
+        self.grace = grace
+        self.held = dict()
+        """ Expiry time of each lease held, by key """
+        self.should_run = False
+        self.thread = None
+        self._cond = Condition()
+        self._woken = False
+
+    def __len__(self):
+        return len(self.held)
+
+    def owns(self, key):
+        """ Whether this worker holds the lease on ``key`` with time to spare """
+        until = self.held.get(key)
+        return until is not None and self.engine.timefunc() + self.grace < until
+
+    def _table(self, conn):
+        root = appmaker(conn.root())
+        if LEASES_KEY not in root:
+            root[LEASES_KEY] = LeaseTable()
+        return root[LEASES_KEY]
+
+    def step(self):
+        """
+        Check in, renew and take leases, once
+
+        Returns
+        -------
+        bool
+            Whether the keys held changed
+        """
+        now = self.engine.timefunc()
+        with self.engine.transaction() as conn:
+            table = self._table(conn)
+            table.prune(now)
+            table.check_in(self.worker, now, self.duration)
+            keys = list(appmaker(conn.root()).get(SCHEDULER_KEY, dict()).keys())
+            workers = max(1, len(table.live_workers(now)))
+            share = math.ceil(len(keys) / workers)
+            mine = [k for k in keys if table.holder(k, now) == self.worker]
+            # Leases over our share aren't renewed, so they run out and go to
+            # a worker which joined since we took them
+            keep = sorted(mine, key=self._rank)[:share]
+            free = sorted((k for k in keys if table.holder(k, now) is None), key=self._rank)
+            take = free[:max(0, share - len(keep))]
+            held = dict()
+            for k in keep + take:
+                if table.claim(k, self.worker, now, self.duration):
+                    held[k] = now + self.duration
+        changed = held.keys() != self.held.keys()
+        self.held = held
+        if changed:
+            L.info('%s holds leases on %d of %d schedulers', self.worker, len(held), len(keys))
+        return changed
+
+    def _rank(self, key):
+        # Each worker prefers a different order of keys, so that workers
+        # starting together mostly try to take different ones
+        return zlib.crc32(repr((self.worker, key)).encode('utf-8'))
+
+    def wake(self):
+        """ Renew and take leases now rather than at the next interval """
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def start(self):
+        """
+        Take a first share of leases and keep renewing them. The engine loads
+        its schedulers after its services are started, so it isn't told to
+        """
+        self.should_run = True
+        wait = self._renew(load=False)
+
+        def runner(wait):
+            while self.should_run:
+                with self._cond:
+                    if not self._woken and self.should_run:
+                        self._cond.wait(wait)
+                    self._woken = False
+                if self.should_run:
+                    wait = self._renew()
+        self.thread = Thread(target=runner, args=(wait,), name='ow_scholar-leases', daemon=True)
+        self.thread.start()
+
+    def _renew(self, load=True):
+        """ Run a `step`, returning the seconds to wait before the next one """
+        try:
+            changed = self.step()
+        except ConflictError:
+            # Another worker changed the same leases. Try again soon, before
+            # ours run out, at a random time so as not to collide again
+            L.info('Conflict renewing leases for %s. Retrying', self.worker)
+            return random.uniform(0, min(1, self.renew_interval))
+        except Exception:
+            L.error('Got an exception while renewing leases', exc_info=True)
+            return self.renew_interval
+        if changed and load and self.engine.should_run:
+            try:
+                self.engine.submit(self.engine.load_schedulers)
+            except RuntimeError:
+                # The engine's workers were shut down while we were renewing
+                pass
+        return self.renew_interval
+
+    def stop(self):
+        """
+        Stop renewing and give up the leases held, so that other workers can
+        take them over right away. The engine's workers should be stopped first
+        """
+        self.should_run = False
+        self.wake()
+        if self.thread:
+            self.thread.join()
+        held, self.held = self.held, dict()
+        try:
+            with self.engine.transaction() as conn:
+                table = self._table(conn)
+                for k in held:
+                    table.release(k, self.worker)
+                table.leave(self.worker)
+        except Exception:
+            L.warning('Failed to give up leases for %s. They will run out in %s seconds',
+                      self.worker, self.duration, exc_info=True)
@@ -0,0 +1,324 @@
+"""
+Runtime metrics, served in the Prometheus text format on ``/metrics``
+
+Counters and histograms are updated where the work happens. Numbers which
+objects already keep, like cache hits and queue lengths, are read by
+collectors when the metrics are scraped, so they cost nothing in between.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+from pyramid.response import Response
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry', 'metrics_view',
+           'watch_engine', 'count_retry']
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+""" Upper bounds, in seconds, for timing histograms """
+
+LAG_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+""" Upper bounds, in seconds, for how late scheduled runs start """
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._values = dict()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(self.name, self.labelnames))
+        return tuple(labels[n] for n in self.labelnames)
+
+    def samples(self):
+        """ Yields (suffix, label names, label values, value) for each sample """
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            yield '', self.labelnames, key, value
+
+
+class Counter(Metric):
+    """ A count which only goes up """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """ A value which may go up or down """
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    """ Counts of observations falling under each of the `buckets` """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the seconds taken by the body of a ``with`` statement """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        names = self.labelnames + ('le',)
+        for key, counts in sorted(items):
+            total = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                total += n
+                yield '_bucket', names, key + (_format_value(float(bound)),), total
+            yield '_sum', self.labelnames, key, counts[-1]
+            yield '_count', self.labelnames, key, total
+
+
+class Registry(object):
+    """
+    The metrics to serve, plus collectors: functions called at each scrape
+    which yield ``(name, type, documentation, samples)``, where ``samples`` is
+    a list of (labels dict, value)
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        with self._lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            self.collectors.remove(collector)
+
+    def render(self):
+        """ All of the metrics in the Prometheus text format """
+        lines = []
+        with self._lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for m in metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.documentation))
+            lines.append('# TYPE {} {}'.format(m.name, m.type))
+            for suffix, names, values, value in m.samples():
+                lines.append('{}{}{} {}'.format(m.name, suffix, _format_labels(names, values),
+                                                _format_value(value)))
+        for collector in collectors:
+            for name, typ, documentation, samples in collector():
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, typ))
+                for labels, value in samples:
+                    names = tuple(sorted(labels))
+                    lines.append('{}{} {}'.format(name,
+                                                  _format_labels(names, [labels[n] for n in names]),
+                                                  _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+""" The metrics served by `metrics_view` """
+
+QUERY_SECONDS = registry.histogram(
+    'ow_scholar_query_seconds',
+    'Time taken by queries sent to their search target', ['target'])
+
+QUERY_ERRORS = registry.counter(
+    'ow_scholar_query_errors_total',
+    'Queries which failed', ['target'])
+
+SEARCH_RUNS = registry.counter(
+    'ow_scholar_search_runs_total',
+    'Scheduled searches run, including ones answered without going to the target',
+    ['target'])
+
+SCHEDULER_LAG = registry.histogram(
+    'ow_scholar_scheduler_lag_seconds',
+    'How long after their planned time scheduled searches started', (), LAG_BUCKETS)
+
+HANDLER_SECONDS = registry.histogram(
+    'ow_scholar_handler_seconds',
+    'Time taken by event handlers for the results of one search', ['handler'])
+
+EVENTS_DELIVERED = registry.counter(
+    'ow_scholar_events_delivered_total',
+    'Events delivered by event handlers', ['handler'])
+
+SLACK_POST_SECONDS = registry.histogram(
+    'ow_scholar_slack_post_seconds',
+    'Time taken by calls to post Slack messages')
+
+SLACK_POST_ERRORS = registry.counter(
+    'ow_scholar_slack_post_errors_total',
+    'Calls to post Slack messages which failed, including rate limiting')
+
+CONFLICTS = registry.counter(
+    'ow_scholar_conflicts_total',
+    'Transactions which failed with a ZODB conflict', ['source'])
+
+RETRIES = registry.counter(
+    'ow_scholar_request_retries_total',
+    'Web requests retried, usually after a ZODB conflict')
+
+
+def count_retry(event):
+    """ Subscriber for ``pyramid_retry.IBeforeRetry`` """
+    RETRIES.inc()
+
+
+_engine_collector = None
+
+
+def watch_engine(engine, sender=None, event_queue=None):
+    """
+    Collect queue depths, cache hit counts and the number of schedules from a
+    running `.scheduling.SchedulerEngine` and the services around it, in place
+    of any engine watched before
+
+    Returns
+    -------
+    callable
+        The collector added to the `registry`
+    """
+    global _engine_collector
+    from . import fetching
+    from .rendering import render_cache
+
+    def collect():
+        yield ('ow_scholar_timer_queue_depth', 'gauge',
+               'Scheduled runs waiting for their time',
+               [({}, len(engine.queue.queue))])
+        yield ('ow_scholar_ready_queue_depth', 'gauge',
+               'Due runs and events waiting for a worker',
+               [({}, len(engine.ready))])
+        yield ('ow_scholar_active_schedules', 'gauge',
+               'Search schedules on the running schedulers',
+               [({}, engine.active_schedules)])
+        yield ('ow_scholar_schedulers', 'gauge',
+               'Running schedulers, one per channel',
+               [({}, len(engine.schedulers))])
+        yield ('ow_scholar_catch_up_backlog', 'gauge',
+               'Catch-up runs, for runs missed during a restart, waiting to be released',
+               [({}, len(engine.backlog))])
+        if engine.leases is not None:
+            yield ('ow_scholar_scheduler_leases', 'gauge',
+                   'Scheduler leases held by this worker',
+                   [({}, len(engine.leases))])
+        yield ('ow_scholar_coalesced_fetches', 'gauge',
+               'Fetches being shared with other subscriptions to the same query',
+               [({}, len(engine.coalescer))])
+        if sender is not None:
+            yield ('ow_scholar_outbox_depth', 'gauge',
+                   'Slack messages waiting to be posted',
+                   [({}, len(sender))])
+            yield ('ow_scholar_slack_rate_limited_total', 'counter',
+                   'Times Slack answered with 429',
+                   [({}, sender.rate_limited)])
+        if event_queue is not None:
+            yield ('ow_scholar_slack_events_total', 'counter',
+                   'Slack events handled, or dropped as duplicates',
+                   [({'result': 'handled'}, event_queue.handled),
+                    ({'result': 'duplicate'}, event_queue.duplicates)])
+        caches = [({'cache': 'render', 'result': 'hit'}, render_cache.hits),
+                  ({'cache': 'render', 'result': 'miss'}, render_cache.misses)]
+        if fetching.response_cache is not None:
+            rc = fetching.response_cache
+            caches += [({'cache': 'http', 'result': 'hit'}, rc.hits),
+                       ({'cache': 'http', 'result': 'miss'}, rc.misses),
+                       ({'cache': 'http', 'result': 'revalidated'}, rc.revalidated)]
+        if engine.percolator is not None:
+            caches.append(({'cache': 'percolator', 'result': 'hit'}, engine.percolator.hits))
+        yield ('ow_scholar_cache_requests_total', 'counter',
+               'Lookups in each cache, by whether they were answered from it',
+               caches)
+
+    if _engine_collector is not None:
+        registry.remove_collector(_engine_collector)
+    registry.add_collector(collect)
+    _engine_collector = collect
+    return collect
+
+
+def metrics_view(request):
+    return Response(registry.render(), content_type=CONTENT_TYPE, charset='utf-8')
@@ -0,0 +1,365 @@
+from collections import deque
+from logging import getLogger
+from threading import Condition, Thread
+from time import monotonic, time
+from uuid import uuid4
+
+from persistent import Persistent
+from persistent.list import PersistentList
+from BTrees.OOBTree import OOBTree
+from slack.errors import SlackApiError
+
+from .models import appmaker
+from .leases import default_worker_id
+from .ratelimit import TokenBucket
+from . import tracing
+
+L = getLogger(__name__)
+
+__all__ = ['Outbox', 'OutboundMessage', 'SlackSender', 'OUTBOX_KEY', 'LEASE_SECONDS']
+
+OUTBOX_KEY = 'slack_outbox'
+
+CHANNEL_RATE = 1
+""" Messages per second Slack allows to one channel """
+
+WORKSPACE_RATE = 5
+""" Messages per second to allow across all channels in a workspace """
+
+WORKSPACE_BURST = 20
+
+MAX_ATTEMPTS = 8
+""" Attempts to post a message after errors, other than rate limiting, before giving up """
+
+LEASE_SECONDS = 60
+""" How long a sender's claim on a message lasts without being renewed """
+
+
+class OutboundMessage(Persistent):
+    """
+    One or more texts to post to a channel. Texts after the first are posted
+    in the first one's thread, unless `thread` is given, in which case they all
+    go to that thread
+    """
+
+    def __init__(self, channel, texts, thread=None):
+        self.channel = channel
+        self.texts = PersistentList(texts)
+        self.thread = thread
+        self.sent = 0
+        """ How many of the texts have been posted """
+        self.attempts = 0
+        self.lease = None
+        """ (worker, expiry time) of the sender which is to post it """
+
+    @property
+    def done(self):
+        return self.sent >= len(self.texts)
+
+
+class Outbox(Persistent):
+    """
+    Messages waiting to be posted, in the order they were queued
+
+    Messages are keyed by the time they were queued and a random string, so
+    that processes queueing messages at once write different keys, which the
+    BTree can resolve
+    """
+
+    def __init__(self):
+        self._messages = OOBTree()
+
+    def put(self, message, now=None):
+        key = (time() if now is None else now, uuid4().hex)
+        self._messages[key] = message
+        return key
+
+    def get(self, key):
+        return self._messages.get(key)
+
+    def remove(self, key):
+        self._messages.pop(key, None)
+
+    def items(self):
+        return self._messages.items()
+
+
+class SlackSender(object):
+    """
+    Posts the messages in an `Outbox` as fast as Slack allows
+
+    Each channel gets a `TokenBucket` for Slack's limit of about one message
+    per second, and the workspace as a whole gets another. When Slack answers
+    with 429, the channel is held off for the ``Retry-After`` time and the
+    message is tried again. Messages are only removed from the outbox once
+    they're posted, so ones which were queued but not posted before a restart
+    are posted after it, possibly twice if the process stopped in between.
+
+    Every process shares the outbox, so each message is leased to the sender
+    which queued it, and only that sender posts it. Senders renew the leases
+    on their messages, and take over ones whose leases ran out, every third of
+    `lease_seconds`. Messages of a process which stopped are then posted by
+    another one.
+    """
+
+    def __init__(self, engine, post, token=None, timefunc=monotonic, worker=None,
+                 lease_seconds=LEASE_SECONDS, clock=time):
+        """
+        Parameters
+        ----------
+        engine : .scheduling.SchedulerEngine
+            Its connection holds the outbox, at ``OUTBOX_KEY`` in the app root
+        post : callable
+            Called like `send_message` to post a message
+        token : str
+            The workspace's API token
+        timefunc : callable
+            Returns the current time in seconds
+        worker : str, optional
+            Names this sender in message leases. By default, the host name and
+            process ID
+        lease_seconds : float
+            Seconds each message's lease lasts from when it's taken or renewed
+        clock : callable
+            Returns the time since the epoch, for leases, which are compared
+            between processes
+        """
+        self.engine = engine
+        self.post = post
+        self.token = token
+        self.timefunc = timefunc
+        self.worker = worker or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self._next_load = None
+        self.workspace_bucket = TokenBucket(WORKSPACE_RATE, WORKSPACE_BURST, timefunc)
+        self.channel_buckets = dict()
+        self.outbox = None
+        self.should_run = False
+        self.thread = None
+        self.rate_limited = 0
+        """ How many times Slack has answered with 429 """
+        self._pending = dict()
+        """ Keys of queued messages, by channel """
+        self._queued = set()
+        self._ring = deque()
+        self._cond = Condition()
+        self._traces = dict()
+        """ The trace each message was queued in, by key. See `.tracing.current` """
+
+    def __len__(self):
+        return sum(len(q) for q in self._pending.values())
+
+    def load(self):
+        """
+        Renew the leases on this sender's messages and take the messages
+        whose leases ran out, queueing the ones taken
+        """
+        now = self.clock()
+        for attempt in self.engine.attempts():
+            with attempt as conn:
+                root = appmaker(conn.root())
+                if OUTBOX_KEY not in root:
+                    root[OUTBOX_KEY] = Outbox()
+                self.outbox = root[OUTBOX_KEY]
+                claimed = [(key, msg.channel) for key, msg in self.outbox.items()
+                           if self._claim(msg, now)]
+        with self._cond:
+            taken = [(key, channel) for key, channel in claimed if key not in self._queued]
+            for key, channel in taken:
+                self._enqueue(channel, key)
+            self._next_load = now + self.lease_seconds / 3
+        if taken:
+            L.info('Loaded %d queued Slack messages', len(taken))
+
+    def _claim(self, msg, now):
+        """ Take or renew the lease on the message, unless another sender holds it """
+        if msg.lease is not None and msg.lease[0] != self.worker and msg.lease[1] > now:
+            return False
+        msg.lease = (self.worker, now + self.lease_seconds)
+        return True
+
+    def _enqueue(self, channel, key):
+        q = self._pending.get(channel)
+        if q is None:
+            q = self._pending[channel] = deque()
+            self._ring.append(channel)
+        q.append(key)
+        self._queued.add(key)
+
+    def put(self, channel, texts, thread=None):
+        """ Queue texts to be posted to the channel. See `OutboundMessage` """
+        for attempt in self.engine.attempts():
+            with attempt:
+                # A message added by an aborted attempt is left unusable
+                msg = OutboundMessage(channel, texts, thread)
+                now = self.clock()
+                self._claim(msg, now)
+                key = self.engine.local(self.outbox).put(msg, now)
+        context = tracing.current()
+        with self._cond:
+            if context is not None:
+                self._traces[key] = context
+            self._enqueue(channel, key)
+            self._cond.notify()
+        return key
+
+    def channel_bucket(self, channel):
+        bucket = self.channel_buckets.get(channel)
+        if bucket is None:
+            bucket = self.channel_buckets[channel] = TokenBucket(CHANNEL_RATE, 1, self.timefunc)
+        return bucket
+
+    def _next_channel(self):
+        """
+        Returns the next channel, in turn, which may be posted to now, or the
+        seconds until one may be
+        """
+        wait = self.workspace_bucket.delay()
+        if wait > 0:
+            return None, wait
+        for _ in range(len(self._ring)):
+            channel = self._ring[0]
+            self._ring.rotate(-1)
+            delay = self.channel_bucket(channel).delay()
+            if delay <= 0:
+                return channel, 0
+            wait = delay if wait <= 0 else min(wait, delay)
+        return None, wait
+
+    def step(self):
+        """
+        Post one message, if any may be posted now
+
+        Returns
+        -------
+        float or None
+            Seconds until another message may be posted, or `None` if there
+            are no more messages
+        """
+        with self._cond:
+            if not self._ring:
+                return None
+            channel, wait = self._next_channel()
+            if channel is None:
+                return wait
+            key = self._pending[channel][0]
+        self.workspace_bucket.acquire()
+        self.channel_bucket(channel).acquire()
+
+        with self.engine.transaction():
+            outbox = self.engine.local(self.outbox)
+            msg = outbox.get(key)
+            # Another sender took the message over if our lease ran out
+            lost = msg is not None and (msg.lease or (None,))[0] != self.worker
+            if msg is not None and not msg.done and not lost:
+                args = (msg.channel, msg.texts[msg.sent], msg.thread)
+            else:
+                args = None
+        # Post outside of the transaction so that it isn't held open, and
+        # likely to conflict, while waiting on Slack
+        with self._cond:
+            context = self._traces.get(key)
+        with tracing.resume(context, 'slack.post', channel=channel):
+            result = self._post(*args) if args else None
+        for attempt in self.engine.attempts():
+            with attempt:
+                if result is not None:
+                    self._record(msg, result)
+                finished = msg is None or msg.done or lost
+                if finished and not lost:
+                    outbox.remove(key)
+        if finished:
+            with self._cond:
+                self._traces.pop(key, None)
+                self._queued.discard(key)
+                q = self._pending[channel]
+                q.popleft()
+                if not q:
+                    del self._pending[channel]
+                    self._ring.remove(channel)
+        return 0
+
+    def _post(self, channel, text, thread):
+        """
+        Returns
+        -------
+        The Slack response if the text was posted, `None` if Slack asked us to
+        slow down, or the exception if posting failed
+        """
+        try:
+            return self.post(self.token, channel, text, thread) or dict()
+        except SlackApiError as e:
+            if e.response.status_code == 429:
+                self.rate_limited += 1
+                retry = float(e.response.headers.get('Retry-After', 1))
+                L.info('Rate limited posting to %s. Retrying in %s seconds', channel, retry)
+                self.channel_bucket(channel).penalize(retry)
+                return None
+            return e
+        except Exception as e:
+            return e
+
+    def _record(self, msg, result):
+        if isinstance(result, Exception):
+            msg.attempts += 1
+            if msg.attempts >= MAX_ATTEMPTS:
+                L.error('Giving up on posting to %s', msg.channel, exc_info=result)
+                msg.sent = len(msg.texts)
+            else:
+                L.warning('Failed to post to %s: %s', msg.channel, result)
+                self.channel_bucket(msg.channel).penalize(2 ** msg.attempts)
+            return
+        if msg.thread is None:
+            msg.thread = result.get('ts')
+        msg.sent += 1
+        msg.attempts = 0
+
+    def start(self):
+        if self.outbox is None:
+            self.load()
+        self.should_run = True
+
+        def runner():
+            while self.should_run:
+                try:
+                    if self.clock() >= self._next_load:
+                        self.load()
+                    wait = self.step()
+                except Exception:
+                    L.error('Got an exception while sending Slack messages', exc_info=True)
+                    wait = 1
+                if wait != 0:
+                    # Wake up to renew leases even with nothing to post
+                    until_load = max(0, self._next_load - self.clock())
+                    wait = until_load if wait is None else min(wait, until_load)
+                    with self._cond:
+                        if self.should_run:
+                            self._cond.wait(wait)
+        self.thread = Thread(target=runner, name='ow_scholar-slack-sender', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.should_run = False
+        with self._cond:
+            self._cond.notify_all()
+        if self.thread:
+            self.thread.join()
+        self._release()
+
+    def _release(self):
+        """ Give up the leases on queued messages so another sender can post them now """
+        with self._cond:
+            keys = list(self._queued)
+        if not keys or self.outbox is None:
+            return
+        try:
+            with self.engine.transaction():
+                outbox = self.engine.local(self.outbox)
+                for key in keys:
+                    msg = outbox.get(key)
+                    if msg is not None and msg.lease and msg.lease[0] == self.worker:
+                        msg.lease = None
+        except Exception:
+            L.warning('Failed to give up leases on Slack messages. They will run out in %s '
+                      'seconds', self.lease_seconds, exc_info=True)
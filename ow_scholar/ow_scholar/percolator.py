@@ -0,0 +1,556 @@
+import re
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Condition, Lock, RLock, Thread
+from time import time
+
+from .atom import parse_arxiv_feed
+from .slack_bot import ArxivQuery, ArxivQueryResponse, parse_atom_date
+
+L = getLogger(__name__)
+
+__all__ = ['parse_query', 'EntryIndex', 'ArxivPercolator', 'QuerySyntaxError',
+           'detect_keywords', 'tokenize']
+
+FIELDS = ('ti', 'au', 'abs', 'co', 'cat', 'id', 'kw')
+"""
+The fields of the arXiv query language which are indexed, plus ``kw`` for
+keyword lists found by `detect_keywords`. ``all`` searches all of them
+"""
+
+OPERATORS = ('AND', 'OR', 'ANDNOT')
+
+TOKEN_RGX = re.compile(r'[^\W_]+')
+
+KEYWORDS_RGX = re.compile(r'(?:^|\n|\.\s)\s*(?:key\s*-?\s*words?|index\s+terms)\s*[:\u2014-]\s*'
+                          r'(?P<keywords>[^\n]+(?:\n(?!\s*\n)[^\n]+)*)',
+                          re.IGNORECASE)
+
+QUERY_TOKEN_RGX = re.compile(r'\s*(?:(?P<paren>[()])|'
+                             r'(?:(?P<field>\w+):)?(?:"(?P<phrase>[^"]*)"|(?P<word>[^\s()"]+)))')
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    """ Split text into lower-cased words for indexing and matching """
+    return TOKEN_RGX.findall(text.casefold())
+
+
+def detect_keywords(text):
+    """
+    Returns the keywords from a "Keywords: ..." list in an abstract or comment,
+    split on commas and semicolons, or an empty list if there isn't one
+    """
+    if not text:
+        return []
+    md = KEYWORDS_RGX.search(text)
+    if md is None:
+        return []
+    listed = ' '.join(md.group('keywords').split()).rstrip('.')
+    return [k.strip() for k in re.split(r'[,;\u00b7]', listed) if k.strip()]
+
+
+class Node(ABC):
+    @abstractmethod
+    def key(self):
+        """ Equal for nodes which match the same documents """
+
+    @abstractmethod
+    def _evaluate(self, index, memo):
+        """ Returns the set of document numbers in the index which match, without `memo` """
+
+    def evaluate(self, index, memo):
+        """
+        Returns the set of document numbers in the index which match
+
+        ``memo`` holds the results of nodes already evaluated, by `key`, so
+        that parts shared between queries are only evaluated once
+        """
+        k = self.key()
+        res = memo.get(k)
+        if res is None:
+            res = memo[k] = self._evaluate(index, memo)
+        return res
+
+
+class Term(Node):
+    def __init__(self, field, words, prefix=False):
+        """
+        Parameters
+        ----------
+        field : str
+            One of `FIELDS`, or ``all``
+        words : list of str
+            Matched as a phrase if there is more than one
+        prefix : bool
+            If true, the last word matches any word starting with it
+        """
+        self.field = field
+        self.words = tuple(words)
+        self.prefix = prefix
+
+    def key(self):
+        return ('term', self.field, self.words, self.prefix)
+
+    def _evaluate(self, index, memo):
+        fields = FIELDS if self.field == 'all' else (self.field,)
+        res = set()
+        for f in fields:
+            res |= index.phrase(f, self.words, self.prefix)
+        return res
+
+
+class And(Node):
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def key(self):
+        return ('and',) + tuple(sorted(c.key() for c in self.children))
+
+    def _evaluate(self, index, memo):
+        res = None
+        for c in sorted(self.children, key=lambda c: len(c.evaluate(index, memo))):
+            res = set(c.evaluate(index, memo)) if res is None else res & c.evaluate(index, memo)
+            if not res:
+                break
+        return res or set()
+
+
+class Or(Node):
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def key(self):
+        return ('or',) + tuple(sorted(c.key() for c in self.children))
+
+    def _evaluate(self, index, memo):
+        res = set()
+        for c in self.children:
+            res |= c.evaluate(index, memo)
+        return res
+
+
+class AndNot(Node):
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def key(self):
+        return ('andnot', self.left.key(), self.right.key())
+
+    def _evaluate(self, index, memo):
+        left = self.left.evaluate(index, memo)
+        if not left:
+            return left
+        return left - self.right.evaluate(index, memo)
+
+
+def parse_query(s):
+    """
+    Compile a query in the arXiv API's ``search_query`` syntax into a tree of
+    `Node` objects
+
+    Terms may have a field prefix, like ``ti:worm`` or ``au:"de Bono"``, and
+    are combined with ``AND``, ``OR`` and ``ANDNOT`` and grouped with
+    parentheses. ``AND`` and ``ANDNOT`` bind more tightly than ``OR``. Terms
+    with no operator between them must all match, and a term with no field
+    searches all of them. A trailing ``*`` matches any word starting with the
+    rest of the term.
+
+    Returns
+    -------
+    Node
+        The tree, or `None` if the query has no terms
+
+    Raises
+    ------
+    QuerySyntaxError
+        If the parentheses don't match, an operator is missing an operand or
+        a field isn't known
+    """
+    tokens = []
+    pos = 0
+    s = s.strip()
+    while pos < len(s):
+        md = QUERY_TOKEN_RGX.match(s, pos)
+        if md is None or md.end() == pos:
+            raise QuerySyntaxError(f'Unexpected text at {pos} in {s!r}')
+        pos = md.end()
+        tokens.append(md)
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def is_op(md, *ops):
+        return (md is not None and md.group('word') in ops and
+                md.group('field') is None)
+
+    def parse_or():
+        children = [parse_and()]
+        while is_op(peek(), 'OR'):
+            tokens.pop(0)
+            children.append(parse_and())
+        return combine(Or, children)
+
+    def parse_and():
+        children = [parse_unary()]
+        while True:
+            md = peek()
+            if md is None or md.group('paren') == ')' or is_op(md, 'OR'):
+                break
+            if is_op(md, 'AND'):
+                tokens.pop(0)
+                children.append(parse_unary())
+            elif is_op(md, 'ANDNOT'):
+                tokens.pop(0)
+                right = parse_unary()
+                left = combine(And, children)
+                if left is None:
+                    raise QuerySyntaxError(f'ANDNOT without a left operand in {s!r}')
+                children = [AndNot(left, right) if right is not None else left]
+            else:
+                children.append(parse_unary())
+        return combine(And, children)
+
+    def parse_unary():
+        md = peek()
+        if md is None or is_op(md, *OPERATORS):
+            raise QuerySyntaxError(f'Expected a term in {s!r}')
+        tokens.pop(0)
+        if md.group('paren') == '(':
+            node = parse_or()
+            closing = peek()
+            if closing is None or closing.group('paren') != ')':
+                raise QuerySyntaxError(f'Unclosed parenthesis in {s!r}')
+            tokens.pop(0)
+            return node
+        if md.group('paren') == ')':
+            raise QuerySyntaxError(f'Unexpected ")" in {s!r}')
+        field = md.group('field') or 'all'
+        if field != 'all' and field not in FIELDS:
+            raise QuerySyntaxError(f'Unknown field {field!r} in {s!r}')
+        text = md.group('phrase') if md.group('phrase') is not None else md.group('word')
+        prefix = text.endswith('*')
+        if field == 'cat':
+            words = [text.rstrip('*').casefold()]
+        else:
+            words = tokenize(text)
+        if not words or not words[-1]:
+            return None
+        return Term(field, words, prefix)
+
+    def combine(cls, children):
+        children = [c for c in children if c is not None]
+        if not children:
+            return None
+        if len(children) == 1:
+            return children[0]
+        return cls(children)
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if tokens:
+        raise QuerySyntaxError(f'Unexpected ")" in {s!r}')
+    return tree
+
+
+def entry_fields(entry):
+    """ The text of an entry dict, like from `parse_arxiv_feed`, for each field """
+    return dict(ti=tokenize(entry.get('title') or ''),
+                abs=tokenize(entry.get('summary') or ''),
+                au=[w for a in entry.get('authors', ()) for w in tokenize(a['name'])],
+                co=tokenize(entry.get('arxiv_comment') or ''),
+                cat=[t['term'].casefold() for t in entry.get('tags', ())],
+                id=[entry['id'].rsplit('/abs/', 1)[-1].casefold()],
+                kw=[w for k in entry_keywords(entry) for w in tokenize(k)])
+
+
+def entry_keywords(entry):
+    return (detect_keywords(entry.get('summary')) or
+            detect_keywords(entry.get('arxiv_comment')))
+
+
+class EntryIndex(object):
+    """
+    An inverted index of a batch of arXiv entries, for matching many queries
+    against the batch at once
+    """
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self._postings = defaultdict(dict)
+        """ Positions of each word in each document, by field and word """
+        self._vocab = defaultdict(set)
+        """ The words in each field, for matching prefixes """
+        for e in entries:
+            self.add(e)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        doc = len(self.entries)
+        self.entries.append(entry)
+        for field, words in entry_fields(entry).items():
+            for i, w in enumerate(words):
+                self._postings[(field, w)].setdefault(doc, []).append(i)
+                self._vocab[field].add(w)
+
+    def _expand(self, field, word, prefix):
+        if not prefix:
+            return (word,)
+        return [w for w in self._vocab[field] if w.startswith(word)]
+
+    def _positions(self, field, word, prefix):
+        res = dict()
+        for w in self._expand(field, word, prefix):
+            for doc, positions in self._postings.get((field, w), {}).items():
+                res.setdefault(doc, []).extend(positions)
+        return res
+
+    def phrase(self, field, words, prefix=False):
+        """ The documents with the words next to each other, in order, in the field """
+        first = self._positions(field, words[0], prefix and len(words) == 1)
+        if len(words) == 1:
+            return set(first)
+        starts = {doc: set(p) for doc, p in first.items()}
+        for offset, w in enumerate(words[1:], 1):
+            last = offset == len(words) - 1
+            following = self._positions(field, w, prefix and last)
+            matched = dict()
+            for doc, ps in starts.items():
+                if doc in following:
+                    at = set(following[doc])
+                    ps = {p for p in ps if p + offset in at}
+                    if ps:
+                        matched[doc] = ps
+            starts = matched
+            if not starts:
+                break
+        return set(starts)
+
+
+class ArxivPercolator(object):
+    """
+    Answers `ArxivQuery` executions from one shared listing of recent arXiv
+    entries instead of one API search per query
+
+    The listing is every entry in `categories` updated in the last `lookback`,
+    fetched with one paged search and refreshed every `refresh_interval`
+    seconds on the percolator's own thread once it's started, or loaded from a
+    file with `load_file`. Each distinct query is
+    compiled with `parse_query` and matched against an `EntryIndex` of the
+    listing once per refresh.
+
+    A query is only answered here if its watermark falls inside the listing
+    and every result it could have is in the listing, which is the case when
+    it is restricted to some of `categories` (like ``cat:q-bio.NC AND
+    worm``), or for any query when the listing is `complete`. Other queries
+    are left for the API.
+    """
+
+    def __init__(self, categories=(), refresh_interval=3600, lookback=timedelta(days=2),
+                 complete=False, timefunc=time, nowfunc=datetime.utcnow):
+        """
+        Parameters
+        ----------
+        categories : list of str
+            arXiv categories, like ``q-bio.NC``, to fetch listings for. A
+            trailing ``*`` takes in every category with that prefix
+        refresh_interval : float
+            Seconds between fetches of the listing
+        lookback : datetime.timedelta
+            How far back the listing goes
+        complete : bool
+            Whether the listing has every recent entry, not just ones in
+            `categories`
+        timefunc : callable
+            Returns the current time in seconds, for refreshing
+        nowfunc : callable
+            Returns the current UTC time as a `datetime`, for the listing's
+            window
+        """
+        self.categories = list(categories)
+        self.refresh_interval = refresh_interval
+        self.lookback = lookback
+        self.complete = complete
+        self.timefunc = timefunc
+        self.nowfunc = nowfunc
+        self.index = None
+        self.floor = None
+        """ The update time from which the listing has every entry """
+        self.feed = dict()
+        self.hits = 0
+        self.refreshed_at = None
+        self.should_run = False
+        self.thread = None
+        self._lock = RLock()
+        self._refresh_lock = Lock()
+        """ Held while fetching, so only one refresh runs at a time """
+        self._cond = Condition()
+        self._compiled = dict()
+        self._results = dict()
+        self._memo = dict()
+
+    def listing_query(self):
+        return ArxivQuery(' OR '.join('cat:' + c for c in self.categories))
+
+    def start(self):
+        """ Refresh the listing now and every `refresh_interval` seconds after """
+        if not self.categories:
+            return
+        self.should_run = True
+
+        def runner():
+            while self.should_run:
+                try:
+                    self.refresh()
+                except Exception:
+                    L.warning('Failed to refresh the arXiv listing', exc_info=True)
+                with self._cond:
+                    if self.should_run:
+                        self._cond.wait(self.refresh_interval)
+        self.thread = Thread(target=runner, name='ow_scholar-percolator', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.should_run = False
+        with self._cond:
+            self._cond.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def refresh(self):
+        """
+        Fetch entries updated since the listing was last fetched
+
+        Queries are answered from the old listing until the new one is loaded
+        """
+        with self._refresh_lock:
+            with self._lock:
+                index, listed_floor = self.index, self.floor
+            floor = self.nowfunc() - self.lookback
+            since = floor
+            old = []
+            if index is not None and listed_floor is not None and listed_floor <= floor:
+                old = [e for e in index.entries if parse_atom_date(e['updated']) >= floor]
+                since = max((parse_atom_date(e['updated']) for e in old), default=floor)
+            query = self.listing_query()
+            query.max_pages = 100
+            response = query.execute(since=since)
+            fetched = list(response.iter_entries())
+            seen = {e['id'] for e in fetched}
+            entries = fetched + [e for e in old if e['id'] not in seen]
+            self.load(entries, floor, response.feed)
+            L.info('Refreshed the arXiv listing with %d entries', len(entries))
+
+    def load(self, entries, floor, feed=None):
+        """
+        Replace the listing
+
+        Parameters
+        ----------
+        entries : list of dict
+            Entry dicts, like from `parse_arxiv_feed`
+        floor : datetime
+            The time from which ``entries`` has every entry
+        """
+        entries = sorted(entries, key=lambda e: e['updated'], reverse=True)
+        index = EntryIndex(entries)
+        with self._lock:
+            self.index = index
+            self.floor = floor
+            self.feed = feed or dict()
+            self.refreshed_at = self.timefunc()
+            self._results.clear()
+            self._memo.clear()
+
+    def load_file(self, path, floor, complete=True):
+        """ Load the listing from an arXiv API Atom document, like a bulk download """
+        with open(path, 'rb') as f:
+            feed = parse_arxiv_feed(f.read())
+        self.complete = complete
+        self.load(feed['entries'], floor, feed['feed'])
+
+    def compile(self, query):
+        key = query.coalesce_key()
+        tree = self._compiled.get(key, False)
+        if tree is False:
+            try:
+                tree = parse_query(query.search_query)
+            except QuerySyntaxError as e:
+                L.info("Can't percolate %s: %s", query.search_query, e)
+                tree = None
+            self._compiled[key] = tree
+        return tree
+
+    def covers(self, tree):
+        """ Whether every entry which could match the tree is in the listing """
+        if self.complete:
+            return True
+        return self._restricted(tree)
+
+    def _restricted(self, node):
+        if isinstance(node, Term):
+            return (node.field == 'cat' and
+                    any(self._category_covered(node.words[0], node.prefix, c)
+                        for c in self.categories))
+        if isinstance(node, And):
+            return any(self._restricted(c) for c in node.children)
+        if isinstance(node, Or):
+            return all(self._restricted(c) for c in node.children)
+        if isinstance(node, AndNot):
+            return self._restricted(node.left)
+        return False
+
+    def _category_covered(self, cat, prefix, listed):
+        listed = listed.casefold()
+        if listed.endswith('*'):
+            return cat.startswith(listed[:-1])
+        return not prefix and cat == listed
+
+    def match_all(self, queries):
+        """
+        Match every query against the listing in one pass
+
+        Returns
+        -------
+        dict
+            The matching entries, most recently updated first, by
+            `Query.coalesce_key`
+        """
+        with self._lock:
+            return {q.coalesce_key(): self._match(q) for q in queries}
+
+    def _match(self, query):
+        key = query.coalesce_key()
+        res = self._results.get(key)
+        if res is None:
+            tree = self.compile(query)
+            docs = tree.evaluate(self.index, self._memo) if tree is not None else set()
+            res = self._results[key] = [self.index.entries[d] for d in sorted(docs)]
+        return res
+
+    def execute(self, query, since=None):
+        """
+        Returns a response for the query from the listing, or `None` if the
+        query has to go to the API
+        """
+        if not isinstance(query, ArxivQuery) or since is None:
+            return None
+        tree = self.compile(query)
+        if tree is None or not self.covers(tree):
+            return None
+        with self._lock:
+            if self.index is None or self.floor is None or since < self.floor:
+                return None
+            entries = [e for e in self._match(query) if parse_atom_date(e['updated']) >= since]
+            self.hits += 1
+        return ArxivQueryResponse(dict(feed=self.feed, entries=entries), query)
@@ -1,5 +1,7 @@
 
-__all__ = ['vol', 'volprop']
+from persistent import Persistent
+
+__all__ = ['vol', 'volprop', 'setvol', 'MergingQueue']
 
 
 def vol(obj, name, thunk):
@@ -20,3 +22,61 @@ def volprop(name, thunk=lambda: None, setter=True):
             setattr(self, volname, v)
         prop = prop.setter(sf)
     return prop
+
+
+def setvol(obj, name, value):
+    """
+    Set the attribute behind ``volprop(name)`` without marking a persistent
+    `obj` as changed, which assigning through the property would do
+    """
+    setattr(obj, '_v_' + name, value)
+
+
+class MergingQueue(Persistent):
+    """
+    A first-in, first-out queue of immutable items, like strings, whose
+    concurrent changes are merged when they're committed rather than raising
+    ``ConflictError``
+
+    Items appended in either transaction are kept, after the ones that were
+    already queued, and items taken in either are dropped. An item is only
+    queued once. The storage must support conflict resolution, as
+    ``FileStorage`` and ZEO do.
+    """
+
+    def __init__(self, items=()):
+        self._items = tuple(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def append(self, item):
+        if item not in self._items:
+            self._items += (item,)
+
+    def take(self):
+        """ Remove and return every queued item, oldest first """
+        items = self._items
+        if items:
+            self._items = ()
+        return items
+
+    def _p_resolveConflict(self, old, committed, new):
+        old_items = old.get('_items', ())
+        committed_items = committed.get('_items', ())
+        new_items = new.get('_items', ())
+        # An item is still queued only if neither transaction took it
+        kept = set(committed_items).intersection(new_items)
+        items = [i for i in old_items if i in kept]
+        seen = set(old_items)
+        for i in committed_items + new_items:
+            if i not in seen:
+                seen.add(i)
+                items.append(i)
+        return dict(new, _items=tuple(items))
@@ -0,0 +1,172 @@
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+
+__all__ = ['SchedulePlacer', 'PlacementIndex', 'PLACEMENTS_KEY']
+
+PLACEMENTS_KEY = 'schedule_placements'
+
+PERIODS = {'HOURLY': timedelta(hours=1),
+           'DAILY': timedelta(days=1),
+           'WEEKLY': timedelta(weeks=1)}
+
+FREQ_RGX = re.compile(r'\bFREQ=(?P<freq>\w+)')
+INTERVAL_RGX = re.compile(r'\bINTERVAL=(?P<interval>\d+)')
+FIXED_TIME_RGX = re.compile(r'\bBY(HOUR|MINUTE|SECOND|SETPOS)=')
+
+WEEK = timedelta(weeks=1)
+
+WEEK_START = datetime(2001, 1, 1)
+""" A Monday at midnight, which `PlacementIndex` counts slots of the week from """
+
+MAX_INDEXED_RUNS = 7 * 24
+"""
+Schedules which run more often than this in a week, like every minute, land in
+nearly every slot alike, so they're left out of a `PlacementIndex`
+"""
+
+
+def _utc(t):
+    """ A naive UTC time for ``t``. Naive times are taken to be UTC already """
+    if t.tzinfo is None:
+        return t
+    return t.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class PlacementIndex(Persistent):
+    """
+    The coalescing keys of the searches which run in each slot of the week,
+    kept up to date as schedules are added, so that placing a new schedule reads
+    a few slots rather than every stored schedule
+
+    A schedule is indexed by its runs in the week from its start, which stand
+    in for every week's. Rebasing a schedule's cursor doesn't move its start,
+    and stored schedules are never dropped, so nothing is taken out again.
+    Counts are `Length` objects keyed by (slot, coalescing key), so adds from
+    different processes write different BTree keys, or merge their counts.
+    """
+
+    def __init__(self, slot=timedelta(minutes=1)):
+        self.slot = slot
+        self._counts = OOBTree()
+        """ (slot, coalescing key) -> Length of searches running in the slot """
+
+    def slot_of(self, t):
+        """ The number of the slot of the week which the time ``t`` falls in """
+        return int(((_utc(t) - WEEK_START) % WEEK) / self.slot)
+
+    def _slots(self, schedule):
+        start = schedule.start
+        if start is None:
+            return set()
+        end = start + WEEK
+        runs = []
+        t = schedule.after(start, inc=True)
+        while t is not None and t < end:
+            runs.append(t)
+            if len(runs) > MAX_INDEXED_RUNS:
+                return set()
+            t = schedule.after(t)
+        return {self.slot_of(t) for t in runs}
+
+    def add(self, schedule):
+        """ Count the runs of a `.slack_bot.SearchSchedule` """
+        key = schedule.query.coalesce_key()
+        for slot in self._slots(schedule):
+            count = self._counts.get((slot, key))
+            if count is not None:
+                count.change(1)
+            else:
+                self._counts[(slot, key)] = Length(1)
+
+    def keys(self, t):
+        """ The coalescing keys of the searches which run in the slot holding ``t`` """
+        slot = self.slot_of(t)
+        counts = self._counts.items(min=(slot,), max=(slot + 1,), excludemax=True)
+        return {key for (_, key), count in counts if count() > 0}
+
+
+class SchedulePlacer(object):
+    """
+    Shifts loosely specified schedules, like "daily", forward in time so that
+    runs are spread out rather than all landing on the same moment
+
+    A schedule is loose if it is hourly, daily or weekly and doesn't say what
+    time of day (or minute of the hour) to run at. Its start is moved forward
+    by up to `max_offset` to the `slot` with the fewest other searches, so
+    the first run still happens soon. Searches which would share a fetch with
+    the new one (see `Query.coalesce_key`) don't count against a slot, so
+    identical queries tend to end up together.
+
+    The other searches are found in a `PlacementIndex`, or else by walking the
+    runs of each of a list of schedules.
+    """
+
+    def __init__(self, slot=timedelta(minutes=1), max_offset=timedelta(hours=1)):
+        self.slot = slot
+        self.max_offset = max_offset
+
+    def period(self, rule):
+        """ The period of a loose rule, or `None` if the rule isn't loose """
+        rule_str = str(rule)
+        md = FREQ_RGX.search(rule_str)
+        if not md or md.group('freq') not in PERIODS or FIXED_TIME_RGX.search(rule_str):
+            return None
+        md = INTERVAL_RGX.search(rule_str)
+        interval = int(md.group('interval')) if md else 1
+        return PERIODS[FREQ_RGX.search(rule_str).group('freq')] * interval
+
+    def load(self, now, span, existing=(), index=None):
+        """
+        Returns the coalescing keys of searches from ``existing`` and
+        ``index`` that run in each slot of ``span`` from ``now``. Slots are
+        numbered from ``now``
+        """
+        res = defaultdict(set)
+        end = now + span
+        max_runs = int(span / self.slot) + 1
+        for s in existing:
+            t = s.after(now, inc=True)
+            runs = 0
+            while t is not None and t < end and runs < max_runs:
+                res[int((t - now) / self.slot)].add(s.query.coalesce_key())
+                t = s.after(t)
+                runs += 1
+        if index is not None:
+            for i in range(max_runs - 1):
+                res[i] |= index.keys(now + i * self.slot)
+        return res
+
+    def place(self, rule, now, key=None, existing=(), index=None):
+        """
+        Returns the rule, moved to start at the least busy slot in the next
+        `max_offset`, or unchanged if it isn't loose
+
+        Parameters
+        ----------
+        rule : dateutil.rrule.rrule
+        now : datetime
+            The requested start of the rule
+        key : tuple, optional
+            The coalescing key of the query the rule is for
+        existing : iterable of SearchSchedule
+            The schedules to spread away from
+        index : PlacementIndex, optional
+            Counts of more schedules to spread away from
+        """
+        period = self.period(rule)
+        if period is None:
+            return rule
+        # Only the slots the rule may be moved to matter
+        span = min(period, self.max_offset)
+        load = self.load(now, span, existing, index)
+        nslots = max(1, int(span / self.slot))
+        best = min(range(nslots), key=lambda i: (len(load[i] - {key}), i))
+        start = now + best * self.slot
+        placed = rule.replace(dtstart=start)
+        placed.dtstart = start
+        return placed
@@ -0,0 +1,234 @@
+from datetime import datetime
+from io import BytesIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+__all__ = ['parse_esearch', 'iter_pubmed_articles', 'format_esearch',
+           'format_pubmed_articles', 'ESearchError', 'PUBMED_URL']
+
+PUBMED_URL = 'https://pubmed.ncbi.nlm.nih.gov/'
+
+MONTHS = {m: i for i, m in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                      'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+
+ARTICLE_TAG = 'PubmedArticle'
+
+
+class ESearchError(Exception):
+    """ Raised when ESearch answers with an error instead of results """
+
+
+def _text(elt, path):
+    child = elt.find(path)
+    if child is None:
+        return None
+    # Titles and abstracts can have markup like <i> and <sup> in them
+    s = ' '.join(''.join(child.itertext()).split())
+    return s or None
+
+
+def _int(s, default):
+    if not s:
+        return default
+    if s.isdigit():
+        return int(s)
+    return MONTHS.get(s[:3].casefold(), default)
+
+
+def _date(elt):
+    """
+    A date from an element with ``Year``, ``Month``, ``Day`` and maybe ``Hour``
+    and ``Minute``
+    """
+    if elt is None:
+        return None
+    year = _int(elt.findtext('Year'), None)
+    if year is None:
+        return None
+    try:
+        return datetime(year,
+                        _int(elt.findtext('Month'), 1),
+                        _int(elt.findtext('Day'), 1),
+                        _int(elt.findtext('Hour'), 0),
+                        _int(elt.findtext('Minute'), 0))
+    except ValueError:
+        return None
+
+
+def _format_date(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ') if dt is not None else None
+
+
+def _author_name(elt):
+    collective = elt.findtext('CollectiveName')
+    if collective:
+        return ' '.join(collective.split())
+    return ' '.join(n for n in (elt.findtext('ForeName') or elt.findtext('Initials'),
+                                elt.findtext('LastName'))
+                    if n)
+
+
+def parse_article(elt):
+    """
+    Convert a ``<PubmedArticle>`` from EFetch into a dict with the same keys
+    as `.atom.parse_entry` gives for arXiv entries, plus ``pmid``, ``version``
+    and ``journal``
+
+    ``updated`` is the later of when the record was last revised and when it
+    was added to PubMed, but no later than now, and ``published`` is when it
+    was added to PubMed. Either is `None` if the record doesn't say. Other
+    dates in the record's history, like ``pmc-release``, may be in the future,
+    so they're left out.
+    """
+    citation = elt.find('MedlineCitation')
+    pmid_elt = citation.find('PMID')
+    pmid = pmid_elt.text.strip()
+    history = {d.get('PubStatus'): _date(d)
+               for d in elt.findall('PubmedData/History/PubMedPubDate')}
+    published = history.get('pubmed') or history.get('entrez')
+    updated = max((d for d in (_date(citation.find('DateRevised')), published)
+                   if d is not None), default=None)
+    if updated is not None:
+        updated = min(updated, datetime.utcnow())
+    abstract = '\n'.join(' '.join(''.join(a.itertext()).split())
+                         for a in citation.findall('Article/Abstract/AbstractText'))
+    link = PUBMED_URL + pmid + '/'
+    tags = [dict(term=' '.join(''.join(d.itertext()).split()), scheme='MeSH')
+            for d in citation.findall('MeshHeadingList/MeshHeading/DescriptorName')]
+    tags += [dict(term=' '.join(''.join(k.itertext()).split()), scheme='keyword')
+             for k in citation.findall('KeywordList/Keyword')]
+    return dict(id='pubmed:' + pmid,
+                pmid=pmid,
+                version=int(pmid_elt.get('Version') or 1),
+                title=_text(citation, 'Article/ArticleTitle'),
+                summary=abstract or None,
+                updated=_format_date(updated),
+                published=_format_date(published),
+                journal=_text(citation, 'Article/Journal/Title'),
+                authors=[dict(name=_author_name(a))
+                         for a in citation.findall('Article/AuthorList/Author')],
+                tags=tags,
+                link=link,
+                links=[dict(href=link, rel='alternate')])
+
+
+def iter_pubmed_articles(data):
+    """
+    Parse a ``PubmedArticleSet`` from EFetch one article at a time
+
+    Like `.atom.iter_arxiv_feed`, each article is yielded as soon as its end
+    tag is read and is then dropped from the parse tree. Book records are
+    skipped.
+
+    Parameters
+    ----------
+    data : bytes or file-like
+
+    Yields
+    ------
+    dict
+        One dict per article. See `parse_article`
+    """
+    if isinstance(data, bytes):
+        data = BytesIO(data)
+    root = None
+    depth = 0
+    for event, elt in ElementTree.iterparse(data, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elt
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elt.tag == ARTICLE_TAG:
+            yield parse_article(elt)
+        root.remove(elt)
+
+
+def parse_esearch(data):
+    """
+    Parse an ``eSearchResult`` from ESearch
+
+    Returns
+    -------
+    dict
+        With ``count``, the number of matches, ``webenv`` and ``query_key``,
+        which name the matches on the history server, and ``ids``, the PMIDs
+        in this part of the result, if any were asked for
+
+    Raises
+    ------
+    ESearchError
+        If ESearch couldn't run the search
+    """
+    root = ElementTree.fromstring(data)
+    error = root.findtext('ERROR')
+    if error:
+        raise ESearchError(error.strip())
+    return dict(count=int(root.findtext('Count') or 0),
+                webenv=root.findtext('WebEnv'),
+                query_key=root.findtext('QueryKey'),
+                ids=[i.text.strip() for i in root.findall('IdList/Id')])
+
+
+def format_esearch(count, webenv=None, query_key=None, ids=()):
+    """ Write an ESearch result, like `parse_esearch` reads. Useful for standing in for the API """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<eSearchResult>',
+             '<Count>{}</Count><RetMax>{}</RetMax><RetStart>0</RetStart>'.format(count, len(ids))]
+    if query_key is not None:
+        parts.append('<QueryKey>{}</QueryKey>'.format(escape(str(query_key))))
+    if webenv is not None:
+        parts.append('<WebEnv>{}</WebEnv>'.format(escape(webenv)))
+    parts.append('<IdList>')
+    parts.extend('<Id>{}</Id>'.format(escape(i)) for i in ids)
+    parts.append('</IdList></eSearchResult>')
+    return ''.join(parts).encode('utf-8')
+
+
+def _format_date_elt(tag, s, attrs=''):
+    dt = datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
+    return ('<{0}{1}><Year>{2.year}</Year><Month>{2.month:02d}</Month><Day>{2.day:02d}</Day>'
+            '<Hour>{2.hour}</Hour><Minute>{2.minute}</Minute></{0}>').format(tag, attrs, dt)
+
+
+def format_pubmed_articles(entries):
+    """
+    Write article dicts, like those from `iter_pubmed_articles`, as an EFetch
+    ``PubmedArticleSet``. Useful for standing in for the API
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<PubmedArticleSet>']
+    for e in entries:
+        parts.append('<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM">'
+                     '<PMID Version="{}">{}</PMID>'.format(e.get('version') or 1,
+                                                           escape(e['pmid'])))
+        if e.get('updated'):
+            parts.append(_format_date_elt('DateRevised', e['updated']))
+        parts.append('<Article><Journal><Title>{}</Title></Journal>'
+                     '<ArticleTitle>{}</ArticleTitle>'
+                     .format(escape(e.get('journal') or ''), escape(e.get('title') or '')))
+        if e.get('summary'):
+            parts.append('<Abstract>')
+            parts.extend('<AbstractText>{}</AbstractText>'.format(escape(p))
+                         for p in e['summary'].split('\n'))
+            parts.append('</Abstract>')
+        parts.append('<AuthorList>')
+        for a in e.get('authors', ()):
+            fore, _, last = a['name'].rpartition(' ')
+            parts.append('<Author><LastName>{}</LastName>{}</Author>'.format(
+                escape(last), '<ForeName>{}</ForeName>'.format(escape(fore)) if fore else ''))
+        parts.append('</AuthorList></Article>')
+        mesh = [t for t in e.get('tags', ()) if t.get('scheme') == 'MeSH']
+        if mesh:
+            parts.append('<MeshHeadingList>')
+            parts.extend('<MeshHeading><DescriptorName>{}</DescriptorName></MeshHeading>'
+                         .format(escape(t['term'])) for t in mesh)
+            parts.append('</MeshHeadingList>')
+        parts.append('</MedlineCitation><PubmedData><History>')
+        if e.get('published'):
+            parts.append(_format_date_elt('PubMedPubDate', e['published'],
+                                          ' PubStatus={}'.format(quoteattr('pubmed'))))
+        parts.append('</History></PubmedData></PubmedArticle>')
+    parts.append('</PubmedArticleSet>')
+    return ''.join(parts).encode('utf-8')
@@ -0,0 +1,346 @@
+import json
+import random
+import zlib
+
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from BTrees.IIBTree import IITreeSet, multiunion
+from BTrees.Length import Length
+
+from .percolator import parse_query, tokenize, entry_keywords
+from .slack_bot import parse_arxiv_id, parse_atom_date
+
+__all__ = ['PublicationStore', 'Publication', 'AbstractBlock', 'PUBLICATIONS_KEY']
+
+PUBLICATIONS_KEY = 'publications'
+
+BLOCK_ENTRIES = 32
+""" How many abstracts are compressed together """
+
+MAX_KEY = 2 ** 30
+""" Document and block numbers are below this, so they fit in the integer BTrees """
+
+
+class Publication(Persistent):
+    """
+    What's kept about one publication. The abstract is stored separately; see
+    `PublicationStore.abstract`
+    """
+
+    def __init__(self, ident, version, title, authors, link, categories, updated,
+                 published=None, comment=None, keywords=()):
+        self.ident = ident
+        self.version = version
+        self.title = title
+        self.authors = tuple(authors)
+        self.link = link
+        self.categories = tuple(categories)
+        self.updated = updated
+        self.published = published
+        self.comment = comment
+        self.keywords = tuple(keywords)
+        self.abstract_ref = None
+        """ The block number and position of the abstract """
+
+
+class AbstractBlock(Persistent):
+    """
+    Up to `BLOCK_ENTRIES` abstracts, compressed together once the block is
+    full
+
+    The abstracts of replaced versions are blanked, so they stop taking up
+    space, and a block whose abstracts have all been replaced is dropped.
+    """
+
+    def __init__(self):
+        self._abstracts = []
+        """ The abstracts while the block is open """
+        self._data = None
+        """ The compressed JSON list of abstracts once it's full """
+        self.live = 0
+        """ How many of the abstracts haven't been replaced """
+
+    @property
+    def full(self):
+        return self._data is not None
+
+    def abstracts(self):
+        if self._data is None:
+            return self._abstracts
+        # Kept until the block is changed or made a ghost
+        abstracts = getattr(self, '_v_abstracts', None)
+        if abstracts is None:
+            abstracts = self._v_abstracts = json.loads(zlib.decompress(self._data))
+        return abstracts
+
+    def _set(self, abstracts):
+        self._v_abstracts = None
+        if self._data is None and len(abstracts) < BLOCK_ENTRIES:
+            self._abstracts = abstracts
+        else:
+            self._abstracts = None
+            self._data = zlib.compress(json.dumps(abstracts).encode('utf-8'))
+
+    def add(self, abstract):
+        """ Add an abstract to an open block, returning its position """
+        pos = len(self._abstracts)
+        self._set(self._abstracts + [abstract])
+        self.live += 1
+        return pos
+
+    def release(self, pos):
+        """ Blank the abstract at the position """
+        abstracts = list(self.abstracts())
+        if abstracts[pos] is not None:
+            abstracts[pos] = None
+            self.live -= 1
+            self._set(abstracts)
+
+
+class PublicationStore(Persistent):
+    """
+    Publications seen in search results, with their abstracts and an inverted
+    index for searching them again without going to the search target
+
+    Publications are deduplicated by ID and keep only their latest version.
+    Abstracts are compressed together in `AbstractBlock` objects. The index
+    maps each word of the title, abstract, authors, comment, categories and
+    keyword list (see `.percolator.detect_keywords`) to the publications with
+    it, so queries in the arXiv syntax are answered with set operations on
+    the BTrees. Publications are also indexed by update time, for limiting a
+    search to a span of time.
+
+    Every search run from every worker adds to the store, so nothing is
+    written to the store object itself after it's made: document and block
+    numbers are picked like ``zope.intid`` picks IDs, counting up from a
+    random number in each connection, and each connection fills a block of
+    its own. Concurrent adds then write different BTree keys and blocks,
+    which the storage can resolve.
+    """
+
+    def __init__(self):
+        self._publications = OOBTree()
+        """ ident -> Publication """
+        self._docids = OIBTree()
+        """ ident -> document number """
+        self._idents = IOBTree()
+        """ document number -> ident """
+        self._index = OOBTree()
+        """ (field, word) -> IITreeSet of document numbers """
+        self._by_date = OOBTree()
+        """ (updated, document number) -> None """
+        self._blocks = IOBTree()
+        """ block number -> AbstractBlock """
+        self._length = Length()
+        self.deliveries = OOTreeSet()
+        """ (time, ident, query string) for each publication delivered """
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, ident):
+        return ident in self._publications
+
+    def get(self, ident):
+        return self._publications.get(ident)
+
+    def add_entry(self, entry):
+        """
+        Store an entry dict from `.atom.parse_arxiv_feed` or
+        `.pubmed.iter_pubmed_articles`, replacing an older version of the same
+        publication. Entries without an update time aren't stored
+
+        Returns
+        -------
+        Publication or None
+            The stored publication
+        """
+        if not entry.get('updated'):
+            return None
+        ident, version = parse_arxiv_id(entry['id'])
+        updated = parse_atom_date(entry['updated'])
+        pub = self._publications.get(ident)
+        if pub is not None:
+            if (pub.version or 0) > (version or 0) or pub.updated >= updated:
+                return pub
+            docid = self._docids[ident]
+            self._unindex(docid, pub)
+            self._release_abstract(pub.abstract_ref)
+        else:
+            docid = self._insert_new(self._idents, ident, '_v_next_docid')
+            self._docids[ident] = docid
+            self._length.change(1)
+        pub = Publication(ident, version,
+                          title=entry.get('title'),
+                          authors=[a['name'] for a in entry.get('authors', ())],
+                          link=entry.get('link'),
+                          categories=[t['term'] for t in entry.get('tags', ())],
+                          updated=updated,
+                          published=entry.get('published'),
+                          comment=entry.get('arxiv_comment'),
+                          keywords=entry_keywords(entry))
+        pub.abstract_ref = self._store_abstract(entry.get('summary') or '')
+        self._publications[ident] = pub
+        self._index_publication(docid, pub, entry.get('summary') or '')
+        return pub
+
+    def add_entries(self, entries):
+        return [self.add_entry(e) for e in entries]
+
+    def _fields(self, pub, abstract):
+        return dict(ti=tokenize(pub.title or ''),
+                    abs=tokenize(abstract),
+                    au=[w for a in pub.authors for w in tokenize(a)],
+                    co=tokenize(pub.comment or ''),
+                    cat=[c.casefold() for c in pub.categories],
+                    id=[pub.ident.casefold()],
+                    kw=[w for k in pub.keywords for w in tokenize(k)])
+
+    def _index_publication(self, docid, pub, abstract):
+        for field, words in self._fields(pub, abstract).items():
+            for w in set(words):
+                docs = self._index.get((field, w))
+                if docs is None:
+                    docs = self._index[(field, w)] = IITreeSet()
+                docs.insert(docid)
+        self._by_date[(pub.updated, docid)] = None
+
+    def _unindex(self, docid, pub):
+        for field, words in self._fields(pub, self.abstract(pub.ident)).items():
+            for w in set(words):
+                docs = self._index.get((field, w))
+                if docs is not None:
+                    docs.remove(docid)
+                    if not docs:
+                        del self._index[(field, w)]
+        self._by_date.pop((pub.updated, docid), None)
+
+    def _insert_new(self, tree, value, counter):
+        """
+        Insert ``value`` into the integer-keyed ``tree`` at an unused key,
+        returning the key. Keys count up from the last one this connection
+        used, kept in the volatile attribute ``counter``, so that one
+        connection's inserts go to the same buckets
+        """
+        key = getattr(self, counter, None)
+        while True:
+            if key is None or key >= MAX_KEY:
+                key = random.randrange(MAX_KEY)
+            if tree.insert(key, value):
+                setattr(self, counter, key + 1)
+                return key
+            key = None
+
+    def _store_abstract(self, abstract):
+        block_id = getattr(self, '_v_open_block', None)
+        block = self._blocks.get(block_id) if block_id is not None else None
+        if block is None or block.full:
+            block = AbstractBlock()
+            block_id = self._v_open_block = self._insert_new(self._blocks, block,
+                                                             '_v_next_block')
+        return (block_id, block.add(abstract))
+
+    def _release_abstract(self, ref):
+        if ref is None:
+            return
+        block_id, pos = ref
+        block = self._blocks.get(block_id)
+        if block is None:
+            return
+        block.release(pos)
+        if block.live <= 0 and block.full:
+            del self._blocks[block_id]
+
+    def abstract(self, ident):
+        pub = self._publications.get(ident)
+        if pub is None or pub.abstract_ref is None:
+            return None
+        block_id, pos = pub.abstract_ref
+        block = self._blocks.get(block_id)
+        return block.abstracts()[pos] if block is not None else None
+
+    def _words(self, field, word, prefix):
+        if not prefix:
+            docs = self._index.get((field, word))
+            return [docs] if docs is not None else []
+        return list(self._index.values(min=(field, word), max=(field, word + '\uffff')))
+
+    def phrase(self, field, words, prefix=False):
+        """
+        The document numbers of publications with the words next to each
+        other, in order, in the field. Like `.percolator.EntryIndex.phrase`
+        """
+        candidates = None
+        for i, w in enumerate(words):
+            docs = multiunion(self._words(field, w, prefix and i == len(words) - 1))
+            candidates = docs if candidates is None else [d for d in candidates if d in docs]
+            if not candidates:
+                return set()
+        if len(words) == 1:
+            return set(candidates)
+        res = set()
+        for docid in candidates:
+            pub = self._publications[self._idents[docid]]
+            text = self._fields(pub, self.abstract(pub.ident) if field == 'abs' else '')[field]
+            if _has_phrase(text, words, prefix):
+                res.add(docid)
+        return res
+
+    def search(self, query_str, start=None, end=None):
+        """
+        Find stored publications matching a query in the arXiv syntax
+
+        Parameters
+        ----------
+        query_str : str
+            See `.percolator.parse_query`
+        start : datetime, optional
+            Leave out publications last updated before this time
+        end : datetime, optional
+            Leave out publications last updated at or after this time
+
+        Returns
+        -------
+        list of Publication
+            Most recently updated first, then by identifier
+        """
+        tree = parse_query(query_str)
+        if tree is None:
+            return []
+        docs = tree.evaluate(self, dict())
+        if start is not None or end is not None:
+            window = self._by_date.keys(min=(start,) if start is not None else None,
+                                        max=(end,) if end is not None else None,
+                                        excludemax=end is not None)
+            docs = [d for _, d in window if d in docs]
+        pubs = [self._publications[self._idents[d]] for d in docs]
+        # Document numbers are random, so they don't order publications
+        pubs.sort(key=lambda p: p.ident)
+        pubs.sort(key=lambda p: p.updated, reverse=True)
+        return pubs
+
+    def record_delivery(self, when, ident, query_str):
+        """ Note that a publication was delivered for a query """
+        self.deliveries.insert((when, ident, query_str))
+
+    def delivered(self, start=None, end=None):
+        """
+        Returns (time, publication, query string) for each delivery in the
+        span, oldest first
+        """
+        items = self.deliveries.keys(min=(start,) if start is not None else None,
+                                     max=(end,) if end is not None else None,
+                                     excludemax=end is not None)
+        return [(when, self._publications.get(ident), q) for when, ident, q in items]
+
+
+def _has_phrase(words, phrase, prefix):
+    n = len(phrase)
+    for i in range(len(words) - n + 1):
+        if words[i:i + n - 1] == list(phrase[:-1]):
+            last = words[i + n - 1]
+            if last == phrase[-1] or (prefix and last.startswith(phrase[-1])):
+                return True
+    return False
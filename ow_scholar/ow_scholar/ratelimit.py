@@ -0,0 +1,119 @@
+from collections import deque
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+__all__ = ['TokenBucket', 'FairQueue']
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` operations per second on average, with bursts of up to
+    `capacity` operations
+    """
+
+    def __init__(self, rate, capacity=1, timefunc=monotonic, sleepfunc=sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.timefunc = timefunc
+        self.sleepfunc = sleepfunc
+        self._tokens = capacity
+        self._last = timefunc()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens, going into debt if there aren't enough
+
+        Returns
+        -------
+        float
+            Seconds to wait before going ahead with the operation
+        """
+        with self._lock:
+            self._refill(self.timefunc())
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def delay(self, tokens=1):
+        """ Seconds until there will be enough tokens, without taking any """
+        with self._lock:
+            self._refill(self.timefunc())
+            if self._tokens >= tokens:
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """ Take tokens only if there are enough now. Returns whether they were taken """
+        with self._lock:
+            self._refill(self.timefunc())
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """ Take tokens, waiting until there are enough """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.sleepfunc(delay)
+
+    def penalize(self, seconds):
+        """
+        Hold off all operations for the given number of seconds, like when a
+        server says to retry later
+        """
+        with self._lock:
+            self._refill(self.timefunc())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class FairQueue(object):
+    """
+    A queue which takes items from each key in turn, so that a key with many
+    items can't hold back the others
+    """
+
+    def __init__(self):
+        self._queues = dict()
+        self._ring = deque()
+        self._cond = Condition()
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, key, item):
+        with self._cond:
+            q = self._queues.get(key)
+            if q is None:
+                q = self._queues[key] = deque()
+                self._ring.append(key)
+            q.append(item)
+            self._len += 1
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None):
+        """
+        Returns the next item, or `None` if there is none and ``block`` is
+        false or ``timeout`` passes
+        """
+        with self._cond:
+            if block and not self._ring:
+                self._cond.wait_for(lambda: self._ring, timeout)
+            if not self._ring:
+                return None
+            key = self._ring.popleft()
+            q = self._queues[key]
+            item = q.popleft()
+            if q:
+                self._ring.append(key)
+            else:
+                del self._queues[key]
+            self._len -= 1
+            return item
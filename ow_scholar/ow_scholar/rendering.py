@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from threading import Lock
+
+from .tracing import span
+
+__all__ = ['text', 'link', 'emphasis', 'LINE_BREAK', 'render', 'RenderCache', 'render_cache']
+
+# Messages are built once as a document: a tuple of parts, each of which is a
+# tuple starting with the kind of part. Documents are then rendered for each
+# content type with that type's templates
+
+
+def text(s):
+    return ('text', s)
+
+
+def link(url, label):
+    return ('link', url, label)
+
+
+def emphasis(s):
+    return ('emphasis', s)
+
+
+LINE_BREAK = ('line_break',)
+
+_compiled = dict()
+
+
+def compiled_templates(content_type):
+    """
+    Returns a function for each kind of part which formats it for the content
+    type, made from the type's ``templates`` the first time it's asked for
+    """
+    res = _compiled.get(content_type)
+    if res is None:
+        templates = content_type.templates
+        quote = content_type.quote
+        quote_url = getattr(content_type, 'quote_url', quote)
+        text_fmt = templates['text'].format
+        link_fmt = templates['link'].format
+        emphasis_fmt = templates['emphasis'].format
+        line_break = templates['line_break']
+        res = _compiled[content_type] = {
+            'text': lambda part: text_fmt(text=quote(part[1])),
+            'link': lambda part: link_fmt(url=quote_url(part[1]), label=quote(part[2])),
+            'emphasis': lambda part: emphasis_fmt(text=quote(part[1])),
+            'line_break': lambda part: line_break,
+        }
+    return res
+
+
+def render(doc, content_type):
+    """ Render a document for the content type, as a string """
+    with span('render'):
+        formatters = compiled_templates(content_type)
+        return ''.join(formatters[part[0]](part) for part in doc)
+
+
+class RenderCache(object):
+    """
+    Documents, and their renderings for each content type, for the most
+    recently rendered `maxsize` keys
+
+    A key stands for everything that goes into a document, so the same
+    message going to many channels is built and rendered only once per
+    content type.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def render(self, key, build, content_type):
+        """
+        Returns the document for ``key`` rendered for the content type
+
+        Parameters
+        ----------
+        key : hashable
+        build : callable
+            Returns the document if it isn't cached
+        content_type : type
+            A `Content` type
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                rendered = entry[1].get(content_type)
+                if rendered is not None:
+                    self.hits += 1
+                    return rendered
+            self.misses += 1
+        doc = entry[0] if entry is not None else build()
+        rendered = render(doc, content_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = (doc, dict())
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            entry[1][content_type] = rendered
+        return rendered
+
+
+render_cache = RenderCache()
+""" The cache that events are rendered through """
@@ -0,0 +1,705 @@
+import random
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from logging import getLogger
+from sched import scheduler
+from threading import Condition, Lock, RLock, Thread, local
+from time import monotonic, sleep, time
+
+import transaction
+from ZODB.POSException import ConflictError
+
+from .models import appmaker
+from .slack_bot import SCHEDULER_KEY, SCHEDULER_COUNT_KEY, ListSearchScheduler, prepare_root
+from .placement import PlacementIndex, PLACEMENTS_KEY
+from .ratelimit import FairQueue
+from .pubstore import PublicationStore, PUBLICATIONS_KEY
+from .metrics import QUERY_SECONDS, QUERY_ERRORS, CONFLICTS
+from .tracing import span
+
+L = getLogger(__name__)
+
+
+class QueryCoalescer(object):
+    """
+    Shares one upstream fetch among all of the subscriptions to the same query
+
+    Queries are grouped by `Query.coalesce_key`. The first subscription to come
+    due runs the fetch; any others with the same key which come due within
+    `window` seconds of it, including while it is still in flight, get the same
+    response instead of fetching again. A fetch is only shared with a
+    subscription whose watermark is no earlier than the fetch's, since the
+    response would otherwise be missing results it needs.
+
+    A fetch without a watermark has only the first page of results, which
+    wouldn't do for a subscription with one, and a fetch with a watermark
+    would give a subscription without one every page back to it. Fetches with
+    and without watermarks are therefore kept apart, and only shared with
+    subscriptions of the same kind.
+    """
+
+    def __init__(self, window=60, timefunc=time):
+        self.window = window
+        self.timefunc = timefunc
+        self._lock = Lock()
+        self._fetches = dict()
+
+    def execute(self, query, since=None):
+        """
+        Returns the response for the query, fetching it only if no query with
+        the same key has been fetched within the window
+        """
+        key = (query.coalesce_key(), since is None)
+        with self._lock:
+            now = self.timefunc()
+            self._prune(now)
+            fetch = self._fetches.get(key)
+            owner = fetch is None or (since is not None and since < fetch[2])
+            if owner:
+                fetch = (now, Future(), since)
+                self._fetches[key] = fetch
+
+        future = fetch[1]
+        if owner:
+            target = query.target or type(query).__name__
+            try:
+                with QUERY_SECONDS.time(target=target):
+                    future.set_result(query.execute(since=since))
+            except Exception as e:
+                QUERY_ERRORS.inc(target=target)
+                future.set_exception(e)
+
+        response = future.result()
+        if not owner and response is not None:
+            response = response.with_query(query)
+        return response
+
+    def _prune(self, now):
+        # Failed fetches aren't shared, so the next subscription tries again
+        expired = [k for k, (t, f, _) in self._fetches.items()
+                   if f.done() and (now - t > self.window or f.exception() is not None)]
+        for k in expired:
+            del self._fetches[k]
+
+    def __len__(self):
+        return len(self._fetches)
+
+
+class CatchUpBacklog(object):
+    """
+    Catch-up runs, for searches which came due while no process was running
+    them, released to the engine's workers at most `concurrency` at a time
+
+    After a restart or a takeover, every schedule with missed runs has one
+    catch-up run. Releasing them gradually, taking turns between keys, keeps
+    them from all going upstream at once and from holding up searches which
+    come due in the meantime.
+    """
+
+    def __init__(self, engine, concurrency=2):
+        self.engine = engine
+        self.concurrency = concurrency
+        self.running = 0
+        self._waiting = FairQueue()
+        self._lock = Lock()
+
+    def __len__(self):
+        """ Runs waiting to be released """
+        return len(self._waiting)
+
+    def put(self, action, key=None):
+        """ Run ``action()`` on the engine's workers when the budget allows """
+        self._waiting.put(key, (key, action))
+        self._release()
+
+    def _release(self):
+        while True:
+            with self._lock:
+                if self.running >= self.concurrency:
+                    return
+                item = self._waiting.get(block=False)
+                if item is None:
+                    return
+                self.running += 1
+            key, action = item
+            self.engine.submit(self._run, (action,), key=key)
+
+    def _run(self, action):
+        try:
+            self.engine._call(action, ())
+        finally:
+            with self._lock:
+                self.running -= 1
+            if self.engine.should_run:
+                self._release()
+
+
+class _Attempt(object):
+    """ One try at a transaction. See `SchedulerEngine.attempts` """
+
+    def __init__(self, engine, retry):
+        self.engine = engine
+        self.retry = retry
+        self.committed = False
+        self._txn = None
+
+    def __enter__(self):
+        self._txn = self.engine.transaction()
+        return self._txn.__enter__()
+
+    def __exit__(self, typ, exc, tb):
+        try:
+            suppressed = self._txn.__exit__(typ, exc, tb)
+        except ConflictError:
+            # Raised by the commit
+            if not self.retry:
+                raise
+        else:
+            if typ is None:
+                self.committed = True
+                return False
+            if not issubclass(typ, ConflictError) or suppressed or not self.retry:
+                return suppressed
+        L.info('Retrying a transaction after a conflict')
+        return True
+
+
+class SchedulerEngine(object):
+    """
+    A single, process-wide timer queue and worker pool for running searches.
+
+    Every `SearchSchedule` from every `ListSearchScheduler` goes into one heap
+    ordered by fire time. One timer thread waits for the earliest entry to come
+    due and hands it off to a bounded pool of workers, so the number of threads,
+    connections and caches stays flat as channels are added.
+
+    The started schedulers are loaded in one connection, which one thread at a
+    time uses through `scheduler_transaction`. Every other thread, including
+    each worker, gets a connection of its own for `transaction`, so persistent
+    objects are never shared between threads. Objects handed from one thread
+    to another are looked up again in the receiving thread's connection with
+    `local`.
+    """
+
+    def __init__(self, db=None, max_workers=4, timefunc=time, delayfunc=None,
+                 executor=None, coalesce_window=60, catch_up_concurrency=2,
+                 poll_interval=None):
+        """
+        Parameters
+        ----------
+        db : ZODB.DB.DB
+            The database holding the stored `ListSearchScheduler` objects. One
+            connection is opened from it for all of the schedulers, and one
+            for each thread which uses `transaction`
+        max_workers : int
+            The maximum number of due entries which may run at the same time
+        timefunc : callable
+            Returns the current time, in seconds, for the timer queue
+        delayfunc : callable
+            Waits for the given number of seconds. By default, waits on a
+            condition which is notified whenever an entry is added
+        executor : concurrent.futures.Executor
+            Runs due entries. By default, a thread pool of `max_workers`
+        coalesce_window : float
+            Seconds for which one fetch of a query is shared with other
+            subscriptions to the same query. See `QueryCoalescer`
+        catch_up_concurrency : int
+            The most catch-up runs, for runs missed while the schedulers
+            weren't running, which may run at the same time. See
+            `CatchUpBacklog`
+        poll_interval : float, optional
+            Seconds between checks of the database for changes to the watched
+            objects, for storages which don't tell the engine's connection
+            about changes as they're committed. By default, the database isn't
+            polled. See `watch`
+        """
+        self.db = db
+        self.scheduler_connection = None
+        """ The connection the started schedulers are loaded in """
+        self._scheduler_tm = transaction.TransactionManager()
+        self._scheduler_depth = 0
+        self._local = local()
+        self._connections = []
+        self._connections_lock = Lock()
+        self.poll_interval = poll_interval
+        self._last_poll = None
+        self._last_tid = None
+        self.max_workers = max_workers
+        self.timefunc = timefunc
+        self.executor = executor
+        self.schedulers = []
+        self.services = []
+        self.should_run = False
+        self.thread = None
+        self._cond = Condition()
+        self._woken = False
+        self.queue = scheduler(timefunc, delayfunc or self._wait)
+        self.coalescer = QueryCoalescer(coalesce_window, timefunc)
+        self.percolator = None
+        """ A `.percolator.ArxivPercolator` to answer queries from, if it can """
+        self.publications = None
+        """ The `.pubstore.PublicationStore` to keep search results in, if there is one """
+        self.ready = FairQueue()
+        """ Entries which are due, waiting for a worker """
+        self.backlog = CatchUpBacklog(self, catch_up_concurrency)
+        self._watched = dict()
+        """ The serial of each watched object as of the last check, by oid """
+        self._sync_pending = False
+        self._changed = False
+        """ Whether a watched object was changed since the timer thread last looked """
+        self.active_schedules = 0
+        """ Search schedules on the started schedulers, as of the last `load_schedulers` """
+        self.run_schedulers = True
+        """ Whether to start the stored schedulers. See `load_schedulers` """
+        self.leases = None
+        """
+        A `.leases.LeaseKeeper` deciding which of the stored schedulers to run,
+        if they're split between workers
+        """
+        self._keys = dict()
+        """ The key of each started scheduler in ``root[SCHEDULER_KEY]``, by ``id`` """
+        self._known_keys = set()
+        self._load_lock = RLock()
+
+    def _wait(self, delay):
+        if self.db is not None and self.poll_interval:
+            delay = self.poll_interval if delay is None else min(delay, self.poll_interval)
+        with self._cond:
+            if not self._woken:
+                self._cond.wait(delay)
+            self._woken = False
+            changed, self._changed = self._changed, False
+        if changed:
+            self._sync_soon()
+        self._poll()
+
+    def now(self):
+        """ The current time by `timefunc`, as a local `datetime` """
+        return datetime.fromtimestamp(self.timefunc())
+
+    def wake(self):
+        """ Interrupt the timer thread so that it re-examines the queue """
+        with self._cond:
+            self._woken = True
+            self._cond.notify_all()
+
+    def enter(self, delay, priority, action, argument=(), key=None):
+        """
+        Schedule ``action(*argument)`` to run in the worker pool after
+        ``delay`` seconds
+
+        The signature is the same as `sched.scheduler.enter`, except for
+        ``key``: when more entries are due than there are free workers, they
+        are run taking turns between keys, so one channel with many searches
+        can't hold back the others
+        """
+        entry = self.queue.enter(delay, priority, self._dispatch, (key, action, argument))
+        self.wake()
+        return entry
+
+    def cancel(self, entry):
+        try:
+            self.queue.cancel(entry)
+        except ValueError:
+            pass
+        self.wake()
+
+    def submit(self, action, argument=(), key=None):
+        """
+        Run ``action(*argument)`` in the worker pool as soon as a worker is
+        free, taking turns with due entries by ``key`` like `enter`
+        """
+        self._dispatch(key, action, argument)
+
+    def execute(self, query, since=None):
+        """
+        Run the query, matching it against the `percolator`'s listing if
+        possible and otherwise sharing the fetch with identical queries
+        """
+        if self.percolator is not None:
+            response = self.percolator.execute(query, since)
+            if response is not None:
+                return response
+        return self.coalescer.execute(query, since)
+
+    def _dispatch(self, key, action, argument):
+        self.ready.put(key, (action, argument))
+        self.executor.submit(self._run_next)
+
+    def _run_next(self):
+        # There is one of these for each item put in `ready`, but the item it
+        # runs is whichever one is next in turn
+        item = self.ready.get(block=False)
+        if item is not None:
+            self._call(*item)
+
+    def _call(self, action, argument):
+        try:
+            action(*argument)
+        except Exception:
+            L.error("Got an exception while running a scheduled action",
+                    exc_info=True)
+
+    @property
+    def connection(self):
+        """ The current thread's connection to `db`, opened the first time it's asked for """
+        conn = getattr(self._local, 'connection', None)
+        if conn is None and self.db is not None:
+            conn = self.db.open(transaction_manager=self._transaction_manager())
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _transaction_manager(self):
+        tm = getattr(self._local, 'transaction_manager', None)
+        if tm is None:
+            tm = self._local.transaction_manager = transaction.TransactionManager()
+        return tm
+
+    @contextmanager
+    def transaction(self):
+        """
+        Begin a transaction on the current thread's connection, committing on
+        exit. A transaction begun inside another on the same thread is part of
+        the outer one
+        """
+        depth = getattr(self._local, 'depth', 0)
+        conn = self.connection
+        if depth:
+            self._local.depth = depth + 1
+            try:
+                yield conn
+            finally:
+                self._local.depth = depth
+            return
+        self._local.depth = 1
+        try:
+            with self._commit(self._transaction_manager()):
+                yield conn
+        finally:
+            self._local.depth = 0
+
+    @contextmanager
+    def scheduler_transaction(self):
+        """
+        Begin a transaction on the connection the started schedulers are
+        loaded in, committing on exit. Only one thread at a time may be in one
+        """
+        with self._load_lock:
+            if self._scheduler_depth:
+                self._scheduler_depth += 1
+                try:
+                    yield self.scheduler_connection
+                finally:
+                    self._scheduler_depth -= 1
+                return
+            self._scheduler_depth = 1
+            try:
+                with self._commit(self._scheduler_tm):
+                    yield self.scheduler_connection
+            finally:
+                self._scheduler_depth = 0
+
+    @contextmanager
+    def _commit(self, tm):
+        txn = tm.begin()
+        try:
+            yield txn
+        except Exception:
+            txn.abort()
+            raise
+        try:
+            with span('zodb.commit'):
+                txn.commit()
+        except ConflictError:
+            CONFLICTS.inc(source='scheduler')
+            raise
+
+    def local(self, obj):
+        """
+        The same stored object as ``obj``, which may have been loaded by another
+        thread, as loaded by the current thread's connection. Call it in a
+        `transaction`. Objects which aren't stored are returned as they are
+        """
+        conn = self.connection
+        if conn is None or obj is None or obj._p_jar is None or obj._p_jar is conn:
+            return obj
+        return conn.get(obj._p_oid)
+
+    def attempts(self, number=3, backoff=0.01):
+        """
+        Like ``transaction.manager.attempts``: yields up to ``number`` context
+        managers, each running its body in a `transaction`, until one of them
+        commits without a ``ConflictError``. The last one's conflict is raised.
+        Use like::
+
+            for attempt in engine.attempts():
+                with attempt as conn:
+                    ...
+
+        Before each retry, waits a random time of up to ``backoff`` seconds,
+        doubled for every conflict so far, so that transactions which
+        conflicted with each other don't just collide again
+        """
+        for i in range(number):
+            attempt = _Attempt(self, retry=i < number - 1)
+            yield attempt
+            if attempt.committed:
+                return
+            if backoff:
+                sleep(random.uniform(0, backoff * 2 ** i))
+
+    def add_service(self, service):
+        """
+        Add an object with ``start()`` and ``stop()`` methods to run alongside
+        the engine. Services are started after the engine's connection is open
+        but before any schedulers are, and are stopped after the workers
+        """
+        self.services.append(service)
+
+    def load_publications(self):
+        """ Find or make the `publications` store. Use it through `local` """
+        with self.transaction() as conn:
+            root = appmaker(conn.root())
+            if PUBLICATIONS_KEY not in root:
+                root[PUBLICATIONS_KEY] = PublicationStore()
+            self.publications = root[PUBLICATIONS_KEY]
+
+    def upgrade_schedulers(self):
+        """
+        Make the mappings that events add schedulers and handlers to (see
+        `.slack_bot.prepare_root`), upgrade stored schedulers saved by older
+        versions, and count the stored schedules in a
+        `.placement.PlacementIndex` if there isn't one yet, so that none of
+        this has to be done when they're read
+        """
+        for attempt in self.attempts():
+            with attempt as conn:
+                root = appmaker(conn.root())
+                prepare_root(root)
+                schedulers = list(root[SCHEDULER_KEY].values())
+                for s in schedulers:
+                    upgrade = getattr(s, 'upgrade', None)
+                    if upgrade is not None:
+                        upgrade()
+                if PLACEMENTS_KEY not in root:
+                    index = root[PLACEMENTS_KEY] = PlacementIndex(
+                        ListSearchScheduler.placer.slot)
+                    for s in schedulers:
+                        for search_sched in getattr(s, 'schedules', tuple)():
+                            index.add(search_sched)
+
+    def load_schedulers(self):
+        """
+        Start every stored scheduler which isn't already started, and pick up
+        schedules added to the ones which are
+
+        If there are `leases`, only the schedulers whose keys this worker holds
+        leases on are started, and started ones whose leases were lost are
+        stopped. If `run_schedulers` is false, none are started.
+        """
+        if not self.run_schedulers:
+            return
+        with self._load_lock:
+            self._load_schedulers()
+
+    def _load_schedulers(self):
+        started = {id(s) for s in self.schedulers}
+        leases = self.leases
+        with self.scheduler_transaction() as conn:
+            root = appmaker(conn.root())
+            if SCHEDULER_KEY not in root:
+                prepare_root(root)
+            schedulers = root[SCHEDULER_KEY]
+            count = root.get(SCHEDULER_COUNT_KEY)
+            owned = [(k, s) for k, s in schedulers.items()
+                     if leases is None or leases.owns(k)]
+            new = [(k, s) for k, s in owned if id(s) not in started]
+            kept = {id(s) for _, s in owned}
+            lost = [s for s in self.schedulers if id(s) not in kept]
+            self.active_schedules = sum(len(s) for _, s in owned)
+            keys = set(schedulers.keys())
+            unclaimed = leases is not None and not keys <= self._known_keys
+            self._known_keys = keys
+        self.watch(schedulers)
+        if count is not None:
+            self.watch(count)
+        for s in lost:
+            s.stop()
+            self._keys.pop(id(s), None)
+        if lost:
+            # Schedulers compare equal by their schedules, so go by identity
+            self.schedulers = [s for s in self.schedulers if id(s) in kept]
+        for s in self.schedulers:
+            s.handle_adds()
+        for k, s in new:
+            self._keys[id(s)] = k
+            self.schedulers.append(s)
+            s.run(self)
+        if new:
+            L.info('Started %d schedulers', len(new))
+        if lost:
+            L.info('Stopped %d schedulers whose leases were lost', len(lost))
+        if unclaimed:
+            # Schedulers added since the last load have no worker yet
+            leases.wake()
+
+    def may_fire(self, scheduler):
+        """ Whether searches from the given started scheduler should still fire """
+        if self.leases is None:
+            return True
+        key = self._keys.get(id(scheduler))
+        return key is not None and self.leases.owns(key)
+
+    def watch(self, obj):
+        """
+        Call `load_schedulers` whenever any connection, in this process or
+        another one sharing the storage, commits a change to the given object,
+        loaded in the `scheduler_connection`
+
+        Every `poll_interval` seconds, the timer thread checks whether anything
+        has been committed since it last looked. If so, the serials of the
+        The storage instance behind the `scheduler_connection` is told which
+        objects every other connection changes as soon as they're committed,
+        including, for ZEO, connections in other processes. The engine hooks
+        it, so a change to a watched object wakes it right away. Storages
+        which can't be hooked are only checked if `poll_interval` is set:
+        every `poll_interval` seconds, the timer thread checks whether
+        anything has been committed since it last looked, and if so, the
+        serials of the watched objects are compared with the ones they had
+        before.
+        """
+        if obj._p_oid is None:
+            return
+        with self._load_lock:
+            obj._p_activate()
+            self._watched[obj._p_oid] = obj._p_serial
+
+    def _hook_invalidations(self):
+        # ZODB has no public callback for invalidations, so this wraps the
+        # methods of the connection's MVCC adapter instance which receive them
+        storage = self.scheduler_connection._storage
+        invalidate = getattr(storage, '_invalidate', None)
+        invalidate_cache = getattr(storage, '_invalidateCache', None)
+        if invalidate is None or invalidate_cache is None:
+            if not self.poll_interval:
+                L.warning("Can't watch %s for changes. Set scheduler.poll_interval to "
+                          "pick up schedules added by other processes", storage)
+            return
+
+        def _invalidate(tid, oids):
+            invalidate(tid, oids)
+            if any(oid in self._watched for oid in oids):
+                self._watched_changed_soon()
+
+        def _invalidateCache():
+            # Sent when the storage can't tell what changed, like after ZEO
+            # reconnects
+            invalidate_cache()
+            self._watched_changed_soon()
+        storage._invalidate = _invalidate
+        storage._invalidateCache = _invalidateCache
+
+    def _watched_changed_soon(self):
+        # Called by the committing thread while the storage holds its lock,
+        # so the sync is left to the timer thread
+        with self._cond:
+            self._changed = True
+            self._woken = True
+            self._cond.notify_all()
+
+    def _unhook_invalidations(self):
+        storage = self.scheduler_connection._storage
+        for name in ('_invalidate', '_invalidateCache'):
+            storage.__dict__.pop(name, None)
+
+    def _poll(self):
+        if self.db is None or not self.poll_interval or not self.should_run:
+            return
+        now = monotonic()
+        if self._last_poll is not None and now - self._last_poll < self.poll_interval:
+            return
+        self._last_poll = now
+        tid = self.db.lastTransaction()
+        if tid != self._last_tid:
+            self._last_tid = tid
+            self._sync_soon()
+
+    def _watched_changed(self):
+        changed = False
+        with self.scheduler_transaction() as conn:
+            for oid, serial in list(self._watched.items()):
+                obj = conn.get(oid)
+                obj._p_activate()
+                if obj._p_serial != serial:
+                    self._watched[oid] = obj._p_serial
+                    changed = True
+        return changed
+
+    def _sync_soon(self):
+        with self._cond:
+            if self._sync_pending or not self.should_run:
+                return
+            self._sync_pending = True
+        self.submit(self._sync)
+
+    def _sync(self):
+        with self._cond:
+            self._sync_pending = False
+        if self._watched_changed():
+            self.load_schedulers()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers,
+                                               thread_name_prefix='ow_scholar-worker')
+        self.should_run = True
+        if self.db is not None:
+            self.scheduler_connection = self.db.open(transaction_manager=self._scheduler_tm)
+            self._last_tid = self.db.lastTransaction()
+            self._hook_invalidations()
+            self.load_publications()
+            self.upgrade_schedulers()
+        for service in self.services:
+            service.start()
+        if self.db is not None:
+            self.load_schedulers()
+
+        def runner():
+            while self.should_run:
+                try:
+                    self.queue.run()
+                except Exception:
+                    L.error("Got an exception while running scheduler: ",
+                            exc_info=True)
+                if self.should_run and self.queue.empty():
+                    self._wait(None)
+        self.thread = Thread(target=runner, name='ow_scholar-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.should_run = False
+        for evt in self.queue.queue:
+            try:
+                self.queue.cancel(evt)
+            except ValueError:
+                pass
+        self.wake()
+        if self.thread:
+            self.thread.join()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        for service in reversed(self.services):
+            service.stop()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        if self.scheduler_connection is not None:
+            self._unhook_invalidations()
+            connections.append(self.scheduler_connection)
+            self.scheduler_connection = None
+        for conn in connections:
+            conn.transaction_manager.abort()
+            conn.close()
+        self._local = local()
@@ -0,0 +1,96 @@
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
+
+__all__ = ['SeenIndex', 'NEW', 'UPDATED', 'SEEN']
+
+NEW = 'new'
+UPDATED = 'updated'
+SEEN = 'seen'
+
+
+class SeenIndex(Persistent):
+    """
+    The publications, and the latest version of each, which have already been
+    delivered for one subscription
+
+    Lookups and inserts are O(log n) in the BTrees, so diffing a response is
+    linear in the number of results. Growth is bounded by `max_size`: once it
+    is reached, the publications which were delivered longest ago are dropped.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        # ident -> (version, sequence number of the last delivery)
+        self._versions = OOBTree()
+        # sequence number -> ident, oldest delivery first
+        self._order = IOBTree()
+        self._length = Length()
+        self._seq = 0
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, ident):
+        return ident in self._versions
+
+    def status(self, ident, version=None):
+        """
+        Returns `NEW` if the publication has not been delivered, `UPDATED` if
+        only an earlier version of it has been, and `SEEN` otherwise
+        """
+        prev = self._versions.get(ident)
+        if prev is None:
+            return NEW
+        if version is not None and (prev[0] is None or version > prev[0]):
+            return UPDATED
+        return SEEN
+
+    def diff(self, events, stop_after=None):
+        """
+        Returns the events which have not been delivered, marking the ones for
+        new versions of delivered publications with ``is_update``
+
+        Events without an ``ident`` are always returned. Nothing is recorded;
+        call `add` once an event has been delivered. If ``stop_after`` is
+        given, ``events`` is only read until that many delivered ones in a row
+        have been found, since results which come newest first are old from
+        there on.
+        """
+        res = []
+        latest = dict()
+        run = 0
+        for evt in events:
+            ident = getattr(evt, 'ident', None)
+            if ident is None:
+                res.append(evt)
+                continue
+            version = getattr(evt, 'version', None)
+            if ident in latest and (version is None or version <= latest[ident]):
+                continue
+            status = self.status(ident, version)
+            if status == SEEN:
+                run += 1
+                if stop_after is not None and run >= stop_after:
+                    break
+                continue
+            run = 0
+            latest[ident] = version or 0
+            evt.is_update = status == UPDATED
+            res.append(evt)
+        return res
+
+    def add(self, ident, version=None):
+        """ Record that the given version of a publication was delivered """
+        prev = self._versions.get(ident)
+        if prev is None:
+            self._length.change(1)
+        else:
+            del self._order[prev[1]]
+        self._seq += 1
+        self._versions[ident] = (version, self._seq)
+        self._order[self._seq] = ident
+        while self._length() > self.max_size:
+            self._versions.pop(self._order.pop(self._order.minKey()))
+            self._length.change(-1)
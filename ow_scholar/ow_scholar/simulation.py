@@ -0,0 +1,366 @@
+"""
+Replay the stored subscriptions on a virtual clock to see how much load they
+put on the scheduler, the search targets and Slack
+
+For example, to simulate a week of the subscriptions in a deployment::
+
+    ow_scholar_simulate production.ini --days 7
+"""
+import argparse
+import heapq
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from logging import getLogger
+from time import time
+
+import transaction
+
+from .models import appmaker
+from .scheduling import SchedulerEngine
+from .slack_bot import (SCHEDULER_KEY, Query, PublicationEvent, SearchSchedule,
+                        EventHandler, ListSearchScheduler, digest_chunks,
+                        DIGEST_MAX_CHARS)
+
+L = getLogger(__name__)
+
+__all__ = ['VirtualClock', 'Simulation', 'SimulationReport', 'SimulatedQuery',
+           'SimulatedHandler', 'SimulatedExecutor']
+
+
+class VirtualClock(object):
+    """
+    A clock which only moves when it's told to, for use as the ``timefunc``
+    and ``delayfunc`` of a `.scheduling.SchedulerEngine`
+    """
+
+    def __init__(self, start=0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        if delay > 0:
+            self.now += delay
+
+
+class SimulatedEvent(PublicationEvent):
+    __slots__ = ()
+
+    def __init__(self, ident):
+        super(SimulatedEvent, self).__init__('Simulated publication', (), None, ident=ident)
+
+
+class SimulatedResponse(object):
+    def __init__(self, query, idents, fetched_at):
+        self.query = query
+        self.idents = idents
+        self.fetched_at = fetched_at
+
+    def with_query(self, query):
+        return SimulatedResponse(query, self.idents, self.fetched_at)
+
+    def events(self):
+        return [SimulatedEvent(i) for i in self.idents]
+
+    def watermark(self):
+        return self.fetched_at
+
+
+class SimulatedQuery(Query):
+    """
+    Stands in for a stored query. It coalesces the same as the query it stands
+    for, but instead of searching, it counts the call and returns
+    `Simulation.results_per_run` new publications
+    """
+
+    def __init__(self, simulation, query):
+        self.simulation = simulation
+        self.key = query.coalesce_key()
+        self.target = getattr(query, 'target', type(query).__name__)
+
+    def coalesce_key(self):
+        return self.key
+
+    def execute(self, since=None):
+        return self.simulation.upstream_call(self)
+
+
+class SimulatedHandler(EventHandler):
+    """
+    Stands in for a stored handler, counting the Slack messages it would post
+    """
+
+    def __init__(self, simulation, handler):
+        self.simulation = simulation
+        self.channel = getattr(handler, 'channel', None)
+        self.digest = getattr(handler, 'digest', False)
+
+    def handle_all(self, events, delivered):
+        if not events:
+            return
+        if self.digest:
+            # Simulated publications are about as long as real ones, so the
+            # real digest rule gives about the right number of messages
+            texts = ['x' * 300] * len(events)
+            messages = len(digest_chunks('', texts, DIGEST_MAX_CHARS))
+        else:
+            messages = len(events)
+        self.simulation.slack_messages(self.channel, messages)
+        delivered.extend(events)
+
+
+class SimulatedExecutor(object):
+    """
+    Runs each submitted call right away, while keeping track of when it would
+    have run with `max_workers` workers each taking `latency` seconds per call
+
+    Calls are run in the order they're submitted, but on the virtual clock one
+    may have to wait for a worker. That wait is the scheduler's lag. While a
+    call runs, the clock reads the time it would finish, so that searches are
+    rescheduled from then, like they are for real.
+    """
+
+    def __init__(self, clock, max_workers, latency):
+        self.clock = clock
+        self.max_workers = max_workers
+        self.latency = latency
+        self.current = None
+        """ The virtual start time of the call being run """
+        self.intervals = []
+        """ The virtual (start, end) of each call """
+        self.lags = []
+        self._free = [clock.time()] * max_workers
+
+    def submit(self, fn, *args, **kwargs):
+        due = self.clock.time()
+        start = max(due, heapq.heappop(self._free))
+        end = start + self.latency
+        heapq.heappush(self._free, end)
+        self.lags.append(start - due)
+        self.intervals.append((start, end))
+        self.current = start
+        self.clock.now = end
+        try:
+            fn(*args, **kwargs)
+        finally:
+            self.clock.now = due
+            self.current = None
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class SimulationReport(object):
+    """ What a `Simulation` found """
+
+    def __init__(self, start, end, intervals, lags, upstream, messages):
+        self.start = start
+        self.end = end
+        self.runs = len(intervals)
+        self.peak_concurrent_queries = peak_overlap(intervals)
+        self.upstream_calls = sum(upstream.values())
+        self.upstream_calls_per_hour = per_bucket(upstream, 3600)
+        """ target -> list of call counts, one for each hour of the simulation """
+        self.peak_upstream_calls_per_hour = {t: max(c, default=0)
+                                             for t, c in self.upstream_calls_per_hour.items()}
+        self.slack_messages = sum(sum(c.values()) for c in messages.values())
+        self.peak_slack_messages_per_minute = {ch: max(c.values(), default=0)
+                                               for ch, c in messages.items()}
+        """ channel -> the most messages posted to it in one minute """
+        lags = sorted(lags)
+        self.mean_lag = sum(lags) / len(lags) if lags else 0
+        self.p99_lag = lags[int(len(lags) * 0.99)] if lags else 0
+        self.max_lag = lags[-1] if lags else 0
+
+    def __str__(self):
+        lines = ['Simulated {} to {}'.format(datetime.fromtimestamp(self.start),
+                                             datetime.fromtimestamp(self.end)),
+                 'Search runs: {}'.format(self.runs),
+                 'Peak concurrent queries: {}'.format(self.peak_concurrent_queries),
+                 'Upstream calls: {}'.format(self.upstream_calls)]
+        for target, peak in sorted(self.peak_upstream_calls_per_hour.items()):
+            lines.append('  {}: at most {} per hour'.format(target, peak))
+        lines.append('Slack messages: {}'.format(self.slack_messages))
+        busiest = sorted(self.peak_slack_messages_per_minute.items(), key=lambda x: -x[1])
+        for channel, peak in busiest[:10]:
+            lines.append('  {}: at most {} per minute'.format(channel, peak))
+        lines.append('Scheduler lag: mean {:.1f}s, p99 {:.1f}s, max {:.1f}s'.format(
+            self.mean_lag, self.p99_lag, self.max_lag))
+        return '\n'.join(lines)
+
+
+def peak_overlap(intervals):
+    """ The most of the (start, end) intervals which overlap at any time """
+    points = sorted([(s, 1) for s, _ in intervals] + [(e, -1) for _, e in intervals])
+    peak = current = 0
+    for _, change in points:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def per_bucket(counts, seconds):
+    """
+    Regroup counts by (key, time) into a list of counts per key for each
+    ``seconds`` long bucket, starting from the earliest time
+    """
+    if not counts:
+        return dict()
+    first = min(t for _, t in counts)
+    res = defaultdict(list)
+    for (key, t), n in counts.items():
+        buckets = res[key]
+        i = int((t - first) // seconds)
+        if len(buckets) <= i:
+            buckets.extend([0] * (i + 1 - len(buckets)))
+        buckets[i] += n
+    return dict(res)
+
+
+class Simulation(object):
+    """
+    Runs copies of stored subscriptions on a `.scheduling.SchedulerEngine`
+    driven by a `VirtualClock`, so that a week or a month of runs takes
+    seconds
+
+    The copies keep the stored schedules, and their queries coalesce like
+    the stored ones do, but the queries and handlers are replaced by
+    `SimulatedQuery` and `SimulatedHandler`. Nothing is fetched or posted and
+    nothing is written to the database.
+    """
+
+    def __init__(self, start=None, max_workers=4, coalesce_window=60,
+                 query_latency=2, results_per_run=1):
+        """
+        Parameters
+        ----------
+        start : float, optional
+            Virtual time, in seconds since the epoch, to start at. By default,
+            the current time
+        max_workers : int
+            Workers in the simulated pool. See `.scheduling.SchedulerEngine`
+        coalesce_window : float
+            See `.scheduling.QueryCoalescer`
+        query_latency : float
+            Virtual seconds each search run keeps a worker busy. Must be more
+            than zero, or a search would be due again as soon as it finished
+        results_per_run : int
+            New publications returned by each upstream call
+        """
+        if query_latency <= 0:
+            raise ValueError('query_latency must be more than zero')
+        self.clock = VirtualClock(time() if start is None else start)
+        self.start = self.clock.time()
+        self.results_per_run = results_per_run
+        self.executor = SimulatedExecutor(self.clock, max_workers, query_latency)
+        self.engine = SchedulerEngine(max_workers=max_workers,
+                                      timefunc=self.clock.time,
+                                      delayfunc=self.clock.sleep,
+                                      executor=self.executor,
+                                      coalesce_window=coalesce_window)
+        self.schedulers = []
+        self.upstream = Counter()
+        """ (target, virtual time) -> upstream calls """
+        self.messages = defaultdict(Counter)
+        """ channel -> virtual minute -> messages """
+        self._next_ident = 0
+
+    def upstream_call(self, query):
+        start = self.executor.current
+        if start is None:
+            start = self.clock.time()
+        self.upstream[(query.target, start)] += 1
+        idents = []
+        for _ in range(self.results_per_run):
+            self._next_ident += 1
+            idents.append('sim/{}'.format(self._next_ident))
+        return SimulatedResponse(query, idents, datetime.fromtimestamp(start))
+
+    def slack_messages(self, channel, count):
+        self.messages[channel][int(self.clock.time() // 60)] += count
+
+    def add_schedule(self, search_sched, handler):
+        """ Add a copy of a stored schedule and its handler """
+        copy = SearchSchedule(SimulatedQuery(self, search_sched.query), search_sched.sched)
+        copy.cursor = search_sched.cursor
+        copy.watermark = search_sched.watermark
+        sim_handler = SimulatedHandler(self, handler)
+        if not self.schedulers:
+            self.schedulers.append(ListSearchScheduler())
+        self.schedulers[0].insert(copy, sim_handler)
+        return copy
+
+    def load(self, root):
+        """ Add copies of every schedule stored under the app root """
+        schedulers = root.get(SCHEDULER_KEY, dict())
+        for scheduler in schedulers.values():
+            # Schedulers stored by older versions are only upgraded when an
+            # engine starts, which may not have happened yet
+            scheduler.upgrade()
+            for search_sched, handler in scheduler.items():
+                self.add_schedule(search_sched, handler)
+
+    def run(self, duration):
+        """
+        Run the schedules for ``duration`` of virtual time
+
+        Parameters
+        ----------
+        duration : datetime.timedelta
+
+        Returns
+        -------
+        SimulationReport
+        """
+        end = self.start + duration.total_seconds()
+        self.engine.should_run = True
+        for s in self.schedulers:
+            s.run(self.engine)
+        queue = self.engine.queue
+        while True:
+            delay = queue.run(blocking=False)
+            if delay is None or self.clock.time() + delay > end:
+                break
+            self.clock.sleep(delay)
+        self.engine.should_run = False
+        return SimulationReport(self.start, end, self.executor.intervals,
+                                self.executor.lags, self.upstream, self.messages)
+
+
+def main(argv=None):
+    from pyramid.paster import get_appsettings, setup_logging
+    from . import make_init_db
+
+    parser = argparse.ArgumentParser(description='Simulate the stored subscriptions')
+    parser.add_argument('config_uri', help='The application configuration, like production.ini')
+    parser.add_argument('--days', type=float, default=7, help='Virtual days to simulate')
+    parser.add_argument('--max-workers', type=int,
+                        help='Default: scheduler.max_workers from the configuration')
+    parser.add_argument('--query-latency', type=float, default=2,
+                        help='Seconds each search keeps a worker busy')
+    parser.add_argument('--results-per-run', type=int, default=1,
+                        help='New publications each upstream call returns')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    sim = Simulation(max_workers=args.max_workers or int(settings.get('scheduler.max_workers', 4)),
+                     coalesce_window=float(settings.get('scheduler.coalesce_window', 60)),
+                     query_latency=args.query_latency,
+                     results_per_run=args.results_per_run)
+    db = make_init_db(settings['zodbconn.uri'])
+    try:
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        try:
+            sim.load(appmaker(conn.root()))
+            L.info('Simulating %d schedules', len(sim.schedulers[0]) if sim.schedulers else 0)
+            report = sim.run(timedelta(days=args.days))
+        finally:
+            # The simulation only reads, but the app root is made if it's missing
+            tm.abort()
+            conn.close()
+    finally:
+        db.close()
+    print(report)
@@ -1,31 +1,60 @@
 import os
 import re
-import arxiv
+from html import escape as html_escape
 import slack
-from urllib.parse import quote_plus as urlquote_plus
+from urllib.parse import quote_plus as urlquote_plus, urlencode
 
 from wsgiref.simple_server import make_server
 from pyramid.config import Configurator
 from pyramid.response import Response
+from pyramid.settings import asbool
 
 from recurrent import RecurringEvent
-from dateutil.rrule import rrulestr
+from dateutil.rrule import rrule, rrulestr
 from datetime import datetime
-from sched import scheduler
-from time import time, sleep
-from threading import Thread
+from itertools import chain
+from time import time, time_ns, sleep
+from uuid import uuid4
+import threading
+from threading import Lock
 
 from persistent import Persistent
-from persistent.list import PersistentList
-from persistent.dict import PersistentDict
+from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
+
+from logging import getLogger
+
+from .persistence_utils import volprop, setvol, MergingQueue
+from .seen import SeenIndex
+from . import fetching
+from .fetching import fetch, FetchError
+from .ratelimit import TokenBucket
+from .placement import SchedulePlacer, PlacementIndex, PLACEMENTS_KEY
+from .atom import iter_arxiv_feed
+from .pubmed import iter_pubmed_articles, parse_esearch, PUBMED_URL
+from .rendering import text, link, emphasis, LINE_BREAK, render, render_cache
+from . import tracing
+from .metrics import (SCHEDULER_LAG, SEARCH_RUNS, HANDLER_SECONDS, EVENTS_DELIVERED,
+                      SLACK_POST_SECONDS, SLACK_POST_ERRORS)
 
-from logging import Logger
+api_key = os.environ.get('SLACK_API_KEY')
 
-from .persistence_utils import volprop
+L = getLogger(__name__)
 
-api_key = os.environ.get('SLACK_API_KEY')
+ARXIV_API_URL = 'http://export.arxiv.org/api/query'
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+""" The base URL of NCBI's E-utilities, which PubMed queries go to """
+
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+""" Raises NCBI's limit from three requests per second to ten """
 
-L = Logger(__name__)
+NCBI_EMAIL = os.environ.get('NCBI_EMAIL')
+""" Sent with E-utilities requests so that NCBI can get in touch about problems """
+
+
+def parse_atom_date(s):
+    return datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
 
 
 class Content(object):
@@ -40,6 +69,15 @@ class Content(object):
         Create a Content from the given string.
         """
 
+    templates = dict(text='{text}',
+                     link='{label} ({url})',
+                     emphasis='{text}',
+                     line_break='\n')
+    """
+    How each kind of part of a `.rendering` document is written for this
+    content. See `.rendering.render`
+    """
+
     @classmethod
     def quote(cls, s):
         """
@@ -63,6 +101,32 @@ class UnicodeStringContent(Content):
 class SlackMessageContent(UnicodeStringContent):
     ident = 'owscholar:content:SlackMessageContent'
 
+    templates = dict(text='{text}',
+                     link='<{url}|{label}>',
+                     emphasis='_{text}_',
+                     line_break='\n')
+
+    @classmethod
+    def quote(cls, s):
+        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    @classmethod
+    def quote_url(cls, s):
+        return s.replace('|', '%7C').replace('>', '%3E')
+
+
+class HtmlContent(UnicodeStringContent):
+    ident = 'owscholar:content:HtmlContent'
+
+    templates = dict(text='{text}',
+                     link='<a href="{url}">{label}</a>',
+                     emphasis='<em>{text}</em>',
+                     line_break='<br/>\n')
+
+    @classmethod
+    def quote(cls, s):
+        return html_escape(s)
+
 
 class MessageFragment(object):
     def __init__(self, frag, frag_type):
@@ -84,50 +148,224 @@ class MessageFragment(object):
         return self.frag.render()
 
 
+QUERY_OPERATOR_RGX = re.compile(r'\b(ANDNOT|AND|OR|NOT)\b')
+""" Boolean operators in arXiv and PubMed queries, which are only operators in upper case """
+
+
 class Query(Persistent):
+    target = None
+    """ The name of the search target in `SEARCH_TARGETS` this query runs on """
+
+    def coalesce_key(self):
+        """
+        Returns a key which is equal for queries that would fetch the same
+        results, so that one fetch can be shared between them
+
+        Search terms are matched regardless of case, so they're case folded,
+        but operators are left alone: ``a and b`` searches for three terms.
+        """
+        query_str = getattr(self, 'search_query', None) or str(self)
+        parts = QUERY_OPERATOR_RGX.split(' '.join(query_str.split()))
+        # Every other part is an operator
+        return (self.target, ''.join(p if i % 2 else p.casefold()
+                                     for i, p in enumerate(parts)))
+
     def msg_format(self, content_type):
         """ Returns a MessageFragment in the format given """
-        return MessageFragment(content_type(content_type.quote(str(self))), content_type)
+        return MessageFragment(content_type(render(self.msg_doc(), content_type)), content_type)
 
-    def execute(self):
-        pass
+    def msg_doc(self):
+        """ Returns a `.rendering` document describing the query """
+        return (text(str(self)),)
+
+    def execute(self, since=None):
+        """
+        Run the query
+
+        Parameters
+        ----------
+        since : datetime, optional
+            If given, results last updated before this time may be left out
+        """
 
 
 class ArxivQuery(Query):
+    target = 'Arxiv'
+
+    page_size = 100
+    """ How many entries to ask for per page """
+
+    max_pages = 20
+    """ The most pages to fetch in one run, even if the watermark isn't reached """
+
     def __init__(self, s):
         self.search_query = s
-        self._client = arxiv.Client()
 
-    def msg_format(self, content_type):
-        if issubclass(content_type, SlackMessageContent):
-            link_text = 'ArXiv Query: <http://export.arxiv.org/api/query?search_query={}|{}>'
-            return MessageFragment(content_type(link_text.format(urlquote_plus(self.search_query),
-                                                                 self.search_query)),
-                                   content_type)
-        else:
-            return super(ArxivQuery, self).msg_format(content_type)
+    def msg_doc(self):
+        url = 'http://export.arxiv.org/api/query?search_query={}'.format(
+            urlquote_plus(self.search_query))
+        return (text('ArXiv Query: '), link(url, self.search_query))
+
+    def page_url(self, start):
+        return ARXIV_API_URL + '?' + urlencode(dict(search_query=self.search_query,
+                                                    sortBy='lastUpdatedDate',
+                                                    sortOrder='descending',
+                                                    start=start,
+                                                    max_results=self.page_size))
 
-    def execute(self):
-        print("running arxiv query for: " + self.search_query)
-        r = self._client.get(arxiv.Search(query=self.search_query))
-        return ArxivQueryResponse(r, self)
+    def execute(self, since=None):
+        """
+        Fetch entries, most recently updated first
+
+        Only the first page is fetched right away. Later pages are fetched as
+        the response's entries are iterated, so a caller which stops early
+        doesn't fetch them at all.
+
+        Parameters
+        ----------
+        since : datetime, optional
+            The watermark from a previous run. Pages are fetched until an entry
+            updated before this time is reached. If not given, only the first
+            page is fetched
+        """
+        L.debug('Running arXiv query for: %s', self.search_query)
+        feed = dict()
+        entries = PagedEntries(self.iter_entries(since, feed))
+        # Fetch the first page now so that errors from it are raised here
+        next(iter(entries), None)
+        return ArxivQueryResponse(dict(feed=feed, entries=entries), self)
+
+    def stream(self, since=None):
+        """
+        Like `execute`, but yields `ArxivPublicationEvent` objects without
+        keeping them, so memory use is bounded by the page size however many
+        results there are
+        """
+        for e in self.iter_entries(since):
+            yield entry_event(e, self)
+
+    def iter_entries(self, since=None, feed=None):
+        """
+        Yields entry dicts page by page, parsing each page as it's read.
+        See `execute` for ``since``. ``feed`` is filled in with the feed
+        metadata of the latest page
+        """
+        if feed is None:
+            feed = dict()
+        start = 0
+        for page in range(self.max_pages):
+            url = self.page_url(start)
+            resp = fetch(url, target=self.target)
+            if not resp.ok:
+                raise FetchError(url, resp)
+            count = 0
+            for e in iter_arxiv_feed(resp.body, feed):
+                if since is not None and parse_atom_date(e['updated']) < since:
+                    return
+                count += 1
+                yield e
+            start += count
+            total = int(feed.get('opensearch_totalresults') or 0)
+            if since is None or count < self.page_size or start >= total:
+                return
 
     def validate(self):
         return True
 
 
 class PubmedQuery(Query):
+    target = 'PubMed'
+
+    batch_size = 500
+    """ How many articles to ask EFetch for at once """
+
+    max_results = 5000
+    """ The most articles to fetch in one run """
+
     def __init__(self, s):
         self.search_query = s
 
     def validate(self):
         return True
 
-    def execute(self):
-        print('running pubmed query for: ' + self.search_query)
+    def msg_doc(self):
+        url = PUBMED_URL + '?' + urlencode(dict(term=self.search_query))
+        return (text('PubMed Query: '), link(url, self.search_query))
+
+    def eutils_url(self, tool, **params):
+        params = dict(db='pubmed', tool='ow_scholar', **params)
+        if NCBI_EMAIL:
+            params['email'] = NCBI_EMAIL
+        if NCBI_API_KEY:
+            params['api_key'] = NCBI_API_KEY
+        return EUTILS_URL + tool + '.fcgi?' + urlencode(params)
+
+    def search_url(self, since=None):
+        params = dict(term=self.search_query, usehistory='y', retmax=0, sort='pub_date')
+        if since is not None:
+            params.update(datetype='mdat', mindate=since.strftime('%Y/%m/%d'), maxdate='3000')
+        return self.eutils_url('esearch', **params)
+
+    def fetch_url(self, search, start, size):
+        return self.eutils_url('efetch', WebEnv=search['webenv'], query_key=search['query_key'],
+                               retstart=start, retmax=size, retmode='xml')
+
+    def execute(self, since=None):
+        """
+        Search with ESearch, keeping the matches on NCBI's history server, and
+        then fetch the articles from there with EFetch in batches of
+        `batch_size`
+
+        Like `ArxivQuery.execute`, only the first batch is fetched right away
+        and the rest as the response's entries are iterated.
+
+        Parameters
+        ----------
+        since : datetime, optional
+            The watermark from a previous run. Only articles modified on or
+            after its day are searched for, up to `max_results` of them. If not
+            given, only the first batch of the newest articles is fetched
+        """
+        L.debug('Running PubMed query for: %s', self.search_query)
+        search = dict()
+        entries = PagedEntries(self.iter_entries(since, search))
+        next(iter(entries), None)
+        return PubmedQueryResponse(dict(search=search, entries=entries), self)
+
+    def stream(self, since=None):
+        """ Like `ArxivQuery.stream`, but yielding `PubmedPublicationEvent` objects """
+        for e in self.iter_entries(since):
+            yield PubmedPublicationEvent.from_entry(e, self)
+
+    def iter_entries(self, since=None, search=None):
+        """
+        Yields article dicts batch by batch, parsing each batch as it's read.
+        See `execute` for ``since``. ``search`` is filled in with the ESearch
+        result. See `.pubmed.parse_esearch`
+        """
+        if search is None:
+            search = dict()
+        url = self.search_url(since)
+        resp = fetch(url, target=self.target)
+        if not resp.ok:
+            raise FetchError(url, resp)
+        search.update(parse_esearch(resp.body))
+        limit = self.batch_size if since is None else self.max_results
+        total = min(search['count'], limit)
+        start = 0
+        while start < total and search['webenv']:
+            size = min(self.batch_size, total - start)
+            url = self.fetch_url(search, start, size)
+            resp = fetch(url, target=self.target)
+            if not resp.ok:
+                raise FetchError(url, resp)
+            yield from iter_pubmed_articles(resp.body)
+            # Book records are left out of the batch, so count by what was asked for
+            start += size
 
 
 class Author(object):
+    __slots__ = ('name', 'affil', 'email')
 
     def __init__(self, name, affil=None, email=None):
         self.name = name
@@ -136,106 +374,552 @@ class Author(object):
 
 
 class ArxivAuthor(Author):
+    __slots__ = ()
+
     def __init__(self, author_object):
         super(ArxivAuthor, self).__init__(author_object['name'])
 
 
-class ArxivQueryResponse(object):
+class PagedEntries(object):
+    """
+    Entries pulled from an iterator as they're first asked for and kept for
+    later iterations, so that one paged search can be shared by several
+    readers without fetching pages that none of them get to
+    """
+
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+        self.fetched = []
+        """ The entries pulled so far """
+        self._lock = Lock()
+        self._done = False
+        self._error = None
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self.fetched):
+                yield self.fetched[i]
+                i += 1
+                continue
+            with self._lock:
+                if i < len(self.fetched):
+                    continue
+                if self._error is not None:
+                    raise self._error
+                if self._done:
+                    return
+                try:
+                    self.fetched.append(next(self._it))
+                except StopIteration:
+                    self._done = True
+                except Exception as e:
+                    self._error = e
+                    raise
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class EntriesResponse(object):
+    """
+    A response holding entry dicts, which are made into events of
+    `event_type` as they're read
+    """
+
+    event_type = None
+    """ A `PublicationEvent` type with a ``from_entry`` class method """
+
     def __init__(self, response_object, query):
         self._response = response_object
         self._query = query
 
+    def with_query(self, query):
+        """ The same response, but with events attributed to the given query """
+        return type(self)(self._response, query)
+
+    def watermark(self):
+        """ The latest update time of any entry read from the response """
+        return max((parse_atom_date(e['updated']) for e in self.entries if e.get('updated')),
+                   default=None)
+
+    @property
+    def entries(self):
+        """ The entries read so far. See `iter_entries` """
+        entries = self._response['entries']
+        return getattr(entries, 'fetched', entries)
+
+    def iter_entries(self):
+        """ Iterate over all of the entries, fetching more pages as needed """
+        return iter(self._response['entries'])
+
     def events(self):
-        for e in self._response['entries']:
-            yield ArxivPublicationEvent(title=e['title'],
-                                        link=e['link'],
-                                        authors=[ArxivAuthor(a) for a in e['authors']],
-                                        query=self._query)
+        for e in self.iter_entries():
+            yield self.event_type.from_entry(e, self._query)
+
+
+class ArxivQueryResponse(EntriesResponse):
+    @property
+    def event_type(self):
+        return ArxivPublicationEvent
+
+    @property
+    def feed(self):
+        return self._response['feed']
+
+
+class PubmedQueryResponse(EntriesResponse):
+    @property
+    def event_type(self):
+        return PubmedPublicationEvent
+
+    @property
+    def search(self):
+        """ The ESearch result. See `.pubmed.parse_esearch` """
+        return self._response['search']
+
+
+def entry_event(e, query):
+    """ Make an `ArxivPublicationEvent` from an entry dict """
+    return ArxivPublicationEvent.from_entry(e, query)
+
+
+ARXIV_ID_RGX = re.compile(r'(?:^|/abs/)(?P<ident>[^/]+(?:/[^/v]+)?)v(?P<version>\d+)$')
+
+
+def parse_arxiv_id(s):
+    """
+    Split an arXiv entry ID, like ``http://arxiv.org/abs/1110.3084v1``, into
+    the ID without the version and the version number, which is `None` if the
+    ID has no version
+    """
+    md = ARXIV_ID_RGX.search(s)
+    if md:
+        return md.group('ident'), int(md.group('version'))
+    return s.rsplit('/abs/', 1)[-1], None
 
 
 class Event(object):
+    __slots__ = ()
+
     def msg_format(self, content_type):
-        return MessageFragment(content_type('nothing'), content_type)
+        """
+        Returns a MessageFragment in the format given. Events with a
+        `render_key` are rendered through `.rendering.render_cache`
+        """
+        with tracing.span('msg_format', content_type=content_type.__name__):
+            return self._msg_format(content_type)
+
+    def _msg_format(self, content_type):
+        key = self.render_key()
+        if key is None:
+            rendered = render(self.msg_doc(), content_type)
+        else:
+            rendered = render_cache.render(key, self.msg_doc, content_type)
+        return MessageFragment(content_type(rendered), content_type)
+
+    def msg_doc(self):
+        """ Returns a `.rendering` document describing the event """
+        return (text('nothing'),)
+
+    def render_key(self):
+        """
+        Returns a key which is equal for events with the same `msg_doc`, or
+        `None` if the document shouldn't be cached
+        """
+        return None
+
+
+_LAZY = object()
+""" Stands in for a field which hasn't been decoded yet """
+
+
+def lazy_field(slot):
+    """
+    A property for a field stored in ``slot`` which is filled in by the
+    object's ``_decode`` method the first time it's read
+    """
+    def get(self):
+        value = getattr(self, slot)
+        if value is _LAZY:
+            self._decode(slot)
+            value = getattr(self, slot)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+    return property(get, set)
 
 
 class PublicationEvent(Event):
-    def __init__(self, title, authors, link):
+    __slots__ = ('_title', '_authors', '_link', '_ident', '_version', 'is_update')
+
+    def __init__(self, title, authors, link, ident=None, version=None, is_update=False):
+        """
+        Parameters
+        ----------
+        title : str
+        authors : list of Author
+        link : str
+        ident : str, optional
+            An identifier for the publication which is the same across versions
+        version : int, optional
+            The version of the publication
+        is_update : bool, optional
+            Whether an earlier version of the publication was already announced
+        """
         self.title = title
         self.authors = authors
         self.link = link
+        self.ident = ident
+        self.version = version
+        self.is_update = is_update
+
+    title = lazy_field('_title')
+    authors = lazy_field('_authors')
+    link = lazy_field('_link')
+    ident = lazy_field('_ident')
+    version = lazy_field('_version')
+
+    def _decode(self, slot):
+        """
+        Fill in the lazy field stored in ``slot``, and any others which are as
+        cheap. Events made with every field given have nothing to decode, so a
+        field left lazy here reads as `None`. See `EntryPublicationEvent`
+        """
+        setattr(self, slot, None)
+
+    @property
+    def headline(self):
+        return 'Updated publication' if self.is_update else 'New publication'
 
     def __str__(self):
-        return 'New publication "{}" by _{}_ ({})'.format(self.title,
-                                                          ', '.join(a.name
-                                                                    for a
-                                                                    in self.authors),
-                                                          self.link)
+        return '{} "{}" by _{}_ ({})'.format(self.headline,
+                                             self.title,
+                                             ', '.join(a.name
+                                                       for a
+                                                       in self.authors),
+                                             self.link)
 
 
-class ArxivPublicationEvent(PublicationEvent):
+class EntryPublicationEvent(PublicationEvent):
+    """ A publication from an entry dict which is decoded as its fields are read """
+
+    __slots__ = ('query', '_entry')
+
+    source = None
+    """ Names the kind of entry in `render_key` """
 
     def __init__(self, query, *args, **kwargs):
-        super(ArxivPublicationEvent, self).__init__(*args, **kwargs)
+        super(EntryPublicationEvent, self).__init__(*args, **kwargs)
         self.query = query
+        self._entry = None
 
-    def msg_format(self, content_type):
-        if issubclass(content_type, SlackMessageContent):
-            fmt = 'New publication "{}" by _{}_\nMatched by {}'
-            msg_str = fmt.format("<{}|{}>".format(self.link, self.title)
-                                 if self.link else self.title,
-                                 ', '.join(a.name for a in self.authors),
-                                 self.query.msg_format(content_type).render())
-            return MessageFragment(content_type(msg_str), content_type)
+    @classmethod
+    def from_entry(cls, entry, query):
+        """
+        Make an event for an entry dict without decoding anything yet. The ID
+        is decoded the first time `ident` or `version` is read, and the rest the
+        first time any other field is
+        """
+        evt = cls.__new__(cls)
+        evt._entry = entry
+        evt.query = query
+        evt._title = evt._authors = evt._link = evt._ident = evt._version = _LAZY
+        evt.is_update = False
+        return evt
+
+    def msg_doc(self):
+        return ((text(self.headline + ' "'),
+                 link(self.link, self.title) if self.link else text(self.title),
+                 text('" by '),
+                 emphasis(', '.join(a.name for a in self.authors)),
+                 LINE_BREAK,
+                 text('Matched by ')) +
+                self.query.msg_doc())
+
+    def render_key(self):
+        # Only the query's text shows in the message, so the same paper matched
+        # by the same search for different channels renders the same
+        return (self.source, self.ident, self.version, self.is_update,
+                self.query.target, self.query.search_query)
+
+
+class ArxivPublicationEvent(EntryPublicationEvent):
+    """ A publication from an entry dict from `.atom.parse_arxiv_feed` """
+
+    __slots__ = ()
+
+    source = 'arxiv'
+
+    def _decode(self, slot):
+        e = self._entry
+        if slot in ('_ident', '_version'):
+            self._ident, self._version = parse_arxiv_id(e['id'])
         else:
-            return MessageFragment(UnicodeStringContent(str(self)), content_type)
+            self._title = e['title']
+            self._link = e['link']
+            self._authors = [ArxivAuthor(a) for a in e['authors']]
 
 
-class Duration(object):
-    """ A span of time """
+class PubmedPublicationEvent(EntryPublicationEvent):
+    """
+    A publication from an article dict from `.pubmed.iter_pubmed_articles`.
+    Its `ident` is ``pubmed:`` and the PMID, so it can't be mistaken for an
+    arXiv ID
+    """
+
+    __slots__ = ()
 
+    source = 'pubmed'
 
-class Period(object):
-    """ A duration with an implicit cycle """
+    def _decode(self, slot):
+        e = self._entry
+        if slot in ('_ident', '_version'):
+            self._ident = e['id']
+            self._version = e.get('version')
+        else:
+            self._title = e['title'] or ''
+            self._link = e['link']
+            self._authors = [Author(a['name']) for a in e['authors']]
 
 
 class Schedule(object):
     """ A schedule. A set of Periods, each with a start and end date-time """
 
 
-class SearchSchedule(object):
+class SearchSchedule(Persistent):
     """ A schedule for searches """
 
+    seen = None
+
+    watermark = None
+    """ The latest update time of any result delivered for this schedule """
+
+    last_run = None
+    """ When the latest run started, by the scheduler's clock """
+
+    cursor = None
+    """
+    `sched` restarted at one of its occurrences, so that finding occurrences
+    after that one doesn't walk through all of the ones before it
+    """
+
     def __init__(self, query, sched):
         """ add a search schedule for the given query """
         self.query = query
         self.sched = sched
+        self.seen = SeenIndex()
+
+    def advance_watermark(self, response):
+        """ Move the watermark up to the latest result in the response """
+        latest = response.watermark()
+        if latest is not None and (self.watermark is None or latest > self.watermark):
+            self.watermark = latest
+
+    def new_events(self, events, stop_after=None):
+        """
+        Returns the events which haven't already been delivered for this
+        schedule. See `SeenIndex.diff`
+        """
+        if self.seen is None:
+            self.seen = SeenIndex()
+        return self.seen.diff(events, stop_after)
+
+    def unseen_events(self, events, stop_after=None):
+        """
+        Like `new_events`, but without writing anything, so that it can read
+        ``events``, fetching more pages as it goes, outside of a transaction.
+        Pass what it returns to `new_events` in a transaction, which leaves
+        out the events delivered since
+        """
+        if self.seen is None:
+            return list(events)
+        return self.seen.diff(events, stop_after)
+
+    def mark_delivered(self, events):
+        """ Record events as delivered so that they are not returned again """
+        for evt in events:
+            if getattr(evt, 'ident', None) is not None:
+                self.seen.add(evt.ident, evt.version)
+
+    def missed(self, now):
+        """ Whether an occurrence after `last_run` came due at or before ``now`` """
+        if self.last_run is None:
+            return False
+        due = self.after(self.last_run)
+        return due is not None and due <= now
 
     @property
     def start(self):
-        return self.sched.dtstart
+        # Rules placed by `.placement.SchedulePlacer` have a dtstart attribute,
+        # but ones straight from rrulestr only have the private one
+        return getattr(self.sched, 'dtstart', self.sched._dtstart)
 
-    @property
-    def after(self):
-        return self.sched.after
+    def after(self, dt, inc=False):
+        """
+        Returns the first occurrence after ``dt``, or at ``dt`` if ``inc`` is
+        true, the same as ``self.sched.after`` would
+        """
+        rule = self.cursor
+        if rule is None or dt < rule._dtstart:
+            rule = self.sched
+        return rule.after(dt, inc)
+
+    def rebase(self, dt):
+        """
+        Move `cursor` up to the last occurrence at or before ``dt``
+
+        Occurrences are found by iterating forward from the start of the rule,
+        so this keeps the cost of `after` from growing with the age of the
+        schedule. The moved rule has the same occurrences from there on: its
+        ``COUNT``, if any, is reduced by the occurrences passed over, and the
+        parts of the rule which default to fields of the start, like the time of
+        day, are the same at every occurrence.
+        """
+        base = self.cursor or self.sched
+        if not isinstance(base, rrule):
+            return
+        last = None
+        for i, occ in enumerate(base):
+            if occ > dt:
+                break
+            last, passed = occ, i
+        if last is None or last == base._dtstart:
+            return
+        count = base._count
+        if count is not None:
+            count -= passed
+        self.cursor = base.replace(dtstart=last, count=count)
 
 
 class SearchScheduler(Persistent):
     """ Schedules searches to be performed at regular intervals """
 
-    def add_schedule(self, query, sched, handler):
-        """ add a search schedule for the given query """
+    def add_schedule(self, query, sched, handler, others=(), placements=None):
+        """
+        add a search schedule for the given query
+
+        Parameters
+        ----------
+        query : Query
+        sched : dateutil.rrule.rrule
+        handler : EventHandler
+        others : iterable of SearchSchedule, optional
+            Schedules from other schedulers to spread this one's runs away from
+        placements : .placement.PlacementIndex, optional
+            Counts of all of the stored schedules to spread this one's runs
+            away from instead of this scheduler's own. The added schedule is
+            counted in it
+
+        Returns
+        -------
+        SearchSchedule
+            The added schedule, which may start later than ``sched`` if
+            ``sched`` is loosely specified. See `.placement.SchedulePlacer`
+        """
 
 
-def query_event(now, scheduler, search_sched, event_handler, priority=0):
+def query_event(now, scheduler, search_sched, event_handler, priority=0, active=None,
+                catch_up=False):
+    """
+    Put the next run of the search schedule at or after ``now`` on the
+    scheduler's timer queue. Each run puts the one after it on the queue
+
+    Parameters
+    ----------
+    active : callable, optional
+        Called when a run comes due. If it returns false, the run is dropped
+        and no more are scheduled
+    catch_up : bool, optional
+        Instead, put one run for all of the occurrences missed since the
+        schedule's `~SearchSchedule.last_run` on the scheduler's
+        `~.scheduling.CatchUpBacklog`. The run searches from the schedule's
+        watermark, so it covers the whole time missed
+    """
     def run():
-        response = search_sched.query.execute()
-        for evt in response.events():
-            event_handler(evt)
-        now = datetime.now()
-        query_event(now, scheduler, search_sched, event_handler, priority)
-    delay = search_sched.after(now, inc=True) - now
-    print('delay is', delay)
-    scheduler.enter(delay.total_seconds(), priority, run, ())
+        if active is not None and not active():
+            return
+        # The schedule may have been loaded by another thread's connection
+        with scheduler.transaction():
+            local_sched = scheduler.local(search_sched)
+            local_handler = scheduler.local(event_handler)
+            query = local_sched.query
+            channel = getattr(local_handler, 'channel', None)
+        with tracing.trace('search.run', target=query.target,
+                           query=getattr(query, 'search_query', None),
+                           channel=channel):
+            run_once(local_sched, local_handler)
+
+    def run_once(search_sched, event_handler):
+        try:
+            search(search_sched, event_handler)
+        except Exception:
+            L.error('Failed to run the search for %r. Trying again at its next run',
+                    getattr(search_sched.query, 'search_query', search_sched.query),
+                    exc_info=True)
+        finally:
+            # The next run is only put on the queue here, so a failed run
+            # mustn't stop the schedule
+            query_event(scheduler.now(), scheduler, search_sched, event_handler,
+                        priority, active)
+
+    def search(search_sched, event_handler):
+        started = scheduler.now()
+        if next_run is not None and not catch_up:
+            SCHEDULER_LAG.observe(max(0, (started - next_run).total_seconds()))
+        SEARCH_RUNS.inc(target=search_sched.query.target or type(search_sched.query).__name__)
+        with tracing.span('query.execute'):
+            response = scheduler.execute(search_sched.query, since=search_sched.watermark)
+        # Read the results, fetching more pages as needed, before beginning
+        # the transaction, so that it isn't held open waiting on the search.
+        # Stop reading once a page worth of results in a row have all been
+        # delivered before
+        with tracing.span('response.events'):
+            candidates = search_sched.unseen_events(
+                response.events(),
+                stop_after=getattr(search_sched.query, 'page_size', None))
+        # Other threads' connections may write to the same objects at once,
+        # so transactions are tried again after conflicts
+        for attempt in scheduler.attempts():
+            with attempt:
+                store = scheduler.local(getattr(scheduler, 'publications', None))
+                events = search_sched.new_events(candidates)
+                if store is not None:
+                    store.add_entries(getattr(response, 'entries', ()))
+        delivered = []
+        handler_name = type(event_handler).__name__
+        try:
+            with HANDLER_SECONDS.time(handler=handler_name), \
+                    tracing.span('handler.handle_all', handler=handler_name, events=len(events)):
+                event_handler.handle_all(events, delivered)
+        finally:
+            EVENTS_DELIVERED.inc(len(delivered), handler=handler_name)
+            now = scheduler.now()
+            for attempt in scheduler.attempts():
+                with attempt:
+                    search_sched.mark_delivered(delivered)
+                    if store is not None:
+                        for evt in delivered:
+                            if getattr(evt, 'ident', None) is not None:
+                                store.record_delivery(now, evt.ident,
+                                                      search_sched.query.search_query)
+                    if len(delivered) == len(events):
+                        search_sched.advance_watermark(response)
+                    search_sched.last_run = started
+                    search_sched.rebase(now)
+    if catch_up:
+        next_run = search_sched.after(search_sched.last_run)
+        L.debug('Catching up on %r from %s', search_sched.query, next_run)
+        scheduler.backlog.put(run, key=getattr(event_handler, 'channel', None))
+        return run
+    next_run = search_sched.after(now, inc=True)
+    if next_run is None:
+        return run
+    delay = next_run - now
+    L.debug('Running %r again in %s', search_sched.query, delay)
+    scheduler.enter(delay.total_seconds(), priority, run, (),
+                    key=getattr(event_handler, 'channel', None))
     return run
 
 
@@ -243,85 +927,285 @@ class EventHandler(Persistent):
     """ Handles events, yo """
 
     def __call__(self, event):
-        print("Handling event", event)
+        L.debug('Handling event %s', event)
+
+    def handle_all(self, events, delivered):
+        """
+        Handle the events from one run, appending each one to ``delivered``
+        once it has been handled
+        """
+        for evt in events:
+            with tracing.span('handler.call'):
+                self(evt)
+            delivered.append(evt)
 
     def __eq__(self, o):
         return type(self) is type(o)
 
 
 class SlackMessageEventHandler(EventHandler):
-    def __init__(self, channel, requester, **kwargs):
+    digest = False
+
+    def __init__(self, channel, requester, digest=False, **kwargs):
+        """
+        Parameters
+        ----------
+        channel : str
+            The Slack channel to post to
+        requester : str
+            The Slack user who asked for the messages
+        digest : bool, optional
+            If true, the events from one run are posted together in as few
+            messages as will fit, with any overflow in a thread under the first
+        """
         super(SlackMessageEventHandler, self).__init__(**kwargs)
         self.channel = channel
+        self.digest = digest
     slack_api_key = volprop('slack_api_key',
                             lambda: os.environ.get('SLACK_API_KEY'))
 
     def __call__(self, event):
         mfrag = event.msg_format(SlackMessageContent)
-        send_message(self.slack_api_key,
-                     self.channel,
-                     mfrag.render())
+        if outbound is not None:
+            outbound.put(self.channel, [mfrag.render()])
+        else:
+            send_message(self.slack_api_key,
+                         self.channel,
+                         mfrag.render())
+
+    def handle_all(self, events, delivered):
+        if not self.digest:
+            return super(SlackMessageEventHandler, self).handle_all(events, delivered)
+        if not events:
+            return
+        texts = [evt.msg_format(SlackMessageContent).render() for evt in events]
+        header = '{} publication{}:'.format(len(texts), '' if len(texts) == 1 else 's')
+        chunks = digest_chunks(header, texts, DIGEST_MAX_CHARS)
+        messages = ['\n\n'.join(texts[i] if i >= 0 else header for i in chunk)
+                    for chunk in chunks]
+        if outbound is not None:
+            outbound.put(self.channel, messages)
+            delivered.extend(events)
+            return
+        thread = None
+        for chunk, message in zip(chunks, messages):
+            resp = send_message(self.slack_api_key, self.channel, message, thread)
+            if thread is None and resp is not None:
+                thread = resp.get('ts')
+            delivered.extend(events[i] for i in chunk if i >= 0)
+
+
+DIGEST_MAX_CHARS = 3500
+""" The most characters to put in one digest message. Slack truncates long ones """
+
+
+def digest_chunks(header, texts, max_chars):
+    """
+    Group the texts, in order, into as few messages as fit in ``max_chars``,
+    the first starting with the header
+
+    Returns
+    -------
+    list of list of int
+        The indices of the texts in each message, where ``-1`` stands for the
+        header. A text which is too long on its own gets a message to itself
+    """
+    chunks = [[-1]]
+    size = len(header)
+    for i, body in enumerate(texts):
+        if size + 2 + len(body) > max_chars:
+            chunks.append([])
+            size = -2
+        chunks[-1].append(i)
+        size += 2 + len(body)
+    return chunks
+
+
+def new_schedule_id():
+    """
+    A key for a new schedule in a `ListSearchScheduler`. Keys sort in the
+    order they were made, and keys made at once by different processes differ
+    """
+    return '{:020d}-{}'.format(time_ns(), uuid4().hex[:12])
 
 
 class ListSearchScheduler(SearchScheduler):
+    """
+    Runs the search schedules for one channel
+
+    Schedules are kept in a BTree keyed by schedule ID, so adding one writes
+    a bucket of the tree rather than the whole collection, and adds from
+    different processes go into different keys. Schedules which the running
+    scheduler hasn't put on its timer queue yet are queued by ID in a
+    `.persistence_utils.MergingQueue`, which merges the web process's appends
+    with the scheduler's takes instead of conflicting.
+    """
+
+    _schedules = None
+
     def __init__(self, sched_list=None, **kwargs):
         super(ListSearchScheduler, self).__init__(**kwargs)
-        if sched_list is None:
-            sched_list = []
-        self._list = PersistentList(sched_list)
-        self._unhandled_list = PersistentList([])
+        self._schedules = OOBTree()
+        """ schedule ID -> (SearchSchedule, handler) """
+        self._count = Length()
+        self._pending = MergingQueue()
+        """ IDs of schedules added but not yet put on the timer queue """
         self.should_run = True
-        self.add_poll_delay = 1 # second
+        for search_sched, handler in (sched_list or ()):
+            self.insert(search_sched, handler)
+
+    def upgrade(self):
+        """
+        Move the schedules of a scheduler stored before they were kept in
+        BTrees, in two PersistentLists, into the BTrees. This is done once for
+        all of the stored schedulers when the engine starts; see
+        `.scheduling.SchedulerEngine.upgrade_schedulers`
+        """
+        # The IDs given to the schedules are the same each time, so that
+        # upgrading in a transaction which is then aborted is harmless
+        if self._schedules is not None:
+            return
+        schedules = OOBTree()
+        ids = dict()
+        for i, entry in enumerate(self.__dict__.pop('_list', ())):
+            ids[id(entry[0])] = sid = '{:020d}-{:012d}'.format(0, i)
+            schedules[sid] = tuple(entry)
+        self._schedules = schedules
+        self._count = Length(len(ids))
+        self._pending = MergingQueue(ids[id(s)] for s, _ in
+                                     self.__dict__.pop('_unhandled_list', ())
+                                     if id(s) in ids)
+        self._p_changed = True
+
+    def __len__(self):
+        return self._count()
 
     def __eq__(self, o):
-        return self._list == o._list
+        return list(self.items()) == list(o.items())
 
     timefunc = volprop('timefunc', lambda: time)
     delayfunc = volprop('delayfunc', lambda: sleep)
     sched = volprop('sched')
-    thread = volprop('thread')
+    owns_sched = volprop('owns_sched', lambda: False)
     is_running = volprop('is_running', lambda: False)
+    active = volprop('active')
+    """
+    Returns whether searches put on the timer queue by the current `run`
+    should still fire. See `query_event`
+    """
 
-    def add_schedule(self, query, sched, handler):
-        search_sched = SearchSchedule(query, sched)
-        self._list.append((search_sched, handler))
-        self._unhandled_list.append((search_sched, handler))
-        # self.send_event(ScheduleAddedEvent(search_sched, handler))
-
-    def run(self):
-        self.sched = scheduler(self.timefunc, self.delayfunc)
+    placer = SchedulePlacer()
 
-        for s, handler in self._list:
-            query_event(datetime.now(), self.sched, s, handler)
+    def items(self):
+        """ Yields (SearchSchedule, handler) for each schedule, in the order they were added """
+        return iter(self._schedules.values())
 
-        def handle_adds():
-            while len(self._unhandled_list) > 0:
-                s, handler = self._unhandled_list.pop(0)
-                query_event(s.start, self.sched, s, handler)
+    def schedules(self):
+        return (s for s, _ in self.items())
 
-            self.sched.enter(self.add_poll_delay, 0, handle_adds, ())
+    def insert(self, search_sched, handler):
+        """
+        Store a schedule without queueing it to be put on the timer queue
+        while running. It's run from the next `run`
 
-        handle_adds()
+        Returns
+        -------
+        str
+            The schedule's ID
+        """
+        sid = new_schedule_id()
+        self._schedules[sid] = (search_sched, handler)
+        self._count.change(1)
+        return sid
+
+    def add_schedule(self, query, sched, handler, others=(), placements=None):
+        existing = others if placements is not None else chain(self.schedules(), others)
+        sched = self.placer.place(sched, sched.dtstart, query.coalesce_key(), existing,
+                                  placements)
+        search_sched = SearchSchedule(query, sched)
+        self._pending.append(self.insert(search_sched, handler))
+        if placements is not None:
+            placements.add(search_sched)
+        if self.is_running:
+            # Adds made in another connection are signalled by the engine when
+            # they're committed. See `.scheduling.SchedulerEngine.watch`
+            self.sched.submit(self.handle_adds)
+        return search_sched
+
+    def handle_adds(self):
+        """ Put schedules added since the last call on the engine's timer queue """
+        with self.sched.scheduler_transaction():
+            for sid in self._pending.take():
+                entry = self._schedules.get(sid)
+                if entry is None:
+                    continue
+                s, handler = entry
+                # A schedule starting at the time it was asked for is already
+                # a little in the past, but it should still run right away
+                query_event(min(self.sched.now(), s.start), self.sched, s, handler,
+                            active=self.active)
+
+    def run(self, engine=None):
+        """
+        Put this scheduler's searches on the given engine's timer queue
 
-        def runner():
-            while self.should_run:
-                self.is_running = True
-                try:
-                    self.sched.run()
-                except Exception:
-                    L.error("Got an exception while running scheduler: ",
-                            exc_info=True)
-            self.is_running = False
-        self.thread = Thread(target=runner)
-        self.thread.start()
+        Parameters
+        ----------
+        engine : .scheduling.SchedulerEngine, optional
+            The process-wide engine to run searches on. If not given, a
+            private engine using `timefunc` and `delayfunc` is started
+        """
+        if engine is None:
+            from .scheduling import SchedulerEngine
+            engine = SchedulerEngine(max_workers=1,
+                                     timefunc=self.timefunc,
+                                     delayfunc=self.delayfunc)
+            engine.start()
+            setvol(self, 'owns_sched', True)
+        setvol(self, 'sched', engine)
+        # Searches queued by an earlier run, which may not have come due yet,
+        # are dropped rather than run alongside this run's. The token is kept
+        # apart from this object, which only the thread loading the engine's
+        # schedulers may touch
+        self._cancel_run()
+        token = threading.Event()
+        token.set()
+        setvol(self, 'run_token', token)
+        setvol(self, 'active', lambda: token.is_set() and engine.may_fire(self))
+
+        # Runs missed while no process ran this scheduler are made up in one
+        # catch-up run per schedule, released gradually. See
+        # `.scheduling.CatchUpBacklog`
+        with self.sched.scheduler_transaction():
+            now = self.sched.now()
+            pending = set(self._pending)
+            for sid, (s, handler) in self._schedules.items():
+                if sid not in pending:
+                    query_event(now, self.sched, s, handler, active=self.active,
+                                catch_up=s.missed(now))
+
+        setvol(self, 'is_running', True)
+        self.sched.watch(self._pending)
+        self.handle_adds()
+
+    def _cancel_run(self):
+        token = getattr(self, '_v_run_token', None)
+        if token is not None:
+            token.clear()
+        setvol(self, 'run_token', None)
 
     def stop(self):
-        if self.sched:
-            while not self.sched.empty():
-                for evt in self.sched.queue:
-                    self.sched.cancel(evt)
-        if self.thread:
-            self.thread.join()
+        setvol(self, 'is_running', False)
+        self._cancel_run()
+        if self.sched and self.owns_sched:
+            self.sched.stop()
+
+    def _p_deactivate(self):
+        # The engine's state is kept in volatile attributes, which the
+        # connection's cache would throw away by making a running scheduler
+        # a ghost
+        if not self.is_running:
+            super(ListSearchScheduler, self)._p_deactivate()
 
 
 class User(object):
@@ -336,20 +1220,61 @@ class SlackUser(User):
         self.time_zone = slack_ob['tz']
 
 
+SLACK_CLIENTS = dict()
+""" Shared Slack clients, by token """
+
+outbound = None
+"""
+The `.outbox.SlackSender` which handlers queue messages with, if there is one.
+Otherwise, they post messages themselves
+"""
+
+event_queue = None
+"""
+The `.inbox.SlackEventQueue` which `slack_events` hands events to, if there is
+one. Otherwise, events are handled before responding
+"""
+
+_slack_clients_lock = Lock()
+
+
+def get_slack_client(token):
+    """ Returns the Slack client shared by everything using the given token """
+    with _slack_clients_lock:
+        client = SLACK_CLIENTS.get(token)
+        if client is None:
+            client = SLACK_CLIENTS[token] = slack.WebClient(token=token)
+        return client
+
+
 def send_message(api_key_or_client, channel, s, thread=None):
-    if isinstance(api_key, str):
-        sc = slack.WebClient(token=api_key)
+    if isinstance(api_key_or_client, str):
+        sc = get_slack_client(api_key_or_client)
     else:
         sc = api_key_or_client
 
-    sc.api_call('chat.postMessage',
-                channel=channel,
-                text=s,
-                **{'thread_ts': x for x in (thread,) if thread})
-
-
-SEARCH_TARGETS = {'Arxiv': {'query_type': ArxivQuery},
-                  'PubMed': {'query_type': PubmedQuery}}
+    try:
+        with SLACK_POST_SECONDS.time(), tracing.span('send_message', channel=channel):
+            return sc.api_call('chat.postMessage',
+                               channel=channel,
+                               text=s,
+                               **{'thread_ts': x for x in (thread,) if thread})
+    except Exception:
+        SLACK_POST_ERRORS.inc()
+        raise
+
+
+# ``rate`` is requests per second and ``burst`` is how many may be made at once
+# before being held to that rate. arXiv asks for one request every three
+# seconds and NCBI allows three per second without an API key, and ten with one.
+# NCBI counts requests in any one second, so PubMed requests are spaced out
+# rather than let through in bursts
+NCBI_RATE = 10 if NCBI_API_KEY else 3
+SEARCH_TARGETS = {'Arxiv': {'query_type': ArxivQuery, 'rate': 1 / 3, 'burst': 1},
+                  'PubMed': {'query_type': PubmedQuery, 'rate': NCBI_RATE, 'burst': 1}}
+
+fetching.rate_limiters.update((name, TokenBucket(t['rate'], t['burst']))
+                              for name, t in SEARCH_TARGETS.items())
 
 SEARCH_TARGET_NAMES = list(SEARCH_TARGETS.keys())
 AND_OR_COMMA_RGX_STR = r'(\s*,?\s+and\s+|\s*,\s*)'
@@ -363,6 +1288,30 @@ MSG_RGX = re.compile(MSG_RGX_STR, flags=re.VERBOSE | re.IGNORECASE)
 
 SCHEDULER_KEY = 'search_scheduler'
 HANDLER_KEY = 'event_handler'
+SCHEDULER_COUNT_KEY = 'search_scheduler_count'
+"""
+A `BTrees.Length.Length` of ``root[SCHEDULER_KEY]``. It's changed whenever a
+scheduler is added, unlike the BTree itself once it has more than one bucket,
+so engines watch it for new schedulers
+"""
+
+
+def prepare_root(root):
+    """
+    Make the mappings of schedulers and event handlers in the app root if they
+    aren't there yet, turning ones saved by older versions as
+    ``PersistentDict`` into BTrees
+
+    The engine does this when it starts, so that events for new channels only
+    add keys to the BTrees, which merge adds to different keys, rather than
+    all writing the root or one ``PersistentDict``
+    """
+    for key in (SCHEDULER_KEY, HANDLER_KEY):
+        mapping = root.get(key)
+        if not isinstance(mapping, OOBTree):
+            root[key] = OOBTree(dict(mapping or {}))
+    if SCHEDULER_COUNT_KEY not in root:
+        root[SCHEDULER_COUNT_KEY] = Length(len(root[SCHEDULER_KEY]))
 
 
 def get_potential_targets(request):
@@ -375,12 +1324,58 @@ def slack_api(request):
 
 
 def slack_events(request):
+    with tracing.trace('slack_events'):
+        return _slack_events(request)
+
+
+def _slack_events(request):
     bod = request.json_body
     bot_token = os.environ.get('SLACK_BOT_TOKEN')
     if bod['token'] != bot_token:
         return Response(status=304)
 
+    if event_queue is not None:
+        # Slack retries events which aren't answered within three seconds, so
+        # the work is left to the queue's workers
+        event_queue.put(bod, get_potential_targets(request),
+                        digest=asbool(request.registry.settings.get('slack.digest', False)))
+        return Response('')
+
     evt = bod['event']
+    retry_count = request.headers.get('X-Slack-Retry-Num')
+    if retry_count is not None and int(retry_count) > 0:
+        thread = evt['ts']
+    else:
+        thread = None
+
+    digest = asbool(request.registry.settings.get('slack.digest', False))
+    reply = handle_message_event(request.context, evt, get_potential_targets(request),
+                                 digest=digest)
+    slack_client = get_slack_client(os.environ.get('SLACK_API_KEY'))
+    send_message(slack_client, evt['channel'], reply, thread)
+    return Response('')
+
+
+def handle_message_event(root, evt, potential_targets, digest=False):
+    """
+    Add the searches asked for in a Slack message event
+
+    Parameters
+    ----------
+    root : MutableMapping
+        The application root, where schedulers and event handlers are stored
+    evt : dict
+        The ``event`` from Slack's event callback
+    potential_targets : list of str
+        The search targets available to the requester
+    digest : bool
+        Whether new event handlers post one digest per run
+
+    Returns
+    -------
+    str
+        The reply to send to the requester
+    """
     msg = evt['text']
     channel = evt['channel']
     user = evt['user']
@@ -389,15 +1384,8 @@ def slack_events(request):
         user_ts = edited['ts']
     else:
         user_ts = evt['ts']
-    print(user_ts)
-    retry_count = request.headers.get('X-Slack-Retry-Num')
-    if retry_count is not None and int(retry_count) > 0:
-        thread = evt['ts']
-    else:
-        thread = None
+    L.debug('Handling a message sent at %s', user_ts)
 
-    slack_api_key = os.environ.get('SLACK_API_KEY')
-    slack_client = slack.WebClient(token=slack_api_key)
     user_ts = float(user_ts)
     # Parsing natural language with regex...we can add a context free grammar later...
     md = MSG_RGX.search(msg)
@@ -405,9 +1393,8 @@ def slack_events(request):
         tgts = re.split(AND_OR_COMMA_RGX_STR, md.group('targets'))
         found_tgts = []
         query_str = md.group('query')
-        # A list of available targets for this requester, a subset of all
-        # possible targets (those in the message regex)
-        potential_targets = get_potential_targets(request)
+        # ``potential_targets`` is a subset of all possible targets (those in
+        # the message regex)
         for t in tgts:
             for s in potential_targets:
                 if s.lower() == t.lower():
@@ -424,45 +1411,44 @@ def slack_events(request):
             sched_str = 'daily'
         rrule_str = sched.parse(sched_str)
         if rrule_str:
-            schedule = rrulestr(rrule_str)
+            schedule = rrulestr(rrule_str, dtstart=user_now)
             schedule.dtstart = user_now
+            # TODO: Make this logic also account for per-user schedule requests,
+            # org-level event handlers and storage
+            key = ('slack_channel', channel)
+            # TODO: Use a remote search scheduler and event handler
+            prepare_root(root)
+
+            if key not in root[SCHEDULER_KEY]:
+                root[SCHEDULER_KEY][key] = ListSearchScheduler()
+                root[SCHEDULER_COUNT_KEY].change(1)
+
+            if key not in root[HANDLER_KEY]:
+                root[HANDLER_KEY][key] = SlackMessageEventHandler(channel, user, digest=digest)
+
+            scheduler = root[SCHEDULER_KEY][key]
+            event_handler = root[HANDLER_KEY][key]
+
+            # The index of every stored schedule's runs is kept up to date as
+            # schedules are added, so that the other schedulers aren't loaded
+            if PLACEMENTS_KEY not in root:
+                root[PLACEMENTS_KEY] = PlacementIndex(ListSearchScheduler.placer.slot)
+            added = [scheduler.add_schedule(q, schedule, event_handler,
+                                            placements=root[PLACEMENTS_KEY])
+                     for q in queries]
+            next_run = min((s.after(user_now, inc=True) for s in added), default=None)
             reply = ('OK, <@{}>, I will search for "{}" on {} with a schedule of "{}". '
                      'The next query will be at {}')
             reply = reply.format(user,
                                  query_str,
                                  ", ".join(found_tgts),
                                  str(rrule_str),
-                                 schedule.after(user_now))
-
-            # TODO: Make this logic also account for per-user schedule requests,
-            # org-level event handlers and storage
-            key = ('slack_channel', channel)
-            if SCHEDULER_KEY not in request.context:
-                # TODO: Put this in a different place and use a remote search scheduler
-                request.context[SCHEDULER_KEY] = PersistentDict()
-
-            if key not in request.context[SCHEDULER_KEY]:
-                request.context[SCHEDULER_KEY][key] = ListSearchScheduler()
-
-            if HANDLER_KEY not in request.context:
-                # TODO: Put this in a different place and use a remote event handler
-                request.context[HANDLER_KEY] = PersistentDict()
-
-            if key not in request.context[HANDLER_KEY]:
-                request.context[HANDLER_KEY][key] = SlackMessageEventHandler(channel, user)
-
-            scheduler = request.context[SCHEDULER_KEY][key]
-            event_handler = request.context[HANDLER_KEY][key]
-
-            for q in queries:
-                scheduler.add_schedule(q, schedule, event_handler)
+                                 next_run)
         else:
             reply = f'Sorry, <@{user}>, but I don\'t understand this search schedule: {sched_str}'
     else:
         reply = f'Sorry, <@{user}>, I don\'t know about that'
-
-    send_message(slack_client, evt['channel'], reply, thread)
-    return Response('')
+    return reply
 
 
 if __name__ == '__main__':
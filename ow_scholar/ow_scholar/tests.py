@@ -3,15 +3,67 @@ from unittest.mock import MagicMock, patch, DEFAULT
 
 import random
 from pyramid import testing
-from .slack_bot import slack_events, EventHandler, ListSearchScheduler
+from .slack_bot import (slack_events, EventHandler, ListSearchScheduler,
+                        ArxivQuery, ArxivQueryResponse, PubmedQuery,
+                        ArxivPublicationEvent, PubmedPublicationEvent,
+                        SearchSchedule, query_event,
+                        SlackMessageEventHandler, SlackMessageContent,
+                        UnicodeStringContent, HtmlContent)
 from . import slack_bot
+from .rendering import RenderCache
+from .simulation import Simulation, SimulatedResponse
+from .bench import Benchmark, PubmedStandIn, percentile
+from . import metrics
+from . import tracing
+from .models import appmaker
+from .scheduling import SchedulerEngine, QueryCoalescer
+from . import scheduling
+from .leases import LeaseKeeper, LeaseTable
+from . import run_schedulers
+from .seen import SeenIndex
+from .persistence_utils import MergingQueue
+from .atom import format_arxiv_feed, iter_arxiv_feed, parse_arxiv_feed
+from .pubmed import (format_pubmed_articles, iter_pubmed_articles, parse_esearch,
+                     ESearchError)
+from .fetching import FetchResponse
+from .http_cache import ResponseCache
+from .ratelimit import TokenBucket, FairQueue
+from . import fetching
+from .placement import SchedulePlacer, PlacementIndex, PLACEMENTS_KEY
+from .outbox import SlackSender, MAX_ATTEMPTS, LEASE_SECONDS
+from .inbox import SlackEventQueue, PROCESSED_EVENTS_KEY
+from . import inbox
+from .percolator import (ArxivPercolator, EntryIndex, parse_query, QuerySyntaxError,
+                         detect_keywords)
+from .pubstore import PublicationStore
+from . import pubstore
 import re
 import tempfile
+import threading
+import time
 
 from zodburi import resolve_uri
 from ZODB.DB import DB
+from ZODB.POSException import ConflictError
 from persistent.dict import PersistentDict
+from persistent.list import PersistentList
 import transaction
+import json
+import os
+from datetime import datetime, timedelta
+from dateutil.rrule import rrulestr
+
+with open(os.path.join(os.path.dirname(__file__), 'arxiv.json')) as f:
+    ARXIV_RESPONSE = json.load(f)
+ENTRY = ARXIV_RESPONSE['entries'][0]
+
+
+class RecordingHandler(EventHandler):
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
 
 
 class Matches(object):
@@ -31,6 +83,27 @@ class Matches(object):
         return f'Matches({self.rgx.pattern!r})'
 
 
+def store_schedulers(db, n):
+    """ Store ``n`` empty schedulers, for channels named by number """
+    conn = db.open()
+    root = appmaker(conn.root())
+    root[slack_bot.SCHEDULER_KEY] = PersistentDict()
+    for i in range(n):
+        root[slack_bot.SCHEDULER_KEY][('slack_channel', str(i))] = ListSearchScheduler()
+    transaction.commit()
+    conn.close()
+
+
+def wait_for(cond, timeout=5):
+    """ Whether ``cond()`` became true within ``timeout`` seconds """
+    deadline = time.time() + timeout
+    while not cond():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
 class Contains(object):
     def __init__(self, s):
         self.s = s
@@ -62,14 +135,16 @@ class ViewTests(unittest.TestCase):
     def setUp(self):
         self.mock_os = self.patch_object(slack_bot, 'os')
         self.mock_slack = self.patch_object(slack_bot, 'slack').WebClient
+        slack_bot.SLACK_CLIENTS.clear()
         self.config = testing.setUp()
         self.bot_token = 'bottok'
         self.mock_os.environ = {'SLACK_API_KEY': 'key', 'SLACK_BOT_TOKEN': self.bot_token}
         self.uname = 'Uh092hp20h'
         request = MagicMock()
         request.headers = {}
-        request.json_body = {'token': self.bot_token,
-                'event': {'text': 'blah', 'ts': '1.0', 'user': self.uname, 'channel': 'chan'}}
+        request.json_body = {
+            'token': self.bot_token,
+            'event': {'text': 'blah', 'ts': '1.0', 'user': self.uname, 'channel': 'chan'}}
         self.mock_request = request
 
     def tearDown(self):
@@ -99,7 +174,6 @@ class ViewTests(unittest.TestCase):
                                                       channel='chan',
                                                       text=Matches('RRULE:.*FREQ=DAILY'))
 
-    @unittest.expectedFailure
     def test_message_daily_at_same_time_spreads_out(self):
         """
         Given a broad specification like 'daily', we can spread out executions
@@ -111,7 +185,62 @@ class ViewTests(unittest.TestCase):
         in time. It should be *ahead* since we still want the first query in
         this schedule to execute soon.
         """
-        self.fail("Not implemented")
+        self.mock_request.context = {}
+        user_now = datetime.utcfromtimestamp(1.0)
+        for i, query in enumerate(('grapes', 'apples')):
+            self.mock_request.json_body['event']['text'] = f'Search for {query} at Arxiv daily'
+            self.mock_request.json_body['event']['channel'] = f'chan{i}'
+            slack_events(self.mock_request)
+        starts = [next(sched.schedules()).start
+                  for sched in self.mock_request.context[slack_bot.SCHEDULER_KEY].values()]
+        self.assertEqual(starts[0], user_now)
+        self.assertGreater(starts[1], user_now)
+        self.assertLess(starts[1] - user_now, timedelta(hours=1))
+
+    def test_identical_daily_queries_share_a_start(self):
+        self.mock_request.context = {}
+        for i in range(3):
+            self.mock_request.json_body['event']['text'] = 'Search for grapes at Arxiv daily'
+            self.mock_request.json_body['event']['channel'] = f'chan{i}'
+            slack_events(self.mock_request)
+        starts = {next(sched.schedules()).start
+                  for sched in self.mock_request.context[slack_bot.SCHEDULER_KEY].values()}
+        self.assertEqual(len(starts), 1)
+
+    def test_fixed_time_schedule_not_moved(self):
+        rule = rrulestr('FREQ=DAILY;BYHOUR=9;BYMINUTE=0', dtstart=datetime(2020, 1, 1))
+        busy = SearchSchedule(ArxivQuery('x'), rrulestr('FREQ=DAILY', dtstart=datetime(2020, 1, 1)))
+        self.assertIs(SchedulePlacer().place(rule, datetime(2020, 1, 1), existing=[busy]), rule)
+
+    def test_placement_index_counts_runs(self):
+        index = PlacementIndex()
+        start = datetime(2020, 1, 1)
+        busy = SearchSchedule(ArxivQuery('x'), rrulestr('FREQ=DAILY', dtstart=start))
+        index.add(busy)
+        self.assertEqual(index.keys(start + timedelta(days=3)), {busy.query.coalesce_key()})
+        self.assertEqual(index.keys(start + timedelta(minutes=1)), set())
+        rule = rrulestr('FREQ=DAILY', dtstart=start)
+        self.assertEqual(SchedulePlacer().place(rule, start, index=index).dtstart,
+                         start + timedelta(minutes=1))
+
+    def test_engine_counts_stored_schedules_once(self):
+        db = DB(None)
+        self.addCleanup(db.close)
+        conn = db.open()
+        root = appmaker(conn.root())
+        scheduler = ListSearchScheduler()
+        rule = rrulestr('FREQ=DAILY', dtstart=datetime(2020, 1, 1))
+        rule.dtstart = datetime(2020, 1, 1)
+        scheduler.add_schedule(ArxivQuery('x'), rule, EventHandler())
+        root[slack_bot.SCHEDULER_KEY] = PersistentDict({('slack_channel', 'c'): scheduler})
+        transaction.commit()
+        conn.close()
+        engine = SchedulerEngine(db)
+        engine.upgrade_schedulers()
+        with engine.transaction() as conn:
+            index = appmaker(conn.root())[PLACEMENTS_KEY]
+            self.assertEqual(index.keys(datetime(2020, 1, 2)), {ArxivQuery('x').coalesce_key()})
+        engine.stop()
 
     def test_message_sent_to_user_at_channel_2(self):
         target = random.choice(slack_bot.SEARCH_TARGET_NAMES)
@@ -177,6 +306,28 @@ class StoreTests(unittest.TestCase):
         root = self.conn.root()
         self.assertEqual(ss, ListSearchScheduler())
 
+    def test_upgrade_ListSearchScheduler_lists(self):
+        root = self.conn.root()
+        a = SearchSchedule(ArxivQuery('grapes'), rrulestr('FREQ=DAILY'))
+        b = SearchSchedule(ArxivQuery('melons'), rrulestr('FREQ=DAILY'))
+        handler = EventHandler()
+        # As stored before schedules were kept in a BTree
+        ss = ListSearchScheduler.__new__(ListSearchScheduler)
+        ss.__setstate__({'_list': PersistentList([(a, handler), (b, handler)]),
+                         '_unhandled_list': PersistentList([(b, handler)]),
+                         'should_run': True})
+        root['sched'] = ss
+        self.reopen()
+        ss = self.conn.root()['sched']
+        ss.upgrade()
+        self.assertEqual(len(ss), 2)
+        self.assertEqual([s.query.search_query for s in ss.schedules()], ['grapes', 'melons'])
+        self.reopen()
+        ss = self.conn.root()['sched']
+        self.assertNotIn('_list', ss.__dict__)
+        self.assertEqual([ss._schedules[sid][0].query.search_query for sid in ss._pending],
+                         ['melons'])
+
     def test_persist_ListSearchScheduler_timefunc(self):
         from time import time
         root = self.conn.root()
@@ -198,3 +349,1730 @@ class StoreTests(unittest.TestCase):
         from time import time
         ss = ListSearchScheduler()
         ss.timefunc = time
+
+
+class SchedulerEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        storage_factory, dbkw = resolve_uri('file://{}/db.zdb'.format(self.tempdir.name))
+        self.db = DB(storage_factory(), **dbkw)
+        self.engine = None
+
+    def tearDown(self):
+        if self.engine:
+            self.engine.stop()
+        self.db.close()
+        self.tempdir.cleanup()
+
+    def test_runs_due_entries_in_order(self):
+        self.engine = SchedulerEngine(max_workers=1)
+        self.engine.start()
+        done = threading.Event()
+        order = []
+        self.engine.enter(0.02, 0, order.append, (2,))
+        self.engine.enter(0.01, 0, order.append, (1,))
+        self.engine.enter(0.03, 0, lambda: (order.append(3), done.set()))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(order, [1, 2, 3])
+
+    def test_new_earlier_entry_wakes_timer(self):
+        self.engine = SchedulerEngine(max_workers=1)
+        self.engine.start()
+        done = threading.Event()
+        self.engine.enter(3600, 0, lambda: None)
+        self.engine.enter(0, 0, done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_one_connection_for_all_schedulers(self):
+        store_schedulers(self.db, 20)
+        before = threading.active_count()
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        self.assertEqual(len(self.engine.schedulers), 20)
+        self.assertTrue(all(s.sched is self.engine for s in self.engine.schedulers))
+        self.assertLessEqual(threading.active_count() - before, 3)
+        self.assertEqual(len({s._p_jar for s in self.engine.schedulers}), 1)
+
+    def add_from_other_connection(self, channel):
+        conn = self.db.open()
+        root = appmaker(conn.root())
+        schedulers = root[slack_bot.SCHEDULER_KEY]
+        key = ('slack_channel', channel)
+        if key not in schedulers:
+            schedulers[key] = ListSearchScheduler()
+        rule = rrulestr('FREQ=DAILY', dtstart=datetime(2100, 1, 1))
+        rule.dtstart = datetime(2100, 1, 1)
+        schedulers[key].add_schedule(ArxivQuery('grapes'), rule, EventHandler())
+        transaction.commit()
+        conn.close()
+
+    def test_idle_schedulers_leave_queue_empty(self):
+        store_schedulers(self.db, 3)
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        self.assertTrue(self.engine.queue.empty())
+
+    def test_idle_engine_not_woken(self):
+        store_schedulers(self.db, 1)
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        with patch.object(self.engine, '_poll') as poll:
+            time.sleep(0.2)
+        poll.assert_not_called()
+
+    def test_polled_when_asked(self):
+        store_schedulers(self.db, 1)
+        self.engine = SchedulerEngine(self.db, max_workers=2, poll_interval=0.01)
+        self.engine.start()
+        self.engine._unhook_invalidations()
+        self.add_from_other_connection('0')
+        self.assertTrue(wait_for(lambda: len(self.engine.queue.queue) == 1))
+
+    def test_add_from_other_connection_is_signalled(self):
+        store_schedulers(self.db, 1)
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        self.add_from_other_connection('0')
+        self.assertTrue(wait_for(lambda: len(self.engine.queue.queue) == 1))
+
+    def test_new_scheduler_from_other_connection_started(self):
+        store_schedulers(self.db, 0)
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        self.add_from_other_connection('new')
+        self.assertTrue(wait_for(lambda: len(self.engine.schedulers) == 1))
+        self.assertTrue(wait_for(lambda: len(self.engine.queue.queue) == 1))
+
+    def test_running_scheduler_survives_cache_gc(self):
+        store_schedulers(self.db, 1)
+        self.engine = SchedulerEngine(self.db, max_workers=2)
+        self.engine.start()
+        self.engine.scheduler_connection.cacheMinimize()
+        scheduler = self.engine.schedulers[0]
+        self.assertIs(scheduler.sched, self.engine)
+        self.add_from_other_connection('0')
+        self.assertTrue(wait_for(lambda: len(self.engine.queue.queue) == 1))
+
+
+class LeaseTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        storage_factory, dbkw = resolve_uri('file://{}/db.zdb'.format(self.tempdir.name))
+        self.db = DB(storage_factory(), **dbkw)
+        self.now = 1000.0
+        self.engines = []
+        store_schedulers(self.db, 10)
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.stop()
+        self.db.close()
+        self.tempdir.cleanup()
+
+    def worker(self, name):
+        engine = SchedulerEngine(self.db, max_workers=1, timefunc=lambda: self.now)
+        engine.leases = LeaseKeeper(engine, worker=name, duration=30)
+        engine.start()
+        self.engines.append(engine)
+        return engine
+
+    def step(self, *engines):
+        for engine in engines:
+            engine.leases.step()
+            engine.load_schedulers()
+
+    def keys(self, engine):
+        return {engine._keys[id(s)] for s in engine.schedulers}
+
+    def test_one_worker_takes_all(self):
+        a = self.worker('a')
+        self.assertEqual(a.schedulers, [])
+        self.step(a)
+        self.assertEqual(len(a.schedulers), 10)
+
+    def test_split_between_workers(self):
+        a, b = self.worker('a'), self.worker('b')
+        self.step(a, b)
+        self.assertEqual((len(a.schedulers), len(b.schedulers)), (10, 0))
+        self.now += 10
+        self.step(a, b)
+        # a lets the leases over its share run out, and stops running them
+        self.assertEqual((len(a.schedulers), len(b.schedulers)), (5, 0))
+        self.now += 10
+        self.step(a, b)
+        self.now += 11
+        self.step(a, b)
+        self.assertEqual((len(a.schedulers), len(b.schedulers)), (5, 5))
+        self.assertFalse(self.keys(a) & self.keys(b))
+
+    def test_takeover_when_worker_dies(self):
+        a, b = self.worker('a'), self.worker('b')
+        self.step(a)
+        self.step(b)
+        self.assertEqual(len(b.schedulers), 0)
+        # a stops renewing without giving up its leases
+        self.now += 31
+        self.step(b)
+        self.assertEqual(len(b.schedulers), 10)
+
+    def test_stop_gives_up_leases(self):
+        a, b = self.worker('a'), self.worker('b')
+        self.step(a)
+        self.engines.remove(a)
+        # As a service, the keeper would be stopped by the engine, before its
+        # connection is closed
+        a.leases.stop()
+        a.stop()
+        self.step(b)
+        self.assertEqual(len(b.schedulers), 10)
+
+    def test_no_firing_near_expiry(self):
+        a = self.worker('a')
+        self.step(a)
+        scheduler = a.schedulers[0]
+        active = scheduler.active
+        self.assertTrue(active())
+        self.now += 26
+        self.assertFalse(a.may_fire(scheduler))
+        self.assertFalse(active())
+        a.load_schedulers()
+        self.assertEqual(a.schedulers, [])
+        self.assertFalse(scheduler.is_running)
+
+    def test_restarted_scheduler_drops_earlier_runs(self):
+        a = self.worker('a')
+        self.step(a)
+        scheduler = a.schedulers[0]
+        old = scheduler.active
+        self.now += 26
+        a.load_schedulers()
+        self.step(a)
+        self.assertTrue(any(s is scheduler for s in a.schedulers))
+        self.assertFalse(old())
+        self.assertTrue(scheduler.active())
+
+    def test_dropped_run_not_rescheduled(self):
+        engine = SchedulerEngine(max_workers=1)
+        search_sched = SearchSchedule(ArxivQuery('grapes'),
+                                      rrulestr('FREQ=DAILY', dtstart=datetime(2000, 1, 1)))
+        with patch.object(ArxivQuery, 'execute') as execute:
+            run = query_event(datetime(2000, 1, 1), engine, search_sched, EventHandler(),
+                              active=lambda: False)
+            engine.queue.cancel(engine.queue.queue[0])
+            run()
+        execute.assert_not_called()
+        self.assertTrue(engine.queue.empty())
+
+    def test_conflicting_claims(self):
+        managers = [transaction.TransactionManager() for _ in range(3)]
+        conns = [self.db.open(transaction_manager=managers[0])]
+        appmaker(conns[0].root())['leases'] = LeaseTable()
+        managers[0].commit()
+        conns += [self.db.open(transaction_manager=tm) for tm in managers[1:]]
+        tables = [appmaker(c.root())['leases'] for c in conns[1:]]
+        self.assertTrue(tables[0].claim('k', 'a', self.now, 30))
+        self.assertTrue(tables[1].claim('k', 'b', self.now, 30))
+        managers[1].commit()
+        with self.assertRaises(ConflictError):
+            managers[2].commit()
+        managers[2].abort()
+        self.assertFalse(tables[1].claim('k', 'b', self.now, 30))
+        for c in conns:
+            c.close()
+
+    def test_workers_split_and_take_over(self):
+        settings = {'scheduler.mode': 'worker', 'scheduler.max_workers': '1',
+                    'scheduler.lease_seconds': '0.9', 'scheduler.lease_grace': '0.1'}
+        with patch.object(slack_bot, 'outbound'), patch.object(slack_bot, 'event_queue'):
+            a, b = [run_schedulers(self.db, dict(settings, **{'scheduler.worker_id': w}),
+                                   post=MagicMock())
+                    for w in 'ab']
+            self.engines += [a, b]
+        self.assertTrue(wait_for(lambda: len(a.schedulers) == len(b.schedulers) == 5))
+        self.assertFalse(self.keys(a) & self.keys(b))
+        self.engines.remove(a)
+        a.stop()
+        self.assertTrue(wait_for(lambda: len(b.schedulers) == 10))
+
+    def test_web_mode_runs_no_schedulers(self):
+        with patch.object(slack_bot, 'outbound'), patch.object(slack_bot, 'event_queue'):
+            engine = run_schedulers(self.db, {'scheduler.mode': 'web'}, post=MagicMock())
+            self.engines.append(engine)
+        self.assertEqual(engine.schedulers, [])
+        self.assertIsNone(engine.leases)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            run_schedulers(self.db, {'scheduler.mode': 'both'})
+
+
+class CatchUpTests(unittest.TestCase):
+    def schedule(self, query, days_since_run):
+        now = datetime.now()
+        rule = rrulestr('FREQ=DAILY', dtstart=now - timedelta(days=10))
+        search_sched = SearchSchedule(query, rule)
+        search_sched.last_run = now - timedelta(days=days_since_run)
+        return search_sched
+
+    def test_missed(self):
+        search_sched = self.schedule(ArxivQuery('grapes'), 3)
+        self.assertTrue(search_sched.missed(datetime.now()))
+        self.assertFalse(search_sched.missed(search_sched.last_run))
+        search_sched.last_run = None
+        self.assertFalse(search_sched.missed(datetime.now()))
+
+    def test_missed_runs_collapsed_and_released_gradually(self):
+        engine = SchedulerEngine(max_workers=4, catch_up_concurrency=2)
+        self.addCleanup(engine.stop)
+        engine.start()
+        lock = threading.Lock()
+        calls = []
+        running = [0, 0]
+
+        def execute(query, since=None):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+                calls.append(query.search_query)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return SimulatedResponse(query, [], datetime.now())
+
+        scheduler = ListSearchScheduler()
+        for i in range(5):
+            search_sched = self.schedule(ArxivQuery('grapes {}'.format(i)), 3)
+            scheduler.insert(search_sched, RecordingHandler())
+        before = datetime.now()
+        with patch.object(ArxivQuery, 'execute', autospec=True, side_effect=execute):
+            scheduler.run(engine)
+            self.assertTrue(wait_for(lambda: len(calls) == 5 and engine.backlog.running == 0))
+        # One run for each schedule's three missed days, at most two at once
+        self.assertEqual(sorted(calls), ['grapes {}'.format(i) for i in range(5)])
+        self.assertEqual(running[1], 2)
+        self.assertTrue(all(s.last_run >= before for s in scheduler.schedules()))
+        # Then each goes back to its schedule
+        self.assertEqual(len(engine.queue.queue), 5)
+
+    def test_no_catch_up_when_nothing_missed(self):
+        engine = SchedulerEngine(max_workers=1)
+        scheduler = ListSearchScheduler()
+        search_sched = self.schedule(ArxivQuery('grapes'), 0)
+        search_sched.last_run = datetime.now()
+        scheduler.insert(search_sched, RecordingHandler())
+        scheduler.run(engine)
+        self.assertEqual(len(engine.backlog), 0)
+        self.assertEqual(len(engine.queue.queue), 1)
+
+
+class ConcurrentScheduleAddTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        storage_factory, dbkw = resolve_uri('file://{}/db.zdb'.format(self.tempdir.name))
+        self.db = DB(storage_factory(), **dbkw)
+        self.managers = [transaction.TransactionManager() for _ in range(3)]
+        conn = self.db.open(transaction_manager=self.managers[0])
+        scheduler = ListSearchScheduler()
+        scheduler.insert(SearchSchedule(ArxivQuery('grapes'), rrulestr('FREQ=DAILY')),
+                         EventHandler())
+        scheduler._pending.append('queued')
+        conn.root()['sched'] = scheduler
+        self.managers[0].commit()
+        # Opened after the commit, so that they see it
+        self.conns = [conn] + [self.db.open(transaction_manager=tm) for tm in self.managers[1:]]
+
+    def tearDown(self):
+        for c in self.conns:
+            c.close()
+        self.db.close()
+        self.tempdir.cleanup()
+
+    def scheduler(self, i):
+        return self.conns[i].root()['sched']
+
+    def test_concurrent_adds_merged(self):
+        rule = rrulestr('FREQ=DAILY', dtstart=datetime(2021, 3, 1))
+        rule.dtstart = datetime(2021, 3, 1)
+        added = [self.scheduler(i).add_schedule(ArxivQuery(q), rule, EventHandler())
+                 for i, q in ((1, 'melons'), (2, 'lemons'))]
+        self.managers[1].commit()
+        self.managers[2].commit()
+        self.managers[0].begin()
+        scheduler = self.scheduler(0)
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual([s.query.search_query for s in scheduler.schedules()],
+                         ['grapes', 'melons', 'lemons'])
+        self.assertEqual([scheduler._schedules[sid][0].query.search_query
+                          for sid in list(scheduler._pending)[1:]],
+                         [s.query.search_query for s in added])
+
+    def test_add_merged_with_take(self):
+        self.scheduler(1)._pending.append('added')
+        self.assertEqual(self.scheduler(2)._pending.take(), ('queued',))
+        self.managers[1].commit()
+        self.managers[2].commit()
+        self.managers[0].begin()
+        self.assertEqual(tuple(self.scheduler(0)._pending), ('added',))
+
+    def test_merge_keeps_order_and_drops_repeats(self):
+        queue = MergingQueue()
+        merged = queue._p_resolveConflict({'_items': ('a', 'b')},
+                                          {'_items': ('b', 'c', 'd')},
+                                          {'_items': ('a', 'b', 'd', 'e')})
+        self.assertEqual(merged['_items'], ('b', 'c', 'd', 'e'))
+
+
+class ScheduleCursorTests(unittest.TestCase):
+    RULES = ['FREQ=HOURLY',
+             'FREQ=DAILY;INTERVAL=3',
+             'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,FR',
+             'FREQ=MONTHLY;BYMONTHDAY=31',
+             'FREQ=MONTHLY;BYDAY=MO,TU,WE,TH,FR;BYSETPOS=-1',
+             'FREQ=DAILY;BYHOUR=9,17;BYMINUTE=30',
+             'FREQ=HOURLY;INTERVAL=5;COUNT=200',
+             'FREQ=DAILY;UNTIL=20210301T000000']
+
+    def schedule(self, rule_str, start=datetime(2020, 1, 31, 13, 7)):
+        rule = rrulestr(rule_str, dtstart=start)
+        rule.dtstart = start
+        return SearchSchedule(ArxivQuery('x'), rule)
+
+    def test_same_occurrences_as_rule(self):
+        for rule_str in self.RULES:
+            s = self.schedule(rule_str)
+            t = datetime(2020, 1, 1)
+            for _ in range(20):
+                t += timedelta(hours=random.randint(1, 400))
+                s.rebase(t - timedelta(hours=random.randint(0, 48)))
+                for dt in (t, s.cursor._dtstart if s.cursor else t):
+                    for inc in (True, False):
+                        self.assertEqual(s.after(dt, inc), s.sched.after(dt, inc),
+                                         (rule_str, dt, inc))
+
+    def test_after_does_not_walk_from_start(self):
+        s = self.schedule('FREQ=HOURLY', datetime(2018, 1, 1))
+        now = datetime(2020, 1, 1, 0, 30)
+        s.rebase(now)
+        self.assertEqual(s.cursor._dtstart, datetime(2020, 1, 1))
+        self.assertEqual(len(list(s.cursor.between(s.cursor._dtstart, now, inc=True))), 1)
+        self.assertEqual(s.after(now), datetime(2020, 1, 1, 1))
+
+    def test_rebase_keeps_remaining_count(self):
+        s = self.schedule('FREQ=DAILY;COUNT=10', datetime(2020, 1, 1))
+        s.rebase(datetime(2020, 1, 4, 12))
+        self.assertEqual(list(s.cursor), list(s.sched)[3:])
+        s.rebase(datetime(2021, 1, 1))
+        self.assertIsNone(s.after(datetime(2021, 1, 1)))
+
+
+class QueryCoalescerTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.coalescer = QueryCoalescer(window=60, timefunc=lambda: self.now)
+        patcher = patch.object(ArxivQuery, 'execute')
+        self.execute = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.execute.return_value = ArxivQueryResponse({'entries': [ENTRY]}, None)
+
+    def test_identical_queries_fetch_once(self):
+        for s in ('C. elegans', 'c.  elegans', ' C. Elegans'):
+            self.coalescer.execute(ArxivQuery(s))
+        self.execute.assert_called_once()
+
+    def test_operators_not_case_folded(self):
+        self.assertEqual(ArxivQuery('Worm AND Neuron').coalesce_key(),
+                         ArxivQuery('worm  AND neuron').coalesce_key())
+        self.assertNotEqual(ArxivQuery('worm AND neuron').coalesce_key(),
+                            ArxivQuery('worm and neuron').coalesce_key())
+        self.assertNotEqual(ArxivQuery('worm ANDNOT neuron').coalesce_key(),
+                            ArxivQuery('worm andnot neuron').coalesce_key())
+
+    def test_different_targets_fetch_separately(self):
+        with patch.object(PubmedQuery, 'execute') as pubmed_execute:
+            self.coalescer.execute(ArxivQuery('C. elegans'))
+            self.coalescer.execute(PubmedQuery('C. elegans'))
+        self.execute.assert_called_once()
+        pubmed_execute.assert_called_once()
+
+    def test_fetches_again_after_window(self):
+        self.coalescer.execute(ArxivQuery('C. elegans'))
+        self.now = 61
+        self.coalescer.execute(ArxivQuery('C. elegans'))
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_shared_with_later_watermarks_only(self):
+        q = ArxivQuery('C. elegans')
+        self.coalescer.execute(q, since=datetime(2020, 1, 2))
+        self.coalescer.execute(q, since=datetime(2020, 1, 3))
+        self.execute.assert_called_once()
+        self.coalescer.execute(q, since=datetime(2020, 1, 1))
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_first_page_not_shared_with_watermarks(self):
+        q = ArxivQuery('C. elegans')
+        self.coalescer.execute(q)
+        self.coalescer.execute(q, since=datetime(2020, 1, 1))
+        self.assertEqual(self.execute.call_count, 2)
+        self.execute.assert_called_with(since=datetime(2020, 1, 1))
+        # Subscriptions without a watermark still share the first-page fetch
+        self.coalescer.execute(q)
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_failed_fetch_not_shared(self):
+        self.execute.side_effect = [OSError('down'), self.execute.return_value]
+        with self.assertRaises(OSError):
+            self.coalescer.execute(ArxivQuery('C. elegans'))
+        self.assertIsNotNone(self.coalescer.execute(ArxivQuery('C. elegans')))
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_events_attributed_to_each_subscriber(self):
+        self.coalescer.execute(ArxivQuery('C. elegans'))
+        q = ArxivQuery('c. elegans')
+        evt = next(self.coalescer.execute(q).events())
+        self.assertIs(evt.query, q)
+
+
+class SeenIndexTests(unittest.TestCase):
+    def evt(self, ident, version):
+        return ArxivPublicationEvent(title='t', authors=[], link='l', query=None,
+                                     ident=ident, version=version)
+
+    def test_new(self):
+        idx = SeenIndex()
+        evts = idx.diff([self.evt('a', 1), self.evt('b', 1)])
+        self.assertEqual([e.ident for e in evts], ['a', 'b'])
+        self.assertFalse(any(e.is_update for e in evts))
+
+    def test_seen_dropped(self):
+        idx = SeenIndex()
+        idx.add('a', 1)
+        self.assertEqual(idx.diff([self.evt('a', 1)]), [])
+
+    def test_new_version_is_update(self):
+        idx = SeenIndex()
+        idx.add('a', 1)
+        evts = idx.diff([self.evt('a', 2)])
+        self.assertEqual(len(evts), 1)
+        self.assertTrue(evts[0].is_update)
+        self.assertIn('Updated publication', str(evts[0]))
+
+    def test_bounded(self):
+        idx = SeenIndex(max_size=3)
+        for i in range(5):
+            idx.add(str(i), 1)
+        self.assertEqual(len(idx), 3)
+        self.assertNotIn('0', idx)
+        self.assertIn('4', idx)
+
+    def test_redelivery_refreshes_age(self):
+        idx = SeenIndex(max_size=2)
+        idx.add('a', 1)
+        idx.add('b', 1)
+        idx.add('a', 2)
+        idx.add('c', 1)
+        self.assertIn('a', idx)
+        self.assertNotIn('b', idx)
+
+    def test_filtered_events_left_undecoded(self):
+        resp = ArxivQueryResponse(ARXIV_RESPONSE, ArxivQuery('C. elegans'))
+        idx = SeenIndex()
+        for e in list(resp.events())[1:]:
+            idx.add(e.ident, e.version)
+        events = list(resp.events())
+        new = idx.diff(events)
+        self.assertEqual(len(new), 1)
+        self.assertTrue(all(e._authors is slack_bot._LAZY for e in events))
+        self.assertEqual(new[0].title, ENTRY['title'])
+        self.assertEqual([a.name for a in new[0].authors], [a['name'] for a in ENTRY['authors']])
+
+    def test_events_are_slotted(self):
+        evt = next(ArxivQueryResponse(ARXIV_RESPONSE, ArxivQuery('x')).events())
+        self.assertFalse(hasattr(evt, '__dict__'))
+        self.assertFalse(hasattr(evt.authors[0], '__dict__'))
+
+    def test_query_event_only_delivers_new_papers(self):
+        engine = SchedulerEngine()
+        handler = RecordingHandler()
+        search_sched = SearchSchedule(ArxivQuery('C. elegans'), rrulestr('FREQ=DAILY'))
+        with patch.object(ArxivQuery, 'execute') as execute:
+            execute.side_effect = lambda since=None: ArxivQueryResponse(ARXIV_RESPONSE,
+                                                                        search_sched.query)
+            run = query_event(datetime.now(), engine, search_sched, handler)
+            run()
+            self.assertEqual(len(handler.events), len(ARXIV_RESPONSE['entries']))
+            del handler.events[:]
+            run()
+        self.assertEqual(handler.events, [])
+
+    def test_failed_run_rescheduled(self):
+        engine = SchedulerEngine()
+        handler = RecordingHandler()
+        search_sched = SearchSchedule(ArxivQuery('C. elegans'), rrulestr('FREQ=DAILY'))
+        with patch.object(ArxivQuery, 'execute', side_effect=OSError('down')), \
+                patch.object(slack_bot.L, 'error') as error:
+            run = query_event(datetime.now(), engine, search_sched, handler)
+            self.assertEqual(len(engine.queue.queue), 1)
+            run()
+        error.assert_called_once()
+        self.assertEqual(len(engine.queue.queue), 2)
+
+
+def make_entries(n, newest=datetime(2020, 1, 1)):
+    """ Entries based on the one in arxiv.json, updated a day apart, newest first """
+    entries = []
+    for i in range(n):
+        e = dict(ENTRY)
+        e['id'] = e['link'] = 'http://arxiv.org/abs/2001.{:05d}v1'.format(n - i)
+        e['updated'] = (newest - timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        entries.append(e)
+    return entries
+
+
+class ArxivPagingTests(unittest.TestCase):
+    def setUp(self):
+        self.entries = make_entries(25)
+        self.urls = []
+
+        def fetch(url, **kwargs):
+            from urllib.parse import urlparse, parse_qs
+            self.urls.append(url)
+            args = parse_qs(urlparse(url).query)
+            start, size = int(args['start'][0]), int(args['max_results'][0])
+            body = format_arxiv_feed(self.entries[start:start + size],
+                                     total_results=len(self.entries),
+                                     start_index=start)
+            return FetchResponse(200, {}, body)
+
+        patcher = patch.object(slack_bot, 'fetch', fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = ArxivQuery('C. elegans')
+        self.query.page_size = 10
+
+    def test_first_run_fetches_one_page(self):
+        resp = self.query.execute()
+        self.assertEqual(len(list(resp.events())), 10)
+        self.assertEqual(len(self.urls), 1)
+
+    def test_sorted_by_update_date(self):
+        self.query.execute()
+        self.assertIn('sortBy=lastUpdatedDate', self.urls[0])
+        self.assertIn('sortOrder=descending', self.urls[0])
+
+    def test_pages_until_watermark(self):
+        since = slack_bot.parse_atom_date(self.entries[14]['updated'])
+        resp = self.query.execute(since=since)
+        self.assertEqual(len(list(resp.events())), 15)
+        self.assertEqual(len(self.urls), 2)
+
+    def test_watermark_advances(self):
+        search_sched = SearchSchedule(self.query, rrulestr('FREQ=DAILY'))
+        search_sched.advance_watermark(self.query.execute())
+        self.assertEqual(search_sched.watermark, datetime(2020, 1, 1))
+
+    def test_later_pages_fetched_as_read(self):
+        resp = self.query.execute(since=datetime(2000, 1, 1))
+        self.assertEqual(len(self.urls), 1)
+        events = list(resp.events())
+        self.assertEqual(len(events), 25)
+        self.assertEqual(len(self.urls), 3)
+        self.assertEqual(len(list(resp.with_query(ArxivQuery('other')).events())), 25)
+        self.assertEqual(len(self.urls), 3)
+
+    def test_stops_at_a_page_of_seen_results(self):
+        search_sched = SearchSchedule(self.query, rrulestr('FREQ=DAILY'))
+        resp = self.query.execute(since=datetime(2000, 1, 1))
+        search_sched.mark_delivered(list(resp.events())[:10])
+        del self.urls[:]
+        resp = self.query.execute(since=datetime(2000, 1, 1))
+        self.assertEqual(search_sched.new_events(resp.events(), stop_after=10), [])
+        self.assertEqual(len(self.urls), 1)
+
+    def test_pages_fetched_outside_transactions(self):
+        engine = SchedulerEngine()
+        handler = RecordingHandler()
+        search_sched = SearchSchedule(self.query, rrulestr('FREQ=DAILY'))
+        search_sched.watermark = datetime(2000, 1, 1)
+        depths = []
+        fetch = slack_bot.fetch
+
+        def fetch_recording_depth(url, **kwargs):
+            depths.append(getattr(engine._local, 'depth', 0))
+            return fetch(url, **kwargs)
+        with patch.object(slack_bot, 'fetch', fetch_recording_depth):
+            query_event(datetime.now(), engine, search_sched, handler)()
+        self.assertEqual(len(handler.events), 25)
+        self.assertEqual(depths, [0, 0, 0])
+
+    def test_stream(self):
+        events = self.query.stream(since=datetime(2000, 1, 1))
+        self.assertEqual(self.urls, [])
+        self.assertEqual(next(events).ident, '2001.00025')
+        self.assertEqual(len(list(events)), 24)
+        self.assertEqual(len(self.urls), 3)
+
+    def test_iter_feed_matches_parse(self):
+        body = format_arxiv_feed(self.entries, total_results=100)
+        feed = dict()
+        it = iter_arxiv_feed(body, feed)
+        first = next(it)
+        self.assertEqual(feed['opensearch_totalresults'], '100')
+        self.assertEqual([first] + list(it), parse_arxiv_feed(body)['entries'])
+
+
+def make_articles(n, newest=datetime(2020, 1, 1)):
+    """ PubMed articles, revised a day apart, newest first """
+    articles = []
+    for i in range(n):
+        pmid = str(30000000 + n - i)
+        updated = (newest - timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        articles.append(dict(pmid=pmid, version=1, title='Neurons in C. elegans',
+                             summary='We study <worms> & their neurons.',
+                             updated=updated, published=updated, journal='Genetics',
+                             authors=[dict(name='Ann Smith'), dict(name='Bo Jones')],
+                             tags=[dict(term='Caenorhabditis elegans', scheme='MeSH')]))
+    return articles
+
+
+class PubmedTests(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = PubmedStandIn(make_articles(25)).start()
+        self.addCleanup(self.stand_in.stop)
+        for attr, value in (('EUTILS_URL', self.stand_in.url + '/entrez/eutils/'),
+                            ('NCBI_API_KEY', None)):
+            patcher = patch.object(slack_bot, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        target = slack_bot.SEARCH_TARGETS['PubMed']
+        patcher = patch.dict(fetching.rate_limiters,
+                             {'PubMed': TokenBucket(target['rate'], target['burst'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = PubmedQuery('C. elegans')
+        self.query.batch_size = 10
+
+    def execute(self, since=None):
+        return self.query.execute(since=since)
+
+    def test_first_run_fetches_one_batch(self):
+        resp = self.execute()
+        self.assertEqual(len(list(resp.events())), 10)
+        self.assertEqual(len(self.stand_in.searches), 1)
+        self.assertEqual(len(self.stand_in.fetches), 1)
+
+    def test_search_kept_on_history_server(self):
+        self.execute()
+        search, = self.stand_in.searches
+        self.assertEqual(search['usehistory'], 'y')
+        self.assertEqual(search['retmax'], '0')
+        self.assertEqual(search['term'], 'C. elegans')
+        fetch, = self.stand_in.fetches
+        self.assertEqual(fetch['WebEnv'], 'MCID_1')
+        self.assertEqual(fetch['query_key'], '1')
+        self.assertEqual(fetch['retmode'], 'xml')
+
+    def test_batches_fetched_as_read(self):
+        resp = self.execute(since=datetime(2000, 1, 1))
+        self.assertEqual(len(self.stand_in.fetches), 1)
+        self.assertEqual(len(list(resp.events())), 25)
+        self.assertEqual([(f['retstart'], f['retmax']) for f in self.stand_in.fetches],
+                         [('0', '10'), ('10', '10'), ('20', '5')])
+        self.assertEqual(self.stand_in.searches[0]['mindate'], '2000/01/01')
+        self.assertEqual(self.stand_in.searches[0]['datetype'], 'mdat')
+
+    def test_max_results(self):
+        self.query.max_results = 15
+        resp = self.execute(since=datetime(2000, 1, 1))
+        self.assertEqual(len(list(resp.events())), 15)
+
+    def test_events(self):
+        evt = next(self.execute().events())
+        self.assertIsInstance(evt, PubmedPublicationEvent)
+        self.assertEqual(evt.ident, 'pubmed:30000025')
+        self.assertEqual(evt.version, 1)
+        self.assertEqual(evt.title, 'Neurons in C. elegans')
+        self.assertEqual([a.name for a in evt.authors], ['Ann Smith', 'Bo Jones'])
+        self.assertEqual(evt.link, 'https://pubmed.ncbi.nlm.nih.gov/30000025/')
+        msg = evt.msg_format(SlackMessageContent).frag.render()
+        self.assertIn('<https://pubmed.ncbi.nlm.nih.gov/30000025/|Neurons in C. elegans>', msg)
+        self.assertIn('PubMed Query: ', msg)
+
+    def test_watermark_advances(self):
+        search_sched = SearchSchedule(self.query, rrulestr('FREQ=DAILY'))
+        search_sched.advance_watermark(self.execute())
+        self.assertEqual(search_sched.watermark, datetime(2020, 1, 1))
+
+    def test_query_event_delivers(self):
+        engine = SchedulerEngine(max_workers=1)
+        handler = RecordingHandler()
+        search_sched = SearchSchedule(self.query, rrulestr('FREQ=DAILY;COUNT=1',
+                                                           dtstart=datetime(2000, 1, 1)))
+        query_event(datetime(2000, 1, 1), engine, search_sched, handler)()
+        self.assertEqual(len(handler.events), 10)
+        self.assertIn('pubmed:30000025', search_sched.seen)
+
+    def test_within_rate_limit(self):
+        resp = self.execute(since=datetime(2000, 1, 1))
+        list(resp.events())
+        self.assertEqual(len(self.stand_in.fetches), 3)
+        self.assertEqual(self.stand_in.rate_limited, 0)
+
+    def test_esearch_error(self):
+        with self.assertRaises(ESearchError):
+            parse_esearch(b'<eSearchResult><ERROR>Invalid query</ERROR></eSearchResult>')
+
+    def test_iter_articles(self):
+        articles = make_articles(3)
+        body = (b'<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle//EN" '
+                b'"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n' +
+                format_pubmed_articles(articles).split(b'\n', 1)[1])
+        parsed = list(iter_pubmed_articles(body))
+        self.assertEqual([a['pmid'] for a in parsed], [a['pmid'] for a in articles])
+        self.assertEqual(parsed[0]['id'], 'pubmed:30000003')
+        self.assertEqual(parsed[0]['summary'], articles[0]['summary'])
+        self.assertEqual(parsed[0]['updated'], '2020-01-01T00:00:00Z')
+        self.assertEqual(parsed[0]['tags'], articles[0]['tags'])
+
+    def test_future_dates_not_used_for_updated(self):
+        article = dict(make_articles(1)[0], published='2019-12-01T00:00:00Z')
+        body = format_pubmed_articles([article]).replace(
+            b'</History>',
+            b'<PubMedPubDate PubStatus="pmc-release"><Year>2999</Year></PubMedPubDate></History>')
+        parsed, = iter_pubmed_articles(body)
+        self.assertEqual(parsed['updated'], '2020-01-01T00:00:00Z')
+        body = format_pubmed_articles([dict(article, updated='2999-01-01T00:00:00Z')])
+        parsed, = iter_pubmed_articles(body)
+        self.assertLessEqual(slack_bot.parse_atom_date(parsed['updated']), datetime.utcnow())
+
+    def test_article_without_dates(self):
+        article = dict(make_articles(1)[0], updated=None, published=None)
+        parsed, = iter_pubmed_articles(format_pubmed_articles([article]))
+        self.assertIsNone(parsed['updated'])
+        self.assertIsNone(parsed['published'])
+        store = PublicationStore()
+        self.assertIsNone(store.add_entry(parsed))
+        self.assertEqual(len(store), 0)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.now = 0
+        self.requests = []
+        self.responses = []
+        self.cache = self.make_cache()
+
+    def make_cache(self, **kwargs):
+        return ResponseCache(self.tempdir.name, ttls={'Arxiv': 60},
+                             timefunc=lambda: self.now, **kwargs)
+
+    def fetchfunc(self, url, headers):
+        self.requests.append(headers)
+        if self.responses:
+            return self.responses.pop(0)
+        return FetchResponse(200, {'etag': '"v1"'}, b'body')
+
+    def test_hit_within_ttl(self):
+        self.cache.fetch('http://a/q?x=1&y=2', self.fetchfunc, 'Arxiv')
+        resp = self.cache.fetch('http://A/q?y=2&x=1', self.fetchfunc, 'Arxiv')
+        self.assertEqual(resp.body, b'body')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_revalidates_after_ttl(self):
+        self.cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        self.now = 61
+        self.responses.append(FetchResponse(304, {}, b''))
+        resp = self.cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        self.assertEqual(self.requests[-1], {'If-None-Match': '"v1"'})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.body, b'body')
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_per_target_ttl(self):
+        self.cache.fetch('http://a/q', self.fetchfunc, 'PubMed')
+        self.now = 61
+        self.cache.fetch('http://a/q', self.fetchfunc, 'PubMed')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_errors_not_stored(self):
+        self.responses.append(FetchResponse(503, {}, b''))
+        self.cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        self.cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_lru_eviction(self):
+        cache = self.make_cache(max_bytes=8)
+        cache.fetch('http://a/1', self.fetchfunc, 'Arxiv')
+        cache.fetch('http://a/2', self.fetchfunc, 'Arxiv')
+        cache.fetch('http://a/1', self.fetchfunc, 'Arxiv')
+        cache.fetch('http://a/3', self.fetchfunc, 'Arxiv')
+        self.assertEqual(cache.evictions, 1)
+        cache.fetch('http://a/1', self.fetchfunc, 'Arxiv')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_survives_restart(self):
+        self.cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        cache = self.make_cache()
+        cache.fetch('http://a/q', self.fetchfunc, 'Arxiv')
+        self.assertEqual(cache.hits, 1)
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.slept = []
+
+    def sleep(self, t):
+        self.slept.append(t)
+        self.now += t
+
+    def bucket(self, rate, capacity):
+        return TokenBucket(rate, capacity, timefunc=lambda: self.now, sleepfunc=self.sleep)
+
+    def test_burst_then_rate(self):
+        b = self.bucket(1 / 3, 1)
+        b.acquire()
+        b.acquire()
+        self.assertEqual(self.slept, [3])
+
+    def test_refills(self):
+        b = self.bucket(1, 2)
+        b.acquire()
+        b.acquire()
+        self.now += 10
+        b.acquire()
+        b.acquire()
+        self.assertEqual(self.slept, [])
+
+    def test_penalize(self):
+        b = self.bucket(1, 5)
+        b.penalize(30)
+        b.acquire()
+        self.assertEqual(self.slept, [31])
+
+    def test_retries_on_429_with_retry_after(self):
+        responses = [FetchResponse(429, {'Retry-After': '7'}, b''),
+                     FetchResponse(503, {}, b''),
+                     FetchResponse(200, {}, b'ok')]
+        b = self.bucket(1, 1)
+        with patch.object(fetching, '_get', side_effect=responses) as get, \
+                patch.object(fetching, 'BACKOFF_BASE', 0):
+            resp = fetching.polite_get('http://a/q', None, 30, b)
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(self.slept[0], 8)
+
+    def test_fair_queue_takes_turns(self):
+        q = FairQueue()
+        for i in range(3):
+            q.put('busy', ('busy', i))
+        q.put('quiet', ('quiet', 0))
+        self.assertEqual([q.get()[0] for _ in range(4)], ['busy', 'quiet', 'busy', 'busy'])
+        self.assertIsNone(q.get(block=False))
+
+
+class SlackDeliveryTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(slack_bot, 'slack')
+        self.WebClient = patcher.start().WebClient
+        self.addCleanup(patcher.stop)
+        slack_bot.SLACK_CLIENTS.clear()
+        self.client = self.WebClient.return_value
+        self.client.api_call.return_value = {'ok': True, 'ts': '123.4'}
+        self.events = list(ArxivQueryResponse(ARXIV_RESPONSE, ArxivQuery('C. elegans')).events())
+
+    def test_client_shared_per_token(self):
+        for _ in range(3):
+            slack_bot.send_message('key', 'chan', 'hi')
+        slack_bot.send_message('other', 'chan', 'hi')
+        self.assertEqual(self.WebClient.call_count, 2)
+
+    def test_one_message_per_event_without_digest(self):
+        handler = SlackMessageEventHandler('chan', 'user')
+        handler.slack_api_key = 'key'
+        delivered = []
+        handler.handle_all(self.events, delivered)
+        self.assertEqual(self.client.api_call.call_count, len(self.events))
+        self.assertEqual(delivered, self.events)
+
+    def test_digest_fits_one_message(self):
+        handler = SlackMessageEventHandler('chan', 'user', digest=True)
+        handler.slack_api_key = 'key'
+        delivered = []
+        handler.handle_all(self.events, delivered)
+        self.client.api_call.assert_called_once_with(
+            'chat.postMessage', channel='chan', text=Contains('10 publications'))
+        self.assertEqual(delivered, self.events)
+
+    def test_digest_overflow_goes_in_thread(self):
+        handler = SlackMessageEventHandler('chan', 'user', digest=True)
+        handler.slack_api_key = 'key'
+        with patch.object(slack_bot, 'DIGEST_MAX_CHARS', 1000):
+            handler.handle_all(self.events, [])
+        calls = self.client.api_call.call_args_list
+        self.assertGreater(len(calls), 1)
+        self.assertLess(len(calls), len(self.events))
+        self.assertNotIn('thread_ts', calls[0][1])
+        self.assertTrue(all(c[1]['thread_ts'] == '123.4' for c in calls[1:]))
+        self.assertTrue(all(len(c[1]['text']) <= 1000 for c in calls))
+
+
+class RenderingTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(slack_bot, 'render_cache', RenderCache())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def events(self, query):
+        return list(ArxivQueryResponse(ARXIV_RESPONSE, query).events())
+
+    def test_slack_format(self):
+        evt = self.events(ArxivQuery('C. elegans'))[0]
+        authors = ', '.join(a.name for a in evt.authors)
+        self.assertEqual(
+            evt.msg_format(SlackMessageContent).frag.render(),
+            '{} "<{}|{}>" by _{}_\nMatched by ArXiv Query: '
+            '<http://export.arxiv.org/api/query?search_query=C.+elegans|C. elegans>'.format(
+                evt.headline, evt.link, evt.title, authors))
+
+    def test_rendered_once_across_subscribers(self):
+        first = self.events(ArxivQuery('C. elegans'))
+        second = self.events(ArxivQuery('C. elegans'))
+        for evt in first + second:
+            evt.msg_format(SlackMessageContent)
+        self.assertEqual(self.cache.misses, len(first))
+        self.assertEqual(self.cache.hits, len(second))
+
+    def test_other_query_rendered_separately(self):
+        self.events(ArxivQuery('C. elegans'))[0].msg_format(SlackMessageContent)
+        self.events(ArxivQuery('neurons'))[0].msg_format(SlackMessageContent)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_doc_reused_across_content_types(self):
+        evt = self.events(ArxivQuery('C. elegans'))[0]
+        with patch.object(type(evt), 'msg_doc', autospec=True,
+                          side_effect=ArxivPublicationEvent.msg_doc) as msg_doc:
+            evt.msg_format(SlackMessageContent)
+            evt.msg_format(HtmlContent)
+            evt.msg_format(UnicodeStringContent)
+        msg_doc.assert_called_once()
+
+    def test_html(self):
+        evt = self.events(ArxivQuery('a<b'))[0]
+        content = evt.msg_format(HtmlContent).frag.render()
+        self.assertIn('<a href="{}">'.format(evt.link), content)
+        self.assertIn('<em>', content)
+        self.assertIn('a&lt;b</a>', content)
+
+    def test_plain_text(self):
+        evt = self.events(ArxivQuery('C. elegans'))[0]
+        content = evt.msg_format(UnicodeStringContent).frag.render()
+        self.assertIn('"{} ({})"'.format(evt.title, evt.link), content)
+        self.assertNotIn('<', content)
+
+    def test_cache_bounded(self):
+        cache = RenderCache(maxsize=2)
+        for i in range(5):
+            cache.render(i, lambda: (), SlackMessageContent)
+        self.assertEqual(len(cache), 2)
+
+
+class OutboxTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(None)
+        self.now = 0
+        self.clock = 1000
+        self.posts = []
+        self.engines = []
+        self.sender = self.make_sender()
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.stop()
+        self.db.close()
+
+    def make_sender(self, worker=None):
+        self.engine = SchedulerEngine(self.db)
+        self.engines.append(self.engine)
+        sender = SlackSender(self.engine, self.post, 'key', timefunc=lambda: self.now,
+                             worker=worker, clock=lambda: self.clock)
+        sender.load()
+        return sender
+
+    def post(self, token, channel, text, thread=None):
+        self.posts.append((channel, text, thread))
+        return {'ok': True, 'ts': 'ts-{}'.format(len(self.posts))}
+
+    def drain(self, limit=100):
+        """ Run the sender until it's out of messages, advancing the clock as it waits """
+        for _ in range(limit):
+            wait = self.sender.step()
+            if wait is None:
+                return
+            self.now += wait
+
+    def test_one_message_per_second_per_channel(self):
+        for i in range(3):
+            self.sender.put('a', ['a{}'.format(i)])
+        self.sender.put('b', ['b0'])
+        self.assertEqual(self.sender.step(), 0)
+        self.assertEqual(self.sender.step(), 0)
+        self.assertEqual(self.sender.step(), 1)
+        self.assertEqual([p[1] for p in self.posts], ['a0', 'b0'])
+        self.drain()
+        self.assertEqual([p[1] for p in self.posts], ['a0', 'b0', 'a1', 'a2'])
+        self.assertEqual(self.now, 2)
+
+    def test_retry_after_429(self):
+        from slack.errors import SlackApiError
+        response = MagicMock(status_code=429, headers={'Retry-After': '30'})
+        self.post = MagicMock(side_effect=[SlackApiError('slow down', response), {'ts': '1'}])
+        self.sender = self.make_sender()
+        self.sender.put('a', ['hi'])
+        self.assertEqual(self.sender.step(), 0)
+        self.assertGreaterEqual(self.sender.step(), 30)
+        self.assertEqual(self.sender.rate_limited, 1)
+        self.now = 29
+        self.assertGreater(self.sender.step(), 0)
+        self.now = 31
+        self.sender.step()
+        self.assertEqual(self.post.call_count, 2)
+        self.assertEqual(len(self.sender), 0)
+
+    def test_gives_up_after_errors(self):
+        self.post = MagicMock(side_effect=Exception('nope'))
+        self.sender = self.make_sender()
+        self.sender.put('a', ['hi'])
+        self.drain(limit=10 * MAX_ATTEMPTS)
+        self.assertEqual(self.post.call_count, MAX_ATTEMPTS)
+        self.assertEqual(len(self.sender), 0)
+
+    def test_later_texts_go_in_thread(self):
+        self.sender.put('a', ['head', 'more', 'rest'])
+        self.drain()
+        self.assertEqual(self.posts, [('a', 'head', None),
+                                      ('a', 'more', 'ts-1'),
+                                      ('a', 'rest', 'ts-1')])
+
+    def test_queued_messages_survive_restart(self):
+        self.sender.put('a', ['one'])
+        self.sender.put('a', ['two'])
+        self.sender.step()
+        self.engine.stop()
+        self.sender = self.make_sender()
+        self.assertEqual(len(self.sender), 1)
+        self.drain()
+        self.assertEqual([p[1] for p in self.posts], ['one', 'two'])
+
+    def test_messages_posted_by_the_sender_holding_them(self):
+        self.clock = 1000
+        self.sender = self.make_sender(worker='w1')
+        other = self.make_sender(worker='w2')
+        self.sender.put('a', ['mine'])
+        other.put('b', ['theirs'])
+        self.sender.load()
+        other.load()
+        self.assertEqual((len(self.sender), len(other)), (1, 1))
+        self.drain()
+        self.assertEqual([p[1] for p in self.posts], ['mine'])
+        # A stopped sender's messages are taken over once its leases run out
+        self.clock += LEASE_SECONDS + 1
+        self.sender.load()
+        self.drain()
+        self.assertEqual([p[1] for p in self.posts], ['mine', 'theirs'])
+        self.assertEqual(len(other), 1)
+        other.step()
+        self.assertEqual(len(other), 0)
+        self.assertEqual(len(self.posts), 2)
+
+
+class InlineExecutor(object):
+    def submit(self, fn, *args):
+        fn(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class SlackEventQueueTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(slack_bot, 'fetch',
+                               return_value=FetchResponse(200, {}, format_arxiv_feed([])))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = DB(None)
+        self.engine = SchedulerEngine(self.db, executor=InlineExecutor())
+        self.engine.start()
+        self.post = MagicMock()
+        self.queue = SlackEventQueue(self.engine, self.post, 'key')
+        self.ts = str(time.time())
+
+    def tearDown(self):
+        self.engine.stop()
+        self.db.close()
+
+    def body(self, event_id, channel='chan'):
+        return {'token': 'bottok', 'event_id': event_id,
+                'event': {'text': 'Search for grapes at Arxiv daily', 'ts': self.ts,
+                          'user': 'U1', 'channel': channel}}
+
+    def test_view_responds_without_handling(self):
+        queue = MagicMock()
+        request = MagicMock()
+        request.json_body = self.body('Ev1')
+        with patch.object(slack_bot, 'event_queue', queue), \
+                patch.object(slack_bot, 'os') as mock_os, \
+                patch.object(slack_bot, 'handle_message_event') as handle:
+            mock_os.environ = {'SLACK_BOT_TOKEN': 'bottok'}
+            slack_events(request)
+        queue.put.assert_called_once()
+        handle.assert_not_called()
+
+    def test_replies_once_per_event_id(self):
+        self.assertTrue(self.queue.put(self.body('Ev1'), ['Arxiv']))
+        self.assertFalse(self.queue.put(self.body('Ev1'), ['Arxiv']))
+        self.post.assert_called_once_with('key', 'chan', Contains('grapes'))
+        self.assertEqual(self.queue.duplicates, 1)
+
+    def test_handled_ids_persist(self):
+        self.queue.put(self.body('Ev1'), ['Arxiv'])
+        queue = SlackEventQueue(self.engine, self.post, 'key')
+        queue.put(self.body('Ev1'), ['Arxiv'])
+        self.assertEqual(self.post.call_count, 1)
+        with self.engine.transaction() as conn:
+            self.assertIn('Ev1', appmaker(conn.root())[PROCESSED_EVENTS_KEY])
+
+    def test_conflict_retried(self):
+        with patch.object(slack_bot, 'handle_message_event',
+                          side_effect=[ConflictError(), 'reply']) as mock:
+            self.assertTrue(self.queue.put(self.body('Ev1'), ['Arxiv']))
+        self.assertEqual(mock.call_count, 2)
+        self.post.assert_called_once_with('key', 'chan', 'reply')
+        self.assertEqual(self.queue.handled, 1)
+
+    def test_conflicted_event_queued_again(self):
+        queue = SlackEventQueue(self.engine, self.post, 'key', attempts=2, requeue_delay=0)
+        with patch.object(slack_bot, 'handle_message_event',
+                          side_effect=[ConflictError(), ConflictError(), 'reply']) as mock, \
+                patch.object(inbox.L, 'warning'):
+            self.assertTrue(queue.put(self.body('Ev1'), ['Arxiv']))
+            deadline = time.monotonic() + 5
+            while not self.post.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(mock.call_count, 3)
+        self.post.assert_called_once_with('key', 'chan', 'reply')
+        self.assertFalse(queue.put(self.body('Ev1'), ['Arxiv']))
+
+    def test_failed_event_handled_when_sent_again(self):
+        self.queue.requeues = 0
+        with patch.object(slack_bot, 'handle_message_event', side_effect=ConflictError()), \
+                patch.object(scheduling.L, 'error'), patch.object(inbox.L, 'error'):
+            self.assertTrue(self.queue.put(self.body('Ev1'), ['Arxiv']))
+        self.post.assert_not_called()
+        self.assertTrue(self.queue.put(self.body('Ev1'), ['Arxiv']))
+        self.post.assert_called_once_with('key', 'chan', Contains('grapes'))
+        with self.engine.transaction() as conn:
+            self.assertIn('Ev1', appmaker(conn.root())[PROCESSED_EVENTS_KEY])
+
+    def test_new_channel_scheduler_started(self):
+        self.queue.put(self.body('Ev1', 'chan1'), ['Arxiv'])
+        self.queue.put(self.body('Ev2', 'chan2'), ['Arxiv'])
+        self.assertEqual(len(self.engine.schedulers), 2)
+        self.assertTrue(all(s.sched is self.engine for s in self.engine.schedulers))
+
+
+class ConcurrentEventTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(slack_bot, 'fetch',
+                               return_value=FetchResponse(200, {}, format_arxiv_feed([])))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        storage_factory, dbkw = resolve_uri('file://{}/db.zdb'.format(self.tempdir.name))
+        self.db = DB(storage_factory(), **dbkw)
+        self.addCleanup(self.db.close)
+        self.engine = SchedulerEngine(self.db, max_workers=4)
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        self.post = MagicMock()
+        self.queue = SlackEventQueue(self.engine, self.post, 'key')
+        self.queue.prepare()
+
+    def test_events_for_new_channels(self):
+        ts = str(time.time())
+        n = 12
+        with patch.object(inbox.L, 'warning') as warning:
+            for i in range(n):
+                self.queue.put({'event_id': 'Ev{}'.format(i),
+                                'event': {'text': 'Search for grapes at Arxiv daily', 'ts': ts,
+                                          'user': 'U1', 'channel': 'chan{}'.format(i)}},
+                               ['Arxiv'])
+            deadline = time.monotonic() + 30
+            while self.post.call_count < n and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(self.queue.handled, n)
+        warning.assert_not_called()
+        self.assertEqual(self.post.call_count, n)
+        with self.engine.transaction() as conn:
+            root = appmaker(conn.root())
+            self.assertEqual(len(root[slack_bot.SCHEDULER_KEY]), n)
+            self.assertEqual(len(root[slack_bot.HANDLER_KEY]), n)
+            self.assertEqual(root[slack_bot.SCHEDULER_COUNT_KEY](), n)
+
+
+def paper(ident, title, summary='', authors=(), cats=(), updated='2020-01-01T00:00:00Z'):
+    return dict(id='http://arxiv.org/abs/{}v1'.format(ident), link='http://arxiv.org/abs/' + ident,
+                title=title, summary=summary, updated=updated,
+                authors=[dict(name=a) for a in authors],
+                tags=[dict(term=c) for c in cats])
+
+
+class PercolatorTests(unittest.TestCase):
+    PAPERS = [paper('1', 'C. elegans in complex media', 'Locomotion of the nematode',
+                    ['X. N. Shen', 'P. E. Arratia'], ['physics.flu-dyn', 'q-bio.NC']),
+              paper('2', 'Elegans chemotaxis', 'A worm model of c. elegans neurons',
+                    ['S. Larson'], ['q-bio.NC']),
+              paper('3', 'Spiking neural networks', 'Networks of neurons',
+                    ['A. Author'], ['cs.NE']),
+              paper('4', 'Nematode locomotion', 'Undulatory swimming',
+                    ['P. E. Arratia'], ['q-bio.QM'], updated='2019-12-01T00:00:00Z')]
+
+    def match(self, query_str):
+        index = EntryIndex(self.PAPERS)
+        docs = parse_query(query_str).evaluate(index, dict())
+        return sorted(index.entries[d]['title'][:5] for d in docs)
+
+    def test_phrase(self):
+        self.assertEqual(self.match('"c. elegans"'), ['C. el', 'Elega'])
+        self.assertEqual(self.match('ti:"C. elegans"'), ['C. el'])
+
+    def test_implicit_and(self):
+        self.assertEqual(self.match('nematode locomotion'), ['C. el', 'Nemat'])
+        self.assertEqual(self.match('neurons networks'), ['Spiki'])
+
+    def test_operators(self):
+        self.assertEqual(self.match('ti:nematode OR ti:chemotaxis'), ['Elega', 'Nemat'])
+        self.assertEqual(self.match('au:arratia ANDNOT cat:q-bio.QM'), ['C. el'])
+        self.assertEqual(self.match('cat:q-bio.NC AND (ti:spiking OR abs:worm)'), ['Elega'])
+        self.assertEqual(self.match('abs:neuron*'), ['Elega', 'Spiki'])
+        self.assertEqual(self.match('cat:q-bio*'), ['C. el', 'Elega', 'Nemat'])
+
+    def test_syntax_errors(self):
+        for q in ('(worm', 'worm)', 'worm AND', 'xx:worm', 'ANDNOT worm'):
+            with self.assertRaises(QuerySyntaxError, msg=q):
+                parse_query(q)
+
+    def test_match_all_shares_evaluation(self):
+        perc = ArxivPercolator(complete=True)
+        perc.load(self.PAPERS, datetime(2019, 1, 1))
+        queries = [ArxivQuery('cat:q-bio.NC'), ArxivQuery('cat:q-bio.NC  '),
+                   ArxivQuery('au:arratia'), ArxivQuery('cat:q-bio.NC AND au:arratia')]
+        res = perc.match_all(queries)
+        self.assertEqual(len(res), 3)
+        self.assertEqual([e['title'][:5] for e in res[queries[3].coalesce_key()]], ['C. el'])
+
+    def test_execute_answers_covered_queries(self):
+        perc = ArxivPercolator(['q-bio.NC', 'cs.*'], timefunc=lambda: 0,
+                               nowfunc=lambda: datetime(2020, 1, 2))
+        with patch.object(slack_bot, 'fetch',
+                          return_value=FetchResponse(200, {}, format_arxiv_feed(self.PAPERS))) as f:
+            since = datetime(2019, 12, 31)
+            self.assertIsNone(perc.execute(ArxivQuery('cat:q-bio.NC AND worm'), since))
+            perc.refresh()
+            resp = perc.execute(ArxivQuery('cat:q-bio.NC AND worm'), since)
+            self.assertEqual([e.title for e in resp.events()], ['Elegans chemotaxis'])
+            self.assertIsNotNone(perc.execute(ArxivQuery('cat:cs.NE'), since))
+            self.assertIsNone(perc.execute(ArxivQuery('worm'), since))
+            self.assertIsNone(perc.execute(ArxivQuery('cat:q-bio.QM'), since))
+            self.assertIsNone(perc.execute(ArxivQuery('cat:q-bio.NC'), None))
+            self.assertIsNone(perc.execute(ArxivQuery('cat:q-bio.NC'), datetime(2019, 1, 1)))
+        self.assertEqual(f.call_count, 1)
+
+    def test_answers_from_old_listing_while_refreshing(self):
+        perc = ArxivPercolator(['q-bio.NC'], nowfunc=lambda: datetime(2020, 1, 2))
+        perc.load(self.PAPERS, datetime(2019, 1, 1))
+        answered = []
+
+        def fetch(*args, **kwargs):
+            t = threading.Thread(target=lambda: answered.append(
+                perc.execute(ArxivQuery('cat:q-bio.NC'), datetime(2019, 6, 1))))
+            t.start()
+            t.join(5)
+            return FetchResponse(200, {}, format_arxiv_feed(self.PAPERS[1:2]))
+        with patch.object(slack_bot, 'fetch', side_effect=fetch):
+            perc.refresh()
+        self.assertEqual(len(list(answered[0].events())), 2)
+        self.assertEqual(len(perc.index), 3)
+
+    def test_engine_uses_percolator(self):
+        engine = SchedulerEngine()
+        engine.percolator = ArxivPercolator(complete=True)
+        engine.percolator.load(self.PAPERS, datetime(2019, 1, 1))
+        with patch.object(ArxivQuery, 'execute') as execute:
+            resp = engine.execute(ArxivQuery('nematode'), datetime(2019, 6, 1))
+        execute.assert_not_called()
+        self.assertEqual(len(list(resp.events())), 2)
+
+
+class PublicationStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.store = PublicationStore()
+        self.store.add_entries(PercolatorTests.PAPERS)
+
+    def titles(self, pubs):
+        return [p.title[:5] for p in pubs]
+
+    def test_detect_keywords(self):
+        self.assertEqual(detect_keywords('We study worms.\nKeywords: C. elegans; locomotion,\n'
+                                         'neural circuits.'),
+                         ['C. elegans', 'locomotion', 'neural circuits'])
+        self.assertEqual(detect_keywords('Good keywords are hard to pick'), [])
+
+    def test_search(self):
+        self.assertEqual(self.titles(self.store.search('"c. elegans"')), ['C. el', 'Elega'])
+        self.assertEqual(self.titles(self.store.search('au:arratia ANDNOT cat:q-bio.QM')),
+                         ['C. el'])
+        self.assertEqual(self.titles(self.store.search('abs:neuron*')), ['Elega', 'Spiki'])
+
+    def test_search_in_span(self):
+        self.assertEqual(self.titles(self.store.search('au:arratia', start=datetime(2019, 12, 15))),
+                         ['C. el'])
+        self.assertEqual(self.titles(self.store.search('au:arratia', end=datetime(2019, 12, 15))),
+                         ['Nemat'])
+
+    def test_newer_version_replaces(self):
+        e = paper('2', 'Elegans thermotaxis', 'Keywords: thermotaxis, AFD neuron',
+                  updated='2020-02-01T00:00:00Z')
+        e['id'] = 'http://arxiv.org/abs/2v2'
+        self.store.add_entry(e)
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(self.store.get('2').version, 2)
+        self.assertEqual(self.store.search('chemotaxis'), [])
+        self.assertEqual(self.titles(self.store.search('kw:"afd neuron"')), ['Elega'])
+        self.store.add_entry(PercolatorTests.PAPERS[1])
+        self.assertEqual(self.store.get('2').version, 2)
+
+    def test_abstracts_in_compressed_blocks(self):
+        store = PublicationStore()
+        entries = [paper(str(i), 'Paper {}'.format(i), 'Abstract number {}'.format(i))
+                   for i in range(pubstore.BLOCK_ENTRIES * 2 + 3)]
+        store.add_entries(entries)
+        self.assertEqual(sorted(b.full for b in store._blocks.values()), [False, True, True])
+        for i in (0, pubstore.BLOCK_ENTRIES + 1, len(entries) - 1):
+            self.assertEqual(store.abstract(str(i)), 'Abstract number {}'.format(i))
+        self.assertEqual(len(store.search('abs:number')), len(entries))
+
+    def test_replaced_abstracts_reclaimed(self):
+        store = PublicationStore()
+        entries = [paper(str(i), 'Paper {}'.format(i), 'Abstract number {}'.format(i))
+                   for i in range(pubstore.BLOCK_ENTRIES)]
+        store.add_entries(entries)
+        (first,) = store._blocks.keys()
+        self.assertTrue(store._blocks[first].full)
+        store.add_entry(dict(entries[0], id='http://arxiv.org/abs/0v2', summary='Revised',
+                             updated='2020-02-01T00:00:00Z'))
+        self.assertIsNone(store._blocks[first].abstracts()[0])
+        self.assertEqual(store.abstract('0'), 'Revised')
+        for e in entries[1:]:
+            store.add_entry(dict(e, id=e['id'][:-1] + '2', updated='2020-02-01T00:00:00Z'))
+        self.assertNotIn(first, store._blocks)
+        self.assertEqual(store.abstract('5'), 'Abstract number 5')
+
+    def test_adds_leave_store_object_unchanged(self):
+        db = DB(None)
+        self.addCleanup(db.close)
+        managers = [transaction.TransactionManager() for _ in range(2)]
+        conns = [db.open(transaction_manager=tm) for tm in managers]
+        conns[0].root()['store'] = PublicationStore()
+        managers[0].commit()
+        managers[1].begin()
+        stores = [c.root()['store'] for c in conns]
+        stores[0].add_entry(PercolatorTests.PAPERS[0])
+        stores[1].add_entry(PercolatorTests.PAPERS[1])
+        self.assertFalse(any(s._p_changed for s in stores))
+        self.assertNotEqual(stores[0]._docids['1'], stores[1]._docids['2'])
+        self.assertNotEqual(stores[0].get('1').abstract_ref[0],
+                            stores[1].get('2').abstract_ref[0])
+        for tm in managers:
+            tm.abort()
+        for c in conns:
+            c.close()
+
+    def test_query_event_stores_results_and_deliveries(self):
+        engine = SchedulerEngine()
+        engine.publications = self.store
+        search_sched = SearchSchedule(ArxivQuery('C. elegans'), rrulestr('FREQ=DAILY'))
+        with patch.object(ArxivQuery, 'execute') as execute:
+            execute.return_value = ArxivQueryResponse(ARXIV_RESPONSE, search_sched.query)
+            query_event(datetime.now(), engine, search_sched, RecordingHandler())()
+        self.assertEqual(len(self.store), 4 + len(ARXIV_RESPONSE['entries']))
+        self.assertIn('1110.3084', self.store)
+        self.assertEqual(len(self.store.delivered()), len(ARXIV_RESPONSE['entries']))
+        self.assertEqual(self.store.delivered()[0][2], 'C. elegans')
+
+
+class SimulationTests(unittest.TestCase):
+    START = datetime(2021, 3, 1)
+
+    def root(self, *subscriptions):
+        scheds = dict()
+        for channel, query, rule, digest in subscriptions:
+            lss = scheds.setdefault(channel, ListSearchScheduler())
+            lss.insert(SearchSchedule(ArxivQuery(query), rrulestr(rule, dtstart=self.START)),
+                       SlackMessageEventHandler(channel, 'user', digest=digest))
+        return {slack_bot.SCHEDULER_KEY: scheds}
+
+    def simulate(self, root, duration=timedelta(days=1), **kwargs):
+        sim = Simulation(start=self.START.timestamp(), **kwargs)
+        sim.load(root)
+        return sim.run(duration)
+
+    def test_coalesced_subscriptions_share_upstream_calls(self):
+        report = self.simulate(self.root(('a', 'worms', 'FREQ=HOURLY', False),
+                                         ('b', 'worms', 'FREQ=HOURLY', False),
+                                         ('c', 'worms', 'FREQ=HOURLY', False)))
+        self.assertEqual(report.runs, 3 * 25)
+        self.assertEqual(report.upstream_calls, 25)
+        self.assertEqual(report.peak_upstream_calls_per_hour, {'Arxiv': 1})
+        self.assertEqual(report.peak_concurrent_queries, 3)
+
+    def test_lag_when_workers_are_busy(self):
+        report = self.simulate(self.root(*[('a', 'q{}'.format(i), 'FREQ=DAILY', False)
+                                           for i in range(5)]),
+                               max_workers=1, query_latency=10)
+        self.assertEqual(report.peak_concurrent_queries, 1)
+        self.assertEqual(report.max_lag, 40)
+        self.assertEqual(report.runs, 10)
+
+    def test_messages_per_channel_per_minute(self):
+        report = self.simulate(self.root(('a', 'worms', 'FREQ=HOURLY', False),
+                                         ('b', 'worms', 'FREQ=HOURLY', True)),
+                               results_per_run=3)
+        self.assertEqual(report.peak_slack_messages_per_minute, {'a': 3, 'b': 1})
+        self.assertEqual(report.slack_messages, 25 * 4)
+
+    def test_month_with_many_subscriptions(self):
+        report = self.simulate(self.root(*[(str(i % 7), 'q{}'.format(i % 13), 'FREQ=DAILY', False)
+                                           for i in range(40)]),
+                               duration=timedelta(days=30))
+        self.assertEqual(report.runs, 40 * 31)
+        self.assertEqual(report.upstream_calls, 13 * 31)
+        self.assertIn('Peak concurrent queries', str(report))
+
+    def test_nothing_written_to_stored_schedules(self):
+        root = self.root(('a', 'worms', 'FREQ=HOURLY', False))
+        stored, _ = next(root[slack_bot.SCHEDULER_KEY]['a'].items())
+        self.simulate(root)
+        self.assertIsNone(stored.watermark)
+        self.assertIsNone(stored.cursor)
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 51)
+        self.assertEqual(percentile(values, 99), 100)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        bench = Benchmark(channels=2, subscriptions=2, duration=0.5,
+                          arxiv_size=5, arxiv_latency=0, digest=True)
+        results = bench.run()
+        json.dumps(results)
+        self.assertEqual(results['webhook']['events'], 4)
+        self.assertGreater(results['events_per_second'], 0)
+        # One search per query, shared by the channels
+        self.assertEqual(results['arxiv']['requests'], 2)
+        # A reply and a digest for each subscription, some maybe still queued
+        self.assertEqual(results['slack']['messages'] + results['slack']['outbox_backlog'], 8)
+        self.assertIsNone(slack_bot.event_queue)
+        self.assertEqual(slack_bot.ARXIV_API_URL, 'http://export.arxiv.org/api/query')
+
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_format(self):
+        reg = metrics.Registry()
+        h = reg.histogram('x_seconds', 'X', ['target'], buckets=(0.1, 1))
+        h.observe(0.05, target='a')
+        h.observe(0.5, target='a')
+        h.observe(5, target='a')
+        lines = reg.render().splitlines()
+        self.assertEqual(lines[:2], ['# HELP x_seconds X', '# TYPE x_seconds histogram'])
+        self.assertEqual(lines[2:], ['x_seconds_bucket{target="a",le="0.1"} 1',
+                                     'x_seconds_bucket{target="a",le="1"} 2',
+                                     'x_seconds_bucket{target="a",le="+Inf"} 3',
+                                     'x_seconds_sum{target="a"} 5.55',
+                                     'x_seconds_count{target="a"} 3'])
+
+    def test_label_values_escaped(self):
+        reg = metrics.Registry()
+        reg.counter('x_total', 'X', ['q']).inc(q='say "hi"\n')
+        self.assertIn('x_total{q="say \\"hi\\"\\n"} 1', reg.render())
+
+    def test_wrong_labels(self):
+        with self.assertRaises(ValueError):
+            metrics.Counter('x_total', 'X', ['target']).inc()
+
+    def test_query_event_records_run_lag_and_handler(self):
+        engine = SchedulerEngine()
+        handler = RecordingHandler()
+        search_sched = SearchSchedule(ArxivQuery('C. elegans'),
+                                      rrulestr('FREQ=DAILY', dtstart=datetime(2020, 1, 1)))
+        runs = metrics.SEARCH_RUNS.get(target='Arxiv')
+        lags = metrics.SCHEDULER_LAG.count()
+        delivered = metrics.EVENTS_DELIVERED.get(handler='RecordingHandler')
+        with patch.object(ArxivQuery, 'execute') as execute:
+            execute.return_value = ArxivQueryResponse(ARXIV_RESPONSE, search_sched.query)
+            query_event(datetime(2020, 1, 1), engine, search_sched, handler)()
+        self.assertEqual(metrics.SEARCH_RUNS.get(target='Arxiv'), runs + 1)
+        self.assertEqual(metrics.SCHEDULER_LAG.count(), lags + 1)
+        self.assertEqual(metrics.EVENTS_DELIVERED.get(handler='RecordingHandler'),
+                         delivered + len(ARXIV_RESPONSE['entries']))
+        self.assertGreater(metrics.HANDLER_SECONDS.count(handler='RecordingHandler'), 0)
+
+    def test_coalescer_times_upstream_queries(self):
+        before = metrics.QUERY_SECONDS.count(target='PubMed')
+        errors = metrics.QUERY_ERRORS.get(target='PubMed')
+        coalescer = QueryCoalescer()
+        with patch.object(PubmedQuery, 'execute', side_effect=IOError):
+            with self.assertRaises(IOError):
+                coalescer.execute(PubmedQuery('worms'))
+        self.assertEqual(metrics.QUERY_SECONDS.count(target='PubMed'), before + 1)
+        self.assertEqual(metrics.QUERY_ERRORS.get(target='PubMed'), errors + 1)
+
+    def test_send_message_errors_counted(self):
+        client = MagicMock()
+        client.api_call.side_effect = IOError
+        errors = metrics.SLACK_POST_ERRORS.get()
+        with self.assertRaises(IOError):
+            slack_bot.send_message(client, 'chan', 'hi')
+        self.assertEqual(metrics.SLACK_POST_ERRORS.get(), errors + 1)
+
+    def test_engine_collector(self):
+        engine = SchedulerEngine()
+        engine.enter(60, 0, lambda: None)
+        collector = metrics.watch_engine(engine)
+        self.addCleanup(metrics.registry.remove_collector, collector)
+        request = testing.DummyRequest()
+        response = metrics.metrics_view(request)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.text
+        self.assertIn('ow_scholar_timer_queue_depth 1', text)
+        self.assertIn('ow_scholar_active_schedules 0', text)
+        self.assertIn('ow_scholar_cache_requests_total{cache="render",result="hit"}', text)
+        self.assertIn('# TYPE ow_scholar_query_seconds histogram', text)
+
+
+class TracingTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.path = os.path.join(self.tempdir.name, 'traces.json')
+        self.tracer = tracing.Tracer(tracing.TraceWriter(self.path))
+
+    def events(self):
+        with open(self.path) as f:
+            return json.loads(f.read().rstrip(',\n') + ']')
+
+    def test_off_without_writer(self):
+        tracer = tracing.Tracer()
+        self.assertIs(tracer.trace('x'), tracing.NULL_SPAN)
+        self.assertIs(tracer.span('x'), tracing.NULL_SPAN)
+
+    def test_span_outside_trace_ignored(self):
+        self.assertIs(self.tracer.span('x'), tracing.NULL_SPAN)
+
+    def test_nested_spans_written_in_chrome_format(self):
+        with self.tracer.trace('outer', a=1):
+            with self.tracer.span('inner') as sp:
+                sp.set(b=2)
+        with self.tracer.trace('second'):
+            pass
+        with open(self.path) as f:
+            self.assertTrue(f.read().startswith('[\n'))
+        inner, outer, second = self.events()
+        self.assertEqual((inner['name'], outer['name'], second['name']),
+                         ('inner', 'outer', 'second'))
+        self.assertEqual(inner['ph'], 'X')
+        self.assertEqual(inner['args']['trace'], outer['args']['trace'])
+        self.assertNotEqual(second['args']['trace'], outer['args']['trace'])
+        self.assertEqual((outer['args']['a'], inner['args']['b']), (1, 2))
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+
+    def test_error_recorded(self):
+        with self.assertRaises(KeyError):
+            with self.tracer.trace('outer'):
+                raise KeyError()
+        self.assertEqual(self.events()[0]['args']['error'], 'KeyError')
+
+    def test_not_sampled(self):
+        self.tracer.sample_rate = 0
+        self.assertIs(self.tracer.trace('x'), tracing.NULL_SPAN)
+
+    def test_continued_on_another_thread(self):
+        with patch.object(tracing, 'tracer', self.tracer):
+            def work():
+                with tracing.span('work'):
+                    pass
+            with tracing.trace('request'):
+                fn = tracing.bind(work, 'handle')
+            t = threading.Thread(target=fn)
+            t.start()
+            t.join()
+        events = self.events()
+        by_name = {e['name']: e for e in events if e['ph'] == 'X'}
+        self.assertEqual(set(by_name), {'request', 'handle', 'work'})
+        self.assertEqual(len({e['args']['trace'] for e in events}), 1)
+        self.assertNotEqual(by_name['request']['tid'], by_name['handle']['tid'])
+        self.assertEqual(sorted(e['ph'] for e in events if e['cat'] == 'ow_scholar.flow'),
+                         ['f', 's'])
+
+    def test_search_run_spans(self):
+        engine = SchedulerEngine()
+        search_sched = SearchSchedule(ArxivQuery('C. elegans'), rrulestr('FREQ=DAILY'))
+        handler = SlackMessageEventHandler('chan', 'user')
+        with patch.object(tracing, 'tracer', self.tracer), \
+                patch.object(ArxivQuery, 'execute') as execute, \
+                patch.object(slack_bot, 'send_message'):
+            execute.return_value = ArxivQueryResponse(ARXIV_RESPONSE, search_sched.query)
+            query_event(datetime.now(), engine, search_sched, handler)()
+        names = {e['name'] for e in self.events()}
+        self.assertTrue({'search.run', 'query.execute', 'response.events', 'zodb.commit',
+                         'handler.handle_all', 'handler.call', 'msg_format'} <= names)
+
+    def test_profiler_keeps_slowest(self):
+        profiles = os.path.join(self.tempdir.name, 'profiles')
+        profiler = tracing.SamplingProfiler(profiles, keep=1, interval=0.001)
+        self.addCleanup(profiler.stop)
+        self.tracer.profiler = profiler
+
+        def slow_part(seconds):
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                pass
+        for seconds in (0.03, 0.1, 0.05):
+            with self.tracer.trace('run'):
+                slow_part(seconds)
+        files = os.listdir(profiles)
+        self.assertEqual(len(files), 1)
+        self.assertGreaterEqual(int(files[0].split('-')[0]), 100)
+        with open(os.path.join(profiles, files[0])) as f:
+            stacks = f.read()
+        self.assertIn('slow_part', stacks)
+        self.assertRegex(stacks, r'slow_part \d+')
+
+    def test_profiler_idle_without_traces(self):
+        profiler = tracing.SamplingProfiler(os.path.join(self.tempdir.name, 'profiles'),
+                                            interval=0.001)
+        self.addCleanup(profiler.stop)
+        self.tracer.profiler = profiler
+        with self.tracer.trace('run'):
+            time.sleep(0.01)
+        time.sleep(0.01)
+        with patch.object(profiler, 'sample') as sample:
+            time.sleep(0.05)
+        sample.assert_not_called()
@@ -0,0 +1,363 @@
+"""
+Traces of scheduled searches and Slack events, from the webhook to the Slack
+post, and an optional sampling profiler for the slowest of them
+
+Each scheduled run and each ``slack_events`` request starts a trace. Work
+done for it, here and on other threads, is recorded as nested spans and
+written to a file in the Chrome trace event format, which chrome://tracing,
+Perfetto and speedscope can open. Spans started outside of a trace, or while
+tracing is off, cost one attribute lookup.
+"""
+import json
+import os
+import random
+import sys
+import threading
+from heapq import heappush, heappushpop
+from itertools import count
+from logging import getLogger
+from time import perf_counter, time
+
+L = getLogger(__name__)
+
+__all__ = ['Tracer', 'TraceWriter', 'SamplingProfiler', 'tracer', 'trace', 'span',
+           'current', 'resume', 'bind', 'configure_tracing']
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ('tracer', 'trace_id', 'name', 'args', 'start', 'root')
+
+    def __init__(self, tracer, trace_id, name, args, root=False):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.args = args
+        self.root = root
+        self.start = None
+
+    def set(self, **args):
+        """ Add arguments to be recorded with the span """
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = perf_counter()
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, typ, exc, tb):
+        end = perf_counter()
+        if typ is not None:
+            self.args['error'] = typ.__name__
+        self.tracer._pop(self, end)
+        return False
+
+
+class TraceWriter(object):
+    """
+    Appends trace events to a file in the JSON array form of the Chrome trace
+    event format. The closing bracket is left off, which the format allows, so
+    that a file can be appended to by later runs and read while it's written
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, events):
+        lines = ''.join(json.dumps(e, separators=(',', ':')) + ',\n' for e in events)
+        with self._lock:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a') as f:
+                if new:
+                    f.write('[\n')
+                f.write(lines)
+
+
+class Tracer(object):
+    """
+    Records spans for a sample of traces
+
+    Spans are kept by the thread which started them until the outermost one
+    on that thread ends, and are then written together.
+    """
+
+    def __init__(self, writer=None, sample_rate=1.0, profiler=None):
+        """
+        Parameters
+        ----------
+        writer : TraceWriter, optional
+            Where to write finished spans. Tracing is off without one
+        sample_rate : float
+            The fraction of traces to record
+        profiler : SamplingProfiler, optional
+            Profiles each thread while it works on a recorded trace
+        """
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.profiler = profiler
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._ids = count(1)
+
+    @property
+    def enabled(self):
+        return self.writer is not None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._local.events = []
+        return stack
+
+    def _push(self, span):
+        stack = self._stack()
+        stack.append(span)
+        if span.root and self.profiler is not None:
+            self.profiler.begin(span)
+
+    def _pop(self, span, end):
+        stack = self._local.stack
+        stack.pop()
+        args = dict(span.args, trace=span.trace_id)
+        self._local.events.append({'name': span.name, 'cat': 'ow_scholar', 'ph': 'X',
+                                   'ts': span.start * 1e6, 'dur': (end - span.start) * 1e6,
+                                   'pid': self.pid, 'tid': threading.get_ident(),
+                                   'args': args})
+        if span.root:
+            if self.profiler is not None:
+                self.profiler.end(span, end - span.start)
+        if not stack:
+            events = self._local.events
+            self._local.events = []
+            try:
+                self.writer.write(events)
+            except Exception:
+                L.warning('Failed to write a trace to %s', self.writer.path, exc_info=True)
+
+    def _flow(self, phase, flow_id, trace_id):
+        event = {'name': 'continue', 'cat': 'ow_scholar.flow', 'ph': phase, 'id': flow_id,
+                 'ts': perf_counter() * 1e6, 'pid': self.pid, 'tid': threading.get_ident(),
+                 'args': {'trace': trace_id}}
+        if phase == 'f':
+            event['bp'] = 'e'
+        self._stack()
+        self._local.events.append(event)
+
+    def trace(self, name, **args):
+        """
+        A span starting a new trace, or a child of the current span if there is
+        one. Use as a context manager
+        """
+        if self.writer is None:
+            return NULL_SPAN
+        stack = self._stack()
+        if stack:
+            return Span(self, stack[-1].trace_id, name, args)
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return NULL_SPAN
+        args['time'] = time()
+        return Span(self, next(self._ids), name, args, root=True)
+
+    def span(self, name, **args):
+        """ A child of the current span, if there is one. Use as a context manager """
+        if self.writer is None:
+            return NULL_SPAN
+        stack = getattr(self._local, 'stack', None)
+        if not stack:
+            return NULL_SPAN
+        return Span(self, stack[-1].trace_id, name, args)
+
+    def current(self):
+        """
+        Returns a context for continuing the current trace on another thread
+        with `resume`, or `None` if there's no trace
+        """
+        stack = getattr(self._local, 'stack', None) if self.writer is not None else None
+        if not stack:
+            return None
+        flow_id = next(self._ids)
+        trace_id = stack[-1].trace_id
+        self._flow('s', flow_id, trace_id)
+        return (trace_id, flow_id)
+
+    def resume(self, context, name, **args):
+        """ A span continuing the trace a `current` context came from """
+        if context is None or self.writer is None:
+            return NULL_SPAN
+        trace_id, flow_id = context
+        self._flow('f', flow_id, trace_id)
+        return Span(self, trace_id, name, args, root=not self._stack())
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of threads working on traces every `interval` seconds,
+    and keeps the samples of the `keep` slowest traces as files of folded
+    stacks in `directory`, for flame graph tools like ``flamegraph.pl`` or
+    speedscope
+
+    The sampling thread waits without waking while no trace is active.
+    """
+
+    def __init__(self, directory, keep=10, interval=0.005, max_depth=128):
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+        self.max_depth = max_depth
+        self.slowest = []
+        """ Heap of (seconds, file name) for the kept traces """
+        self._active = dict()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+    def begin(self, span):
+        with self._lock:
+            self._active[threading.get_ident()] = (span, dict())
+            if len(self._active) == 1:
+                self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ow_scholar-profiler',
+                                                daemon=True)
+                self._thread.start()
+
+    def end(self, span, seconds):
+        with self._lock:
+            _, counts = self._active.pop(threading.get_ident(), (None, None))
+            if not counts:
+                return
+            if len(self.slowest) >= self.keep and seconds <= self.slowest[0][0]:
+                return
+        name = '{}-{}-{}.folded'.format(int(seconds * 1000), span.name, span.trace_id)
+        self._write(name, counts)
+        with self._lock:
+            if len(self.slowest) < self.keep:
+                heappush(self.slowest, (seconds, name))
+                dropped = None
+            else:
+                _, dropped = heappushpop(self.slowest, (seconds, name))
+        if dropped is not None:
+            try:
+                os.remove(os.path.join(self.directory, dropped))
+            except OSError:
+                pass
+
+    def _write(self, name, counts):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), 'w') as f:
+            for stack, n in sorted(counts.items()):
+                f.write('{} {}\n'.format(stack, n))
+
+    def sample(self):
+        """ Take one sample of each active thread's stack """
+        frames = sys._current_frames()
+        with self._lock:
+            for tid, (_, counts) in self._active.items():
+                frame = frames.get(tid)
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append('{}:{}'.format(frame.f_globals.get('__name__', code.co_filename),
+                                                code.co_name))
+                    frame = frame.f_back
+                if names:
+                    stack = ';'.join(reversed(names))
+                    counts[stack] = counts.get(stack, 0) + 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._cond.wait(self.interval)
+                if self._stopped:
+                    return
+            try:
+                self.sample()
+            except Exception:
+                L.warning('Failed to take a profiling sample', exc_info=True)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+tracer = Tracer()
+""" The tracer used by the app. Off until `configure_tracing` gives it a file """
+
+
+def trace(name, **args):
+    return tracer.trace(name, **args)
+
+
+def span(name, **args):
+    return tracer.span(name, **args)
+
+
+def current():
+    return tracer.current()
+
+
+def resume(context, name, **args):
+    return tracer.resume(context, name, **args)
+
+
+def bind(fn, name=None):
+    """
+    Returns ``fn`` wrapped to run in a span continuing the current trace, for
+    handing work to another thread. Returns ``fn`` itself if there's no trace
+    """
+    context = tracer.current()
+    if context is None:
+        return fn
+    name = name or getattr(fn, '__qualname__', 'call')
+
+    def traced(*args, **kwargs):
+        with tracer.resume(context, name):
+            return fn(*args, **kwargs)
+    return traced
+
+
+def configure_tracing(settings):
+    """
+    Turn on tracing if ``tracing.file`` is set. ``tracing.sample_rate`` is the
+    fraction of traces to record. If ``profiling.directory`` is also set, the
+    stacks of the ``profiling.slowest`` slowest traces are kept there, sampled
+    every ``profiling.interval`` seconds
+    """
+    path = settings.get('tracing.file')
+    if not path:
+        return None
+    profiler = None
+    directory = settings.get('profiling.directory')
+    if directory:
+        profiler = SamplingProfiler(directory,
+                                    keep=int(settings.get('profiling.slowest', 10)),
+                                    interval=float(settings.get('profiling.interval', 0.005)))
+    tracer.writer = TraceWriter(path)
+    tracer.sample_rate = float(settings.get('tracing.sample_rate', 1.0))
+    tracer.profiler = profiler
+    return tracer
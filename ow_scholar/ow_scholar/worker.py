@@ -0,0 +1,58 @@
+"""
+Run a share of the stored search schedules without serving the web app
+
+Start as many of these, on as many hosts, as needed to run the searches,
+each pointed at the same ZEO server, and set ``scheduler.mode = web`` for
+the web processes. The workers split the schedulers between them with
+leases. See `.leases`. For example::
+
+    ow_scholar_worker production.ini
+"""
+import argparse
+import signal
+import threading
+from logging import getLogger
+
+from . import make_init_db, run_schedulers, configure_response_cache
+from .tracing import configure_tracing
+
+L = getLogger(__name__)
+
+
+def main(argv=None):
+    from pyramid.paster import get_appsettings, setup_logging
+
+    parser = argparse.ArgumentParser(description='Run scheduled searches as a worker')
+    parser.add_argument('config_uri', help='The application configuration, like production.ini')
+    parser.add_argument('--worker-id',
+                        help='Default: scheduler.worker_id from the configuration, or the '
+                             'host name and process ID')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    settings = dict(get_appsettings(args.config_uri))
+    settings['scheduler.mode'] = 'worker'
+    if args.worker_id:
+        settings['scheduler.worker_id'] = args.worker_id
+    configure_response_cache(settings)
+    configure_tracing(settings)
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    db = make_init_db(settings['zodbconn.uri'])
+    try:
+        engine = run_schedulers(db, settings)
+        L.info('Worker %s started', engine.leases.worker)
+        try:
+            stopping.wait()
+        finally:
+            # Leases are given up on the way out, so other workers take over
+            # this one's schedulers without waiting for them to run out
+            engine.stop()
+    finally:
+        db.close()
@@ -7,11 +7,9 @@ requires = [
     'pyramid_debugtoolbar',
     'pyramid_retry',
     'pyramid_tm',
-    'pyramid_zodbconn',
     'transaction',
     'ZODB3',
     'waitress',
-    'arxiv',
     'slackclient',
     'recurrent',
     'python-dateutil',
@@ -39,6 +37,7 @@ setup(
     keywords='web pyramid pylons',
     packages=find_packages(),
     include_package_data=True,
+    package_data={'ow_scholar': ['arxiv.json']},
     zip_safe=False,
     extras_require={
         'testing': tests_require,
@@ -48,5 +47,10 @@ setup(
         'paste.app_factory': [
             'main = ow_scholar:main',
         ],
+        'console_scripts': [
+            'ow_scholar_simulate = ow_scholar.simulation:main',
+            'ow_scholar_bench = ow_scholar.bench:main',
+            'ow_scholar_worker = ow_scholar.worker:main',
+        ],
     },
 )